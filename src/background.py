@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the background estimators: each one gives
+the background and its dispersion, either as single values or as maps
+of the size of the picture. The main function times them on a fits file.
+"""
+
+import argparse
+import sys
+import time
+import warnings
+import numpy as np
+# pylint: disable=E
+from scipy.optimize import curve_fit
+from scipy import ndimage
+import mylib
+
+MAD_TO_SIGMA = 1.4826 # dispersion of a gaussian from its median absolute deviation
+
+class BackgroundEstimator(object):
+    """
+    Base class of the background estimators
+    """
+    name = 'base'
+
+    def estimate(self, pixels):
+        """
+        Estimate the background of a picture
+        :param pixels: 2D array corresponding to the picture
+        :return: background and dispersion, values or 2D arrays
+        """
+        raise NotImplementedError
+
+class HistogramFitEstimator(BackgroundEstimator):
+    """
+    Gaussian fit of the 200 bins histogram (mylib.modelling_parameters)
+    """
+    name = 'fit'
+
+    def estimate(self, pixels):
+        _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
+        return background, dispersion
+
+class IntegerHistogramEstimator(BackgroundEstimator):
+    """
+    Gaussian fit of the histogram of the integer values around the peak,
+    the fit being seeded by the median and the median absolute deviation
+    read on the cumulative histogram
+    """
+    name = 'integer'
+
+    def __init__(self, window=3.0, bins_per_sigma=4):
+        """
+        Constructor of IntegerHistogramEstimator
+        :param window: half width of the fitted region in dispersions
+        :param bins_per_sigma: number of bins in a dispersion for the fit
+        """
+        self.window = window
+        self.bins_per_sigma = bins_per_sigma
+
+    def estimate(self, pixels):
+        if not np.issubdtype(pixels.dtype, np.integer):
+            raise ValueError('integer pixels expected, got %s' % pixels.dtype)
+
+        # One bin per integer value
+        values = pixels.ravel()
+        lowest = int(values.min())
+        counts = np.bincount(values.astype(np.int64) - lowest)
+        half = counts.sum() / 2.
+
+        # Seeds: median and median absolute deviation
+        median = int(np.searchsorted(np.cumsum(counts), half))
+        distances = np.zeros(max(median + 1, len(counts) - median), dtype=np.int64)
+        distances[:len(counts) - median] += counts[median:]
+        distances[1:median + 1] += counts[median - 1::-1] if median > 0 else 0
+        seed = max(MAD_TO_SIGMA * np.searchsorted(np.cumsum(distances), half), 1.)
+
+        # Regroup the values around the peak in bins of a fraction of
+        # the dispersion, and fit them
+        width = max(1, int(seed / self.bins_per_sigma))
+        start = max(0, int(median - self.window * seed))
+        nbins = max(3, int(2 * self.window * seed / width))
+        region = np.zeros(nbins * width, dtype=np.int64)
+        kept = counts[start:start + len(region)]
+        region[:len(kept)] = kept
+        bin_values = region.reshape(nbins, width).sum(axis=1)
+        x_values = start + width * np.arange(nbins) + (width - 1) / 2.
+        fit, _ = curve_fit(mylib.modelling_function, x_values, bin_values, \
+                           p0=(bin_values.max(), median, seed))
+        return lowest + fit[1], abs(fit[2])
+
+class SigmaClipEstimator(BackgroundEstimator):
+    """
+    Median and median absolute deviation, the pixels further than
+    nsigma dispersions from the median being removed at each iteration
+    """
+    name = 'clip'
+
+    def __init__(self, nsigma=3.0, iterations=5):
+        """
+        Constructor of SigmaClipEstimator
+        :param nsigma: clipping distance in dispersions
+        :param iterations: maximum number of iterations
+        """
+        self.nsigma = nsigma
+        self.iterations = iterations
+
+    def estimate(self, pixels):
+        values = pixels.ravel().astype(np.float64)
+        for _ in range(self.iterations):
+            median = np.median(values)
+            dispersion = MAD_TO_SIGMA * np.median(np.abs(values - median))
+            kept = np.abs(values - median) <= self.nsigma * dispersion
+            if kept.all():
+                break
+            values = values[kept]
+        return median, dispersion
+
+def interpolation_weights(size, box, ncells):
+    """
+    Give the cells surrounding each pixel along one axis and the weight
+    of the upper one, for a linear interpolation between cell centers
+    :param size: number of pixels along the axis
+    :param box: size of a cell in pixels
+    :param ncells: number of cells along the axis
+    :return: lower cells, upper cells and weights of the upper cells
+    """
+    position = np.clip((np.arange(size) + 0.5) / box - 0.5, 0, ncells - 1)
+    lower = np.minimum(np.floor(position).astype(np.intp), max(ncells - 2, 0))
+    upper = np.minimum(lower + 1, ncells - 1)
+    return lower, upper, position - lower
+
+def interpolate_mesh(mesh, box, shape):
+    """
+    Interpolate linearly values given at the centers of the cells
+    of a mesh to every pixel of the picture
+    :param mesh: 2D array of values of the cells
+    :param box: size of a cell in pixels
+    :param shape: shape of the picture
+    :return: 2D float32 array of the shape of the picture
+    """
+    x_lower, x_upper, x_weights = interpolation_weights(shape[1], box, mesh.shape[1])
+    y_lower, y_upper, y_weights = interpolation_weights(shape[0], box, mesh.shape[0])
+    rows = mesh[:, x_lower] * (1 - x_weights) + mesh[:, x_upper] * x_weights
+    return (rows[y_lower] * (1 - y_weights)[:, np.newaxis] + \
+            rows[y_upper] * y_weights[:, np.newaxis]).astype(np.float32)
+
+class MeshBackgroundEstimator(BackgroundEstimator):
+    """
+    Local background and dispersion: sigma clipped median and MAD in each
+    cell of a mesh, smoothed by a median filter over the cells,
+    and interpolated to every pixel
+    """
+    name = 'mesh'
+
+    def __init__(self, box=64, filter_size=3, nsigma=3.0, iterations=5):
+        """
+        Constructor of MeshBackgroundEstimator
+        :param box: size of a cell in pixels
+        :param filter_size: size of the median filter in cells
+        :param nsigma: clipping distance in dispersions
+        :param iterations: number of clipping iterations
+        """
+        self.box = box
+        self.filter_size = filter_size
+        self.nsigma = nsigma
+        self.iterations = iterations
+
+    def cell_statistics(self, pixels):
+        """
+        Sigma clipped median and dispersion of each cell
+        :return: two 2D arrays of the size of the mesh
+        """
+        box = self.box
+        n_row = -(-pixels.shape[0] // box)
+        n_column = -(-pixels.shape[1] // box)
+
+        # Cut the picture in cells, the incomplete ones being padded with NaN
+        padded = np.full((n_row * box, n_column * box), np.nan, dtype=np.float32)
+        padded[:pixels.shape[0], :pixels.shape[1]] = pixels
+        cells = padded.reshape(n_row, box, n_column, box).swapaxes(1, 2) \
+                      .reshape(n_row, n_column, box * box)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # empty cells
+            for _ in range(self.iterations):
+                median = np.nanmedian(cells, axis=2)
+                distance = np.abs(cells - median[:, :, np.newaxis])
+                dispersion = MAD_TO_SIGMA * np.nanmedian(distance, axis=2)
+                with np.errstate(invalid='ignore'):
+                    clipped = distance > self.nsigma * dispersion[:, :, np.newaxis]
+                cells = np.where(clipped, np.nan, cells)
+
+        # Cells without valid pixels get the values of the whole picture
+        for values in (median, dispersion):
+            invalid = ~np.isfinite(values)
+            if invalid.all():
+                values[:] = 0.
+            elif invalid.any():
+                values[invalid] = np.median(values[~invalid])
+        return median, dispersion
+
+    def estimate(self, pixels):
+        median, dispersion = self.cell_statistics(pixels)
+        if self.filter_size > 1:
+            median = ndimage.median_filter(median, self.filter_size, mode='nearest')
+            dispersion = ndimage.median_filter(dispersion, self.filter_size, mode='nearest')
+        return interpolate_mesh(median, self.box, pixels.shape), \
+               interpolate_mesh(dispersion, self.box, pixels.shape)
+
+ESTIMATORS = {estimator.name: estimator for estimator in \
+              (HistogramFitEstimator, IntegerHistogramEstimator, \
+               SigmaClipEstimator, MeshBackgroundEstimator)}
+
+def get_estimator(name, **parameters):
+    """
+    Build a background estimator from its name
+    :param name: 'fit', 'integer', 'clip' or 'mesh'
+    :param parameters: parameters of the constructor
+    :return: instance of BackgroundEstimator
+    """
+    return ESTIMATORS[name](**parameters)
+
+def time_estimators(pixels, estimators=None, repeat=3):
+    """
+    Time the background estimators on a picture
+    :param pixels: 2D array corresponding to the picture
+    :param estimators: list of estimators (default: one of each)
+    :param repeat: number of runs, the fastest one being kept
+    :return: list of (name, seconds, mean background, mean dispersion)
+    """
+    if estimators is None:
+        estimators = [get_estimator(name) for name in ('fit', 'integer', 'clip', 'mesh')]
+    timings = []
+    for estimator in estimators:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            background, dispersion = estimator.estimate(pixels)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append((estimator.name, best, np.mean(background), np.mean(dispersion)))
+    return timings
+
+def main():
+    """
+    Time the background estimators on a fits file
+    """
+    parser = argparse.ArgumentParser(description='Time the background estimators')
+    parser.add_argument('path', nargs='?', default='../data/specific.fits', \
+                        help='fits file (default: ../data/specific.fits)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs')
+    args = parser.parse_args()
+
+    pixels, _ = mylib.get_pixels(args.path)
+    if pixels is None:
+        return 1
+    print '%-8s %12s %12s %12s' % ('method', 'time (ms)', 'background', 'dispersion')
+    for name, seconds, background, dispersion in \
+            time_estimators(pixels, repeat=args.repeat):
+        print '%-8s %12.2f %12.1f %12.1f' % (name, 1e3 * seconds, background, dispersion)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batch:
+Module which runs the detection of clusters over many fits files
+(directories or glob patterns) with a pool of processes,
+and writes one merged catalog. Small pictures of the same shape
+can be processed by stacks (see the module stack)
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import traceback
+from background import ESTIMATORS, get_estimator
+import catalog
+import library
+import metrics
+import mylib
+import stack
+import streaming
+
+def find_fits_files(inputs):
+    """
+    Find the fits files given by directories, glob patterns or paths
+    :param inputs: list of directories, patterns or paths
+    :return: sorted list of paths without duplicates
+    """
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.fits')
+        paths.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    return sorted(paths)
+
+def process_file(task):
+    """
+    Run the detection on one file, errors being reported instead of raised
+    so that a bad file does not stop the batch
+    :param task: tuple (path, options) where options is a dictionary
+    :return: tuple (path, catalog.Catalog or None, error message or None,
+             dictionary of the measures of the run, see metrics.Stats)
+    """
+    path, options = task
+    with metrics.collect(path) as stats:
+        clusters, error = detect_file(path, options)
+    return path, clusters, error, stats.as_dict()
+
+def detect_file(path, options):
+    """
+    Run the detection on one file
+    :return: tuple (catalog.Catalog or None, error message or None)
+    """
+    try:
+        if options['strip_rows']:
+            with mylib.open_image(path) as image:
+                _, _, _, background, dispersion = \
+                    streaming.strip_modelling_parameters(image, options['strip_rows'])
+                threshold = background + options['nsigma'] * dispersion
+                clusters = streaming.strip_catalog(image, background, dispersion, \
+                                                   threshold, options['strip_rows'])
+                header, shape = image.header, image.shape
+        else:
+            pixels, header = mylib.get_pixels(path)
+            if pixels is None:
+                raise IOError('cannot open %s' % path)
+            background, dispersion = \
+                get_estimator(options['background']).estimate(pixels)
+            threshold = background + options['nsigma'] * dispersion
+            clusters = mylib.get_cluster_array(pixels, background, dispersion, threshold)
+            shape = pixels.shape
+
+        add_coordinates(clusters, header, shape, options)
+        return clusters, None
+    # pylint: disable=broad-except
+    except Exception:
+        return None, traceback.format_exc().strip().split('\n')[-1]
+
+def add_coordinates(clusters, header, shape, options):
+    """
+    Compute the celestial coordinates and the names of the clusters, if asked
+    :param clusters: catalog.Catalog of the clusters of a picture
+    :param header: header of the picture
+    :param shape: shape of the picture
+    :param options: dictionary of options given to process_file
+    """
+    if options['wcs'] or options['names']:
+        my_wcs = library.WCS(header)
+        if len(clusters) != 0:
+            clusters['ra'], clusters['dec'] = \
+                my_wcs.convert_many(clusters['x'], clusters['y'])
+        if options['names']:
+            mylib.find_star_names(clusters, my_wcs, shape)
+
+def group_stacks(paths, stack_size):
+    """
+    Cut the list of files into stacks of consecutive pictures of the same shape
+    :param paths: list of paths of fits files
+    :param stack_size: largest number of pictures of a stack
+    :return: list of lists of paths
+    """
+    stacks, last_shape = [], None
+    for path in paths:
+        try:
+            with mylib.open_image(path) as image:
+                shape = image.shape
+        except (IOError, ValueError):
+            shape = None # reported when the file is processed
+        if shape is None or shape != last_shape or len(stacks[-1]) == stack_size:
+            stacks.append([])
+        stacks[-1].append(path)
+        last_shape = shape
+    return stacks
+
+def process_stack(task):
+    """
+    Run the detection on a stack of pictures of the same shape at once,
+    the files being processed one by one if the stack fails
+    :param task: tuple (paths, options) where options is a dictionary
+    :return: list of the results of the files, see process_file
+             (the measures of the stack are given with its first file,
+             the counter stack_fallbacks telling that the stack failed)
+    """
+    paths, options = task
+    with metrics.collect(paths[0]) as stats:
+        try:
+            clusters, headers = stack.find_stack_clusters(paths, options['nsigma'])
+            with mylib.open_image(paths[0]) as image:
+                shape = image.shape
+        # pylint: disable=broad-except
+        except Exception:
+            clusters = None
+            metrics.count('stack_fallbacks')
+    if clusters is None:
+        results = [process_file((path, options)) for path in paths]
+        path, frame_clusters, error, file_stats = results[0]
+        stats.merge(file_stats)
+        results[0] = (path, frame_clusters, error, stats.as_dict())
+        return results
+
+    results = []
+    for frame, (path, header) in enumerate(zip(paths, headers)):
+        frame_clusters = clusters.filter(clusters['frame'] == frame)
+        frame_clusters['frame'] = 0
+        try:
+            add_coordinates(frame_clusters, header, shape, options)
+            error = None
+        # pylint: disable=broad-except
+        except Exception:
+            frame_clusters, error = None, traceback.format_exc().strip().split('\n')[-1]
+        results.append((path, frame_clusters, error, \
+                        (stats if frame == 0 else metrics.Stats(path)).as_dict()))
+    return results
+
+def run_batch(paths, options, jobs=None, ordered=True, stack_size=0):
+    """
+    Process the files with a pool of processes
+    :param paths: list of paths of fits files
+    :param options: dictionary of options given to process_file
+    :param jobs: number of processes (default: number of cores)
+    :param ordered: if True, results come in the order of paths,
+                    else as soon as they are ready
+    :param stack_size: if not 0, process the pictures by stacks
+                       of at most this many pictures of the same shape
+    :return: iterator over the results of process_file
+    """
+    if stack_size:
+        function, tasks = process_stack, [(paths, options) for paths \
+                                          in group_stacks(paths, stack_size)]
+    else:
+        function, tasks = process_file, [(path, options) for path in paths]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.imap(function, tasks) if ordered \
+                  else pool.imap_unordered(function, tasks)
+        for result in results:
+            for file_result in (result if stack_size else [result]):
+                yield file_result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main():
+    """
+    Parse the command line, process the files and write the merged catalog
+    """
+    parser = argparse.ArgumentParser(description='Find clusters in many fits files')
+    parser.add_argument('inputs', nargs='+', help='directories, glob patterns or files')
+    parser.add_argument('-o', '--output', default='catalog.txt', \
+                        help='merged catalog, .npy (written as the files come), ' \
+                             '.npz, .fits or text (default: catalog.txt)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, \
+                        help='number of processes (default: number of cores)')
+    parser.add_argument('--unordered', action='store_true', \
+                        help='report the files as soon as they are done')
+    parser.add_argument('--nsigma', type=float, default=6.0, \
+                        help='threshold in dispersions above the background')
+    parser.add_argument('--background', choices=sorted(ESTIMATORS), default='fit', \
+                        help='background estimator (default: fit)')
+    parser.add_argument('--strip-rows', type=int, default=0, \
+                        help='process the pictures by strips of this many rows ' \
+                             '(the background is then always fitted)')
+    parser.add_argument('--stack', type=int, default=0, \
+                        help='process the pictures of the same shape by stacks ' \
+                             'of this many pictures (the background is then always fitted)')
+    parser.add_argument('--wcs', action='store_true', \
+                        help='compute the celestial coordinates of the clusters')
+    parser.add_argument('--names', action='store_true', \
+                        help='find the star names (one Simbad request per file)')
+    parser.add_argument('--reference', default=None, \
+                        help='find the star names in this reference catalog ' \
+                             'instead of Simbad (see refcatalog.py)')
+    parser.add_argument('--name-length', type=int, default=catalog.NAME_LENGTH, \
+                        help='bytes of the names in a .npy output streamed as the ' \
+                             'files come, the longer ones are cut (default: %d)' % \
+                             catalog.NAME_LENGTH)
+    parser.add_argument('--stats', action='store_true', \
+                        help='print the time spent in each stage')
+    parser.add_argument('--metrics-log', default=None, \
+                        help='append the measures of each file to this JSON lines file')
+    args = parser.parse_args()
+
+    paths = find_fits_files(args.inputs)
+    if not paths:
+        print 'no fits file found'
+        return 1
+    if args.reference is not None:
+        library.use_reference(args.reference) # loaded once, shared by the workers
+    options = {'nsigma': args.nsigma, 'strip_rows': args.strip_rows, \
+               'background': args.background, \
+               'wcs': args.wcs, 'names': args.names}
+
+    # Stream the results as they come, appending them to a .npy
+    # catalog or keeping the catalogs to merge
+    catalogs, names, failures = [], [], 0
+    total = metrics.Stats('batch')
+    writer = catalog.NpyWriter(args.output, args.name_length) \
+             if args.output.lower().endswith('.npy') else None
+    try:
+        for path, clusters, error, stats in run_batch(paths, options, args.jobs, \
+                                                      ordered=not args.unordered, \
+                                                      stack_size=args.stack):
+            total.merge(stats)
+            if args.metrics_log is not None:
+                metrics.write_log(stats, args.metrics_log)
+            if error is not None:
+                print '%s: ERROR %s' % (path, error)
+                failures += 1
+                continue
+            print '%s: %d clusters' % (path, len(clusters))
+            if writer is not None:
+                writer.append(clusters, frame_name=path)
+            else:
+                catalogs.append(clusters)
+                names.append(path)
+    finally:
+        if writer is not None:
+            writer.close() # the rows written so far stay readable
+
+    if writer is None:
+        catalog.write_catalog(catalog.concatenate(catalogs), args.output, names)
+    elif writer.truncated:
+        print '%d names cut to %d bytes (see --name-length)' % (writer.truncated, args.name_length)
+    print '%d files, %d failed, catalog written to %s' % \
+          (len(paths), failures, args.output)
+    if args.stats:
+        print total.summary()
+
+    return 0 if failures == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main())
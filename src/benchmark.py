@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark:
+Module which times the stages of the detection on synthetic fields
+of several sizes, measures the memory used by each stage and the
+recovery of the generated stars, and writes the results in a JSON file so that
+versions can be compared
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import scipy
+# pylint: disable=E
+from scipy.spatial import cKDTree
+import catalog
+import library
+import metrics
+import mylib
+import synthetic
+
+def timed(function, repeat):
+    """
+    Run a function several times
+    :return: result of the last run and fastest time in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def recovery(cluster_array, stars, radius=1.5):
+    """
+    Compare the clusters with the generated stars
+    :param cluster_array: catalog.Catalog of the clusters
+    :param stars: stars of the field (see synthetic.make_stars)
+    :param radius: largest distance between a star and its cluster, in pixels
+    :return: dictionary with the number of stars, of clusters,
+             of stars found and of clusters matching no star
+    """
+    result = {'stars': len(stars), 'clusters': len(cluster_array)}
+    if len(cluster_array) == 0 or len(stars) == 0:
+        result.update(found=0, spurious=len(cluster_array))
+        return result
+    tree = cKDTree(np.column_stack((stars['x'], stars['y'])))
+    distances, nearest = tree.query( \
+        np.column_stack((cluster_array['xcen'], cluster_array['ycen'])), \
+        distance_upper_bound=radius)
+    matched = np.isfinite(distances)
+    result['found'] = len(np.unique(nearest[matched]))
+    result['spurious'] = int(np.count_nonzero(~matched))
+    return result
+
+def generate_field(task):
+    """
+    Write the synthetic field of a size, in a process of its own so
+    that its memory is not counted in the measures of the stages
+    :param task: tuple (size, options, directory)
+    :return: path of the fits file and time taken in seconds
+    """
+    size, options, directory = task
+    path = os.path.join(directory, 'field_%d.fits' % size)
+    start = time.time()
+    synthetic.write_field(path, (size, size), options['density'], \
+                          noise=options['noise'], seed=options['seed'])
+    return path, time.time() - start
+
+def bench_size(task):
+    """
+    Time every stage on a field already written, in a fresh process
+    so that the memory measured is the one of the stages only
+    :param task: tuple (size, options, path) where options is a dictionary
+    :return: dictionary of the results
+    """
+    size, options, path = task
+    directory = os.path.dirname(path)
+    repeat = options['repeat']
+    result = {'size': size, 'pixels': size * size}
+    stages = []
+
+    def stage(name, function):
+        """
+        Time a stage and record the peak memory during its runs and
+        its increase over the memory used before the stage
+        """
+        metrics.reset_peak_memory()
+        resident = metrics.resident_memory()
+        value, seconds = timed(function, repeat)
+        peak = metrics.peak_memory()
+        stages.append({'stage': name, 'seconds': seconds, \
+                       'pixels_per_second': size * size / seconds if seconds > 0 else None, \
+                       'peak_memory': peak, 'memory_delta': max(peak - resident, 0)})
+        return value
+
+    pixels, header = stage('get_pixels', lambda: mylib.get_pixels(path))
+    stage('read', lambda: np.asarray(pixels).sum()) # the file is memory mapped
+    _, _, _, background, dispersion = \
+        stage('modelling_parameters', lambda: mylib.modelling_parameters(pixels))
+    stage('remove_background', \
+          lambda: mylib.remove_background(pixels, background, dispersion))
+    cluster_array = stage('get_cluster_array', \
+        lambda: mylib.get_cluster_array(pixels, background, dispersion))
+    my_wcs = library.WCS(header)
+    stage('wcs', lambda: my_wcs.convert_many(cluster_array['x'], cluster_array['y']))
+    stage('write_text', lambda: catalog.write_text(cluster_array, \
+                                                   os.path.join(directory, 'catalog.txt')))
+    stage('write_npy', lambda: catalog.write_npy(cluster_array, \
+                                                 os.path.join(directory, 'catalog.npy')))
+
+    result['stages'] = stages
+    result['peak_memory'] = max(stage_result['peak_memory'] for stage_result in stages)
+    result['background'] = float(background)
+    result['dispersion'] = float(dispersion)
+    result['recovery'] = recovery(cluster_array, synthetic.read_truth(path))
+    return result
+
+def in_process(function, task):
+    """
+    Run a function in a new process
+    :return: result of the function
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(function, (task,))
+    finally:
+        pool.terminate()
+        pool.join()
+
+def environment():
+    """
+    Describe the code and the machine the results come from
+    """
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], \
+                                           stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision': revision, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), \
+            'python': platform.python_version(), 'numpy': np.__version__, \
+            'scipy': scipy.__version__, 'machine': platform.platform(), \
+            'cpus': multiprocessing.cpu_count()}
+
+def run_benchmark(sizes, options):
+    """
+    Benchmark every size: the field is generated in a process,
+    then its stages are measured in another one
+    :param sizes: list of numbers of rows (and columns) of the fields
+    :param options: dictionary of options given to bench_size
+    :return: list of the results of bench_size
+    """
+    results = []
+    for size in sizes:
+        directory = tempfile.mkdtemp(dir=options['directory'])
+        try:
+            path, seconds = in_process(generate_field, (size, options, directory))
+            result = in_process(bench_size, (size, options, path))
+            result['generation_seconds'] = seconds
+            results.append(result)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def main():
+    """
+    Run the benchmark and write the results
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the detection stages')
+    parser.add_argument('sizes', type=int, nargs='*', default=[106, 512, 2048, 4096], \
+                        help='sizes of the fields (default: 106 512 2048 4096, ' \
+                             'up to 16384 for the full suite)')
+    parser.add_argument('-o', '--output', default='benchmark.json', \
+                        help='JSON results (default: benchmark.json)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of a stage')
+    parser.add_argument('--density', type=float, default=1e-3, help='stars per pixel')
+    parser.add_argument('--noise', type=float, default=10., help='background dispersion')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--directory', default=None, \
+                        help='directory of the generated fields (default: temporary)')
+    args = parser.parse_args()
+
+    options = {'repeat': args.repeat, 'density': args.density, 'noise': args.noise, \
+               'seed': args.seed, 'directory': args.directory}
+    results = run_benchmark(args.sizes, options)
+
+    print '%6s %-22s %10s %14s %12s %12s' % ('size', 'stage', 'time (ms)', 'Mpixels/s', \
+                                             'peak (MB)', 'delta (MB)')
+    for result in results:
+        for stage in result['stages']:
+            print '%6d %-22s %10.2f %14.1f %12.1f %12.1f' % \
+                  (result['size'], stage['stage'], 1e3 * stage['seconds'], \
+                   (stage['pixels_per_second'] or 0) / 1e6, stage['peak_memory'] / 2.**20, \
+                   stage['memory_delta'] / 2.**20)
+        print '%6d %d/%d stars found, %d spurious clusters' % \
+              (result['size'], result['recovery']['found'], result['recovery']['stars'], \
+               result['recovery']['spurious'])
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'environment': environment(), 'results': results}, \
+                  output_file, indent=2, sort_keys=True)
+    print 'results written to %s' % (args.output)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
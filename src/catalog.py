@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the class Catalog, a columnar list of clusters
+stored in a structured numpy array, and CatalogRow, a view on one
+of its rows which behaves like a cluster.Cluster.
+Catalogs are written as text tables or in binary files which are
+read back without parsing:
+- .npy: one record per cluster, appended as the clusters come
+  (NpyWriter) and memory mapped when read, the names of the frames
+  being written next to it in a .frames.txt file
+- .npz: one array per column, each optionally compressed
+- .fits: binary table
+"""
+
+import io
+import os
+import warnings
+import zipfile
+import numpy as np
+
+# Columns of a catalog, one row per cluster
+CATALOG_DTYPE = np.dtype([('frame', np.int32), \
+                          ('label', np.int32), \
+                          ('npix', np.int32), \
+                          ('luminosity', np.float64), \
+                          ('xmin', np.int32), ('xmax', np.int32), \
+                          ('ymin', np.int32), ('ymax', np.int32), \
+                          ('x', np.float64), ('y', np.float64), \
+                          ('flux', np.float64), \
+                          ('xcen', np.float64), ('ycen', np.float64), \
+                          ('x2', np.float64), ('y2', np.float64), ('xy', np.float64), \
+                          ('size', np.float64), ('ellipticity', np.float64), \
+                          ('theta', np.float64), \
+                          ('peak', np.float64), \
+                          ('xpeak', np.int32), ('ypeak', np.int32), \
+                          ('ra', np.float64), ('dec', np.float64), \
+                          ('name', object)])
+
+NAME_LENGTH = 32 # bytes of the names in the binary files
+
+def from_statistics(stats):
+    """
+    Build a catalog from the statistics given by mylib.label_clusters
+    :param stats: dictionary of 1D arrays indexed by label - 1
+    :return: instance of Catalog
+    """
+    data = np.zeros(len(stats['npix']), dtype=CATALOG_DTYPE)
+    data['label'] = np.arange(1, len(data) + 1)
+    for column in ('npix', 'luminosity', 'xmin', 'xmax', 'ymin', 'ymax', \
+                   'flux', 'xcen', 'ycen', 'x2', 'y2', 'xy', \
+                   'size', 'ellipticity', 'theta', 'peak', 'xpeak', 'ypeak'):
+        data[column] = stats[column]
+
+    # The centroid is the center of the bounding box
+    data['x'] = (data['xmin'] + data['xmax']) / 2.
+    data['y'] = (data['ymin'] + data['ymax']) / 2.
+    data['ra'] = np.nan
+    data['dec'] = np.nan
+    data['name'] = ""
+    return Catalog(data)
+
+def concatenate(catalogs):
+    """
+    Merge catalogs, the frame column of each row being set
+    to the index of its catalog in the list
+    :param catalogs: list of instances of Catalog
+    :return: instance of Catalog
+    """
+    if not catalogs:
+        return Catalog()
+    data = np.concatenate([cat.data for cat in catalogs])
+    data['frame'] = np.repeat(np.arange(len(catalogs)), [len(cat) for cat in catalogs])
+    return Catalog(data)
+
+def write_text(cat, path, frame_names=None):
+    """
+    Write a catalog as a text table, one row per cluster,
+    the columns being separated by tabulations
+    :param cat: instance of Catalog
+    :param path: path of the output file
+    :param frame_names: names of the frames (e.g. their file names)
+    """
+    formats = {'i': '%d', 'f': '%.10g', 'O': '%s', 'S': '%s'}
+    with open(path, 'w') as output_file:
+        for frame, name in enumerate(frame_names or []):
+            output_file.write('# frame %d: %s\n' % (frame, name))
+        output_file.write('# ' + '\t'.join(cat.columns()) + '\n')
+        if len(cat) != 0:
+            np.savetxt(output_file, cat.data, delimiter='\t', \
+                       fmt=[formats[cat.data.dtype[column].kind] \
+                            for column in cat.columns()])
+
+def binary_dtype(dtype=CATALOG_DTYPE, name_length=NAME_LENGTH):
+    """
+    Return the dtype of the binary files: the names, python objects
+    in memory, are stored as fixed length strings
+    :param dtype: dtype of the catalog
+    :param name_length: number of bytes of the names, the longer ones are cut
+    :return: numpy dtype
+    """
+    return np.dtype([(column, 'S%d' % name_length if dtype[column].kind == 'O' \
+                      else dtype[column]) for column in dtype.names])
+
+def to_binary(cat, name_length=None):
+    """
+    Convert the rows of a catalog to the dtype of the binary files
+    :param cat: instance of Catalog
+    :param name_length: number of bytes of the names
+                        (default: the longest name, at least 1)
+    :return: structured array without python objects
+    """
+    if name_length is None:
+        name_length = max([1] + [len(name) for name in cat.data['name']])
+    return cat.data.astype(binary_dtype(cat.data.dtype, name_length))
+
+def write_npy(cat, path, name_length=None):
+    """
+    Write a catalog in a .npy file, which np.load can memory map
+    :param cat: instance of Catalog
+    :param path: path of the output file
+    :param name_length: number of bytes of the names (default: the longest name)
+    """
+    np.save(path, to_binary(cat, name_length))
+
+def frames_path(path):
+    """
+    Return the path of the file of the frame names of a .npy catalog
+    """
+    return os.path.splitext(path)[0] + '.frames.txt'
+
+def write_frames(frame_names, path):
+    """
+    Write the names of the frames of a .npy catalog in its .frames.txt
+    file, one frame per line: its number and its name separated by a tabulation
+    :param frame_names: names of the frames (e.g. their file names)
+    :param path: path of the .npy catalog
+    """
+    with open(frames_path(path), 'w') as output_file:
+        output_file.write('# frame\tname\n')
+        for frame, name in enumerate(frame_names):
+            output_file.write('%d\t%s\n' % (frame, name))
+
+def read_frames(path):
+    """
+    Read the names of the frames of a .npy catalog
+    :param path: path of the .npy catalog
+    :return: list of names, empty if there is no .frames.txt file
+    """
+    if not os.path.exists(frames_path(path)):
+        return []
+    with open(frames_path(path)) as input_file:
+        return [line.rstrip('\n').split('\t', 1)[1] for line in input_file \
+                if not line.startswith('#')]
+
+def read_npy(path, mmap_mode='r'):
+    """
+    Read a catalog written in a .npy file
+    :param path: path of the file
+    :param mmap_mode: mode of np.load ('r': read only memory map,
+                      'c': copy on write, None: read in memory)
+    :return: instance of Catalog, whose names are strings of fixed length
+    """
+    return Catalog(np.load(path, mmap_mode=mmap_mode))
+
+class NpyWriter(object):
+    """
+    Class which writes a .npy catalog as its rows come: the header
+    is written first with room for any number of rows, every append
+    writes its rows at the end of the file and close writes the
+    final number of rows in the header (and the names of the frames
+    in the .frames.txt file). The names longer than name_length are
+    cut, which close reports with a warning.
+    """
+
+    def __init__(self, path, name_length=NAME_LENGTH):
+        """
+        Constructor of NpyWriter
+        :param path: path of the output file
+        :param name_length: number of bytes of the names, the longer ones are cut
+        """
+        self.path = path
+        self.name_length = name_length
+        self.dtype = binary_dtype(name_length=name_length)
+        self.rows = 0
+        self.truncated = 0 # number of names cut
+        self.frame_names = []
+        self.output_file = open(path, 'wb')
+        self.output_file.write(self.header(0))
+
+    def header(self, rows):
+        """
+        Return the header of a .npy file (version 1.0) of rows records,
+        always padded to the length of the one of 10**18 records
+        """
+        def description(count):
+            """
+            Dictionary of the header as written in the file
+            """
+            return repr({'descr': np.lib.format.dtype_to_descr(self.dtype), \
+                         'fortran_order': False, 'shape': (count,)})
+        # 10 bytes of magic string and size, then the description ending with a newline
+        length = 16 * ((10 + len(description(10**18)) + 1) // 16 + 1) - 10
+        text = description(rows).ljust(length - 1) + '\n'
+        return np.lib.format.magic(1, 0) + np.array(length, dtype='<u2').tobytes() + text
+
+    def append(self, cat, frame=None, frame_name=None):
+        """
+        Write the rows of a catalog at the end of the file
+        :param cat: instance of Catalog
+        :param frame: value of the frame column of the rows (default: unchanged)
+        :param frame_name: name of a new frame (e.g. a file name), the
+                           frame column being set to its number
+        """
+        self.truncated += sum(1 for name in cat.data['name'] \
+                              if name is not None and len(name) > self.name_length)
+        data = cat.data.astype(self.dtype)
+        if frame_name is not None:
+            frame = len(self.frame_names)
+            self.frame_names.append(frame_name)
+        if frame is not None:
+            data['frame'] = frame
+        data.tofile(self.output_file)
+        self.rows += len(data)
+
+    def close(self):
+        """
+        Write the number of rows in the header and close the file
+        """
+        if self.output_file.closed:
+            return
+        self.output_file.seek(0)
+        self.output_file.write(self.header(self.rows))
+        self.output_file.close()
+        if self.frame_names:
+            write_frames(self.frame_names, self.path)
+        if self.truncated:
+            warnings.warn('%s: %d names cut to %d bytes' % \
+                          (self.path, self.truncated, self.name_length))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def write_npz(cat, path, frame_names=None, compress=True):
+    """
+    Write a catalog in a .npz file, one array per column
+    :param cat: instance of Catalog
+    :param path: path of the output file
+    :param frame_names: names of the frames (e.g. their file names)
+    :param compress: True to compress every column, False for none,
+                     or the list of the columns to compress
+    """
+    if compress is True or compress is False:
+        compress = cat.columns() if compress else ()
+    data = to_binary(cat)
+    arrays = [(column, data[column]) for column in data.dtype.names]
+    arrays.append(('frame_names', np.array(frame_names or [], dtype=str)))
+    with zipfile.ZipFile(path, 'w', allowZip64=True) as archive:
+        for name, array in arrays:
+            buffer_file = io.BytesIO()
+            np.lib.format.write_array(buffer_file, np.ascontiguousarray(array))
+            archive.writestr(zipfile.ZipInfo(name + '.npy'), buffer_file.getvalue(), \
+                             zipfile.ZIP_DEFLATED if name in compress \
+                             else zipfile.ZIP_STORED)
+
+def read_npz(path, columns=None):
+    """
+    Read a catalog written in a .npz file, only the asked columns
+    being decompressed
+    :param path: path of the file
+    :param columns: names of the columns to read (default: all)
+    :return: tuple (instance of Catalog, list of the frame names)
+    """
+    with np.load(path) as archive:
+        stored = [name for name in archive.files if name != 'frame_names']
+        columns = [column for column in CATALOG_DTYPE.names \
+                   if column in stored and (columns is None or column in columns)]
+        arrays = [archive[column] for column in columns]
+        frame_names = list(archive['frame_names'])
+    data = np.zeros(len(arrays[0]) if arrays else 0, \
+                    dtype=[(column, array.dtype) for column, array in zip(columns, arrays)])
+    for column, array in zip(columns, arrays):
+        data[column] = array
+    return Catalog(data), frame_names
+
+def write_fits(cat, path, frame_names=None):
+    """
+    Write a catalog as a fits binary table, the frame names
+    being kept in the FRAMEn keywords of its header
+    :param cat: instance of Catalog
+    :param path: path of the output file
+    :param frame_names: names of the frames (e.g. their file names)
+    """
+    from astropy.io import fits # pylint: disable=E
+    table = fits.BinTableHDU(to_binary(cat), name='CATALOG')
+    for frame, name in enumerate(frame_names or []):
+        table.header['FRAME%d' % frame] = name
+    table.writeto(path, overwrite=True)
+
+def read_fits(path, memmap=True):
+    """
+    Read a catalog written as a fits binary table
+    :param path: path of the file
+    :param memmap: True to memory map the table
+    :return: tuple (instance of Catalog, list of the frame names)
+    """
+    from astropy.io import fits # pylint: disable=E
+    with fits.open(path, memmap=memmap) as hdulist:
+        header = hdulist['CATALOG'].header
+        frame_names = []
+        while 'FRAME%d' % len(frame_names) in header:
+            frame_names.append(header['FRAME%d' % len(frame_names)])
+        # The raw records, big endian, stay mapped after the file is closed
+        data = np.asarray(hdulist['CATALOG'].data)
+        if not memmap:
+            data = data.copy()
+    return Catalog(data), frame_names
+
+def write_catalog(cat, path, frame_names=None):
+    """
+    Write a catalog in the format given by the extension of path:
+    .npy, .npz, .fits or .fit, and text for any other
+    :param cat: instance of Catalog
+    :param path: path of the output file
+    :param frame_names: names of the frames (in a .frames.txt file for .npy)
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        write_npy(cat, path)
+        if frame_names:
+            write_frames(frame_names, path)
+    elif extension == '.npz':
+        write_npz(cat, path, frame_names)
+    elif extension in ('.fits', '.fit'):
+        write_fits(cat, path, frame_names)
+    else:
+        write_text(cat, path, frame_names)
+
+class Catalog(object):
+    """
+    Class which contains the clusters of a picture as columns:
+    - catalog['x'] is the array of a column
+    - catalog[mask], catalog[indices] or catalog[start:stop] is a catalog
+    - catalog[i] and the iteration give views behaving like clusters
+    """
+
+    def __init__(self, data=None):
+        """
+        Constructor of Catalog
+        :param data: structured array of dtype CATALOG_DTYPE
+        """
+        if data is None:
+            data = np.zeros(0, dtype=CATALOG_DTYPE)
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for index in xrange(len(self.data)):
+            yield CatalogRow(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self.data[key]
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self.data)
+            if not 0 <= key < len(self.data):
+                raise IndexError('catalog index out of range')
+            return CatalogRow(self, key)
+        return Catalog(self.data[key])
+
+    def __setitem__(self, column, values):
+        self.data[column] = values
+
+    def columns(self):
+        """
+        Return the names of the columns
+        """
+        return self.data.dtype.names
+
+    def filter(self, mask):
+        """
+        Return the catalog of the rows where mask is True
+        """
+        return Catalog(self.data[np.asarray(mask, dtype=bool)])
+
+    def sort(self, column, reverse=False):
+        """
+        Return the catalog sorted according to a column
+        """
+        order = np.argsort(self.data[column], kind='mergesort')
+        if reverse:
+            order = order[::-1]
+        return Catalog(self.data[order])
+
+    def brightest(self):
+        """
+        Return the row with the highest luminosity
+        """
+        return self[int(np.argmax(self.data['luminosity']))]
+
+class CatalogRow(object):
+    """
+    Class which gives access to one row of a catalog
+    with the attributes of a cluster.Cluster
+    """
+    __slots__ = ('catalog', 'index')
+
+    def __init__(self, catalog, index):
+        """
+        Constructor of CatalogRow
+        :param catalog: instance of Catalog
+        :param index: index of the row
+        """
+        self.catalog = catalog
+        self.index = index
+
+    def __getitem__(self, column):
+        return self.catalog.data[column][self.index]
+
+    @property
+    def integrated_luminosity(self):
+        """
+        Integrated luminosity of the cluster
+        """
+        return self['luminosity']
+
+    @property
+    def centroid_pixel(self):
+        """
+        Coordinates (x, y) of the centroid in pixels
+        """
+        return (self['x'], self['y'])
+
+    @property
+    def centroid_flux(self):
+        """
+        Coordinates (x, y) of the flux-weighted centroid in pixels
+        """
+        return (self['xcen'], self['ycen'])
+
+    @property
+    def centroid_wcs(self):
+        """
+        Celestial coordinates (ra, dec) of the centroid, None if unknown
+        """
+        if np.isnan(self['ra']):
+            return None
+        return (self['ra'], self['dec'])
+
+    @property
+    def bounding_box(self):
+        """
+        Bounding box ([xmin, ymin], width, height) in pixels
+        """
+        xmin, xmax, ymin, ymax = self['xmin'], self['xmax'], self['ymin'], self['ymax']
+        return ([xmin-0.5, ymin-0.5], xmax-xmin+1, ymax-ymin+1)
+
+    @property
+    def star_name(self):
+        """
+        Name of the celestial object
+        """
+        return self['name']
+
+    @star_name.setter
+    def star_name(self, name):
+        self.catalog.data['name'][self.index] = name
+
+    def is_in_bounding(self, x_position, y_position):
+        """
+        Return True if (x_position, y_position) is contained
+        in the bounding box else False
+        """
+        x_position = int(x_position)
+        y_position = int(y_position)
+        return self['xmin'] - 0.5 <= x_position <= self['xmax'] + 0.5 and \
+               self['ymin'] - 0.5 <= y_position <= self['ymax'] + 0.5
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script checks that the clusters given by the component tree
+(see componenttree) at several thresholds are the ones found by
+labelling the picture again at each of them (see mylib.label_clusters)
+"""
+
+import argparse
+import sys
+import numpy as np
+import catalog
+import componenttree
+import mylib
+import synthetic
+
+PICTURES = ['../data/common.fits', '../data/specific.fits']
+NSIGMAS = [3., 4.5, 6., 10., 50.]
+
+def check(name, condition):
+    """
+    Print the result of a check
+    :param name: description of the check
+    :param condition: True if the check passed
+    :return: condition
+    """
+    print '%s: %s' % (name, 'ok' if condition else 'NOT OK')
+    return condition
+
+def same_catalogs(tree_catalog, labelled):
+    """
+    Compare two catalogs column by column, in the order of their clusters
+    :param tree_catalog: catalog.Catalog given by ComponentTree.catalog
+    :param labelled: catalog.Catalog built from mylib.label_clusters
+    :return: True if they have the same clusters
+    """
+    if len(tree_catalog) != len(labelled):
+        return False
+    for name in catalog.CATALOG_DTYPE.names:
+        if name == 'name':
+            continue
+        if not np.allclose(tree_catalog[name], labelled[name], rtol=1e-9, atol=1e-6, \
+                           equal_nan=True):
+            return False
+    return True
+
+def check_picture(name, pixels, background, thresholds):
+    """
+    Compare the tree of a picture with the labelling at every threshold
+    :param name: name of the picture in the messages
+    :param pixels: 2D array corresponding to the picture
+    :param background: value (or 2D map) subtracted from the pixels
+    :param thresholds: list of threshold values
+    :return: list of the results of the checks
+    """
+    results = []
+    tree = componenttree.ComponentTree(pixels, background, lowest=min(thresholds))
+    counts = tree.count(np.array(thresholds))
+    for threshold, count in zip(thresholds, counts):
+        labels, stats = mylib.label_clusters(pixels, threshold, background)
+        nlabels = len(stats['npix'])
+        tree_labels, tree_nlabels = tree.labels(threshold)
+        image = np.zeros(pixels.size, dtype=np.int64)
+        image[tree.index[:len(tree_labels)]] = tree_labels
+        results.append(check('%s at %g: count' % (name, threshold), \
+                             tree.count(threshold) == nlabels and count == nlabels))
+        results.append(check('%s at %g: labels' % (name, threshold), \
+                             tree_nlabels == nlabels and \
+                             np.array_equal(image.reshape(pixels.shape), labels)))
+        results.append(check('%s at %g: catalog' % (name, threshold), \
+                             same_catalogs(tree.catalog(threshold), \
+                                           catalog.from_statistics(stats))))
+    return results
+
+def run_checks():
+    """
+    Run the checks
+    :return: number of failed checks
+    """
+    results = []
+
+    # Pictures of the exercises
+    for path in PICTURES:
+        pixels, _ = mylib.get_pixels(path)
+        _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
+        results += check_picture(path, pixels, background, \
+                                 [background + nsigma * dispersion for nsigma in NSIGMAS])
+
+    # Integer synthetic field, with many pixels of the same value,
+    # at thresholds equal to pixel values
+    shape = (150, 120)
+    stars = synthetic.make_stars(shape, density=5e-3, seed=2)
+    random = np.random.RandomState(2)
+    pixels = np.rint(1000. + random.normal(0., 10., shape) + \
+                     synthetic.render_strip(stars, 0, shape[0], shape[1])).astype(np.int16)
+    results += check_picture('synthetic field', pixels, 1000., \
+                             [1030, 1045, 1060, 1100, 1500])
+
+    # Float picture with a background map
+    background = np.linspace(0., 20., pixels.size).reshape(shape)
+    results += check_picture('background map', pixels + background, background, \
+                             [1030.5, 1060., 1200.])
+
+    # Thresholds below the lowest one of the tree are refused
+    tree = componenttree.ComponentTree(pixels, lowest=1100)
+    try:
+        tree.count(1000)
+        raised = False
+    except ValueError:
+        raised = True
+    results.append(check('threshold below the lowest one raises ValueError', raised))
+
+    return results.count(False)
+
+def main():
+    """
+    Run the checks and print ok or NOT OK
+    """
+    parser = argparse.ArgumentParser(description='Check the component tree ' \
+                                                 'against the labelling of the picture')
+    parser.parse_args()
+
+    failed = run_checks()
+    print 'ok' if failed == 0 else 'NOT OK'
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
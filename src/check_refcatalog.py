@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script checks that the cone requests of the reference catalog
+(see refcatalog), which only search a few RA ranges of the declination
+zones, find the same objects as the angular distance to every object,
+in particular around RA 0 / 360, near the poles and on zone boundaries
+"""
+
+import argparse
+import sys
+import numpy as np
+from cluster import choose_star_name
+import library
+import refcatalog
+
+RADII = [0.003, 0.05, 0.3, 2.]
+ZONE_HEIGHTS = [0.1, 1.]
+
+def check(name, condition):
+    """
+    Print the result of a check
+    :param name: description of the check
+    :param condition: True if the check passed
+    :return: condition
+    """
+    print '%s: %s' % (name, 'ok' if condition else 'NOT OK')
+    return condition
+
+def make_objects(random, count):
+    """
+    Draw objects over the whole sky and packed around the difficult
+    places: RA 0 / 360, the poles and the boundaries of the zones
+    :param random: numpy.random.RandomState
+    :param count: number of objects of each group
+    :return: tuple (names, types, ras, decs)
+    """
+    ras = np.concatenate((random.uniform(0., 360., count), \
+                          np.mod(random.uniform(-3., 3., count), 360.), \
+                          random.uniform(0., 360., count), \
+                          random.uniform(0., 360., count), \
+                          random.uniform(0., 360., count)))
+    decs = np.concatenate((np.degrees(np.arcsin(random.uniform(-1., 1., count))), \
+                           random.uniform(-90., 90., count), \
+                           random.uniform(85., 90., count), \
+                           random.uniform(-90., -85., count), \
+                           np.round(random.uniform(-10., 10., count), 1) + \
+                           random.uniform(-1e-3, 1e-3, count)))
+    names = ['OBJ %d' % index for index in range(len(ras))]
+    types = np.where(random.uniform(0., 1., len(ras)) < 0.3, 'Unknown', 'Star')
+    return names, types, ras, decs
+
+def make_cones(random, count):
+    """
+    Draw the centers of the cones at the same difficult places,
+    RA being sometimes given outside of [0, 360)
+    :return: tuple (ras, decs)
+    """
+    ras = np.concatenate(([0., 359.9999, 360., -0.0001, 720.5, 0., 180., 0., 10.], \
+                          random.uniform(-1., 1., count), \
+                          random.uniform(0., 360., count), \
+                          random.uniform(0., 360., count), \
+                          random.uniform(0., 360., count), \
+                          random.uniform(0., 360., count)))
+    decs = np.concatenate(([0., 1., -1., 45., 30., 90., -90., 89.999, 0.1], \
+                           random.uniform(-90., 90., count), \
+                           random.uniform(80., 88., count), \
+                           random.uniform(88., 90., count), \
+                           random.uniform(-90., -88., count), \
+                           np.round(random.uniform(-10., 10., count), 1)))
+    return ras, decs
+
+def brute_force(reference, ras, decs, radius):
+    """
+    Pairs (cone, object) closer than radius, with the distance
+    from every cone to every object
+    :return: set of pairs
+    """
+    distances = library.angular_distance(ras[:, np.newaxis], decs[:, np.newaxis], \
+                                         reference.ras[np.newaxis, :], \
+                                         reference.decs[np.newaxis, :])
+    return set(zip(*np.nonzero(distances <= radius)))
+
+def run_checks():
+    """
+    Run the checks
+    :return: number of failed checks
+    """
+    results = []
+    random = np.random.RandomState(3)
+    names, types, ras, decs = make_objects(random, 2000)
+    cone_ras, cone_decs = make_cones(random, 100)
+
+    for zone_height in ZONE_HEIGHTS:
+        reference = refcatalog.ReferenceCatalog(names, types, ras, decs, zone_height)
+        for radius in RADII:
+            name = 'zones of %g, radius %g' % (zone_height, radius)
+            expected = brute_force(reference, cone_ras, cone_decs, radius)
+
+            # Every close object is found once
+            cones, objects = reference.matches(cone_ras, cone_decs, radius)
+            found = zip(cones, objects)
+            results.append(check(name + ': matches', set(found) == expected))
+            results.append(check(name + ': no duplicate', len(set(found)) == len(found)))
+
+            # Same names as the rule applied to the objects of each cone
+            names_expected = ['Unfound'] * len(cone_ras)
+            by_cone = {}
+            for cone, index in expected:
+                by_cone.setdefault(cone, {})[reference.names[index]] = reference.types[index]
+            for cone, cone_objects in by_cone.items():
+                names_expected[cone] = choose_star_name(cone_objects)
+            results.append(check(name + ': star names', \
+                                 reference.star_names(cone_ras, cone_decs, radius) == \
+                                 names_expected))
+
+    return results.count(False)
+
+def main():
+    """
+    Run the checks and print ok or NOT OK
+    """
+    parser = argparse.ArgumentParser(description='Check the cone requests of the ' \
+                                                 'reference catalog against brute force')
+    parser.parse_args()
+
+    failed = run_checks()
+    print 'ok' if failed == 0 else 'NOT OK'
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
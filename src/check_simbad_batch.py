@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script checks the splitting of the answer to a script of many
+cone requests (see library.parse_batch) without network: the answers
+are built by the local stand-in server (see simbad_server), then
+markers are removed, swapped or repeated, which must raise SimbadError
+instead of giving the objects of a cone to another one
+"""
+
+import argparse
+import sys
+import library
+import simbad_client
+import simbad_server
+
+OBJECTS = [('HD 1', 'Star', 10.0000, 40.0000), \
+           ('HD 2', 'Unknown', 10.0010, 40.0005), \
+           ('HD 3', 'Star', 20.0000, -30.0000), \
+           ('HD 4', 'Star', 359.9995, 0.0000), \
+           ('HD 5', 'Star', 0.0005, 0.0000)]
+
+POSITIONS = [(10.0, 40.0), (50.0, 50.0), (20.0, -30.0), (0.0, 0.0), (10.001, 40.0005)]
+RADIUS = 0.003
+
+def check(name, condition):
+    """
+    Print the result of a check
+    :param name: description of the check
+    :param condition: True if the check passed
+    :return: condition
+    """
+    print '%s: %s' % (name, 'ok' if condition else 'NOT OK')
+    return condition
+
+def data_lines(out):
+    """
+    Cut an answer into the lines before the data (included) and the data lines
+    :return: tuple (header lines, data lines)
+    """
+    lines = out.split('\n')
+    start = lines.index('::data' + ':'*74) + 1
+    return lines[:start], lines[start:]
+
+def sections(lines):
+    """
+    Cut the data lines into the lines before the first marker and
+    the sections starting with each marker
+    :return: tuple (lines before the first marker, list of sections)
+    """
+    before, parts = [], []
+    for line in lines:
+        if line.startswith(library.CONE_MARKER + ' '):
+            parts.append([])
+        (parts[-1] if parts else before).append(line)
+    return before, parts
+
+def rebuild(header, before, parts):
+    """
+    Join the lines of an answer cut by data_lines and sections
+    """
+    return '\n'.join(header + before + [line for part in parts for line in part])
+
+def raises(out, count):
+    """
+    Tell whether parsing an answer raises SimbadError
+    """
+    try:
+        list(library.parse_batch(out, count))
+    except simbad_client.SimbadError:
+        return True
+    return False
+
+def run_checks():
+    """
+    Run the checks
+    :return: number of failed checks
+    """
+    results = []
+    count = len(POSITIONS)
+    out = simbad_server.answer(library.make_batch_script(POSITIONS, RADIUS), OBJECTS)
+
+    # A complete answer gives the objects of each cone, as its own request
+    expected = [library.parse_objects(simbad_server.answer( \
+                    library.make_script(ra, dec, RADIUS), OBJECTS)) \
+                for ra, dec in POSITIONS]
+    results.append(check('answers in the order of the requests', \
+                         list(library.parse_batch(out, count)) == expected))
+    results.append(check('empty cone kept', expected[1] == [] and \
+                         list(library.parse_batch(out, count))[1] == []))
+
+    # Broken answers
+    header, lines = data_lines(out)
+    before, parts = sections(lines)
+    for name, broken_parts in \
+            [('first marker missing', [parts[0][1:]] + parts[1:]), \
+             ('middle marker missing', parts[:2] + [parts[2][1:]] + parts[3:]), \
+             ('last cone missing', parts[:-1]), \
+             ('cones swapped', [parts[1], parts[0]] + parts[2:]), \
+             ('last cones swapped', parts[:-2] + [parts[-1], parts[-2]]), \
+             ('marker repeated', parts[:2] + [parts[1]] + parts[2:-1]), \
+             ('extra cone', parts + [[library.CONE_MARKER + ' %d' % count]])]:
+        results.append(check(name + ' raises SimbadError', \
+                             raises(rebuild(header, before, broken_parts), count)))
+    results.append(check('no data raises SimbadError', raises('\n'.join(header), count)))
+    results.append(check('no answer raises SimbadError', raises('', count)))
+
+    return results.count(False)
+
+def main():
+    """
+    Run the checks and print ok or NOT OK
+    """
+    parser = argparse.ArgumentParser(description='Check the splitting of the answers ' \
+                                                 'to many cone requests')
+    parser.parse_args()
+
+    failed = run_checks()
+    print 'ok' if failed == 0 else 'NOT OK'
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script checks the cache of the Simbad answers without network:
+the requests are sent to the local stand-in server (see simbad_server),
+which counts them
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import library
+import simbad_server
+
+OBJECTS = [('HD 1', 'Star', 10.0000, 40.0000), \
+           ('HD 2', 'Unknown', 10.0010, 40.0005), \
+           ('HD 3', 'Star', 20.0000, -30.0000)]
+
+def check(name, condition):
+    """
+    Print the result of a check
+    :param name: description of the check
+    :param condition: True if the check passed
+    :return: condition
+    """
+    print '%s: %s' % (name, 'ok' if condition else 'NOT OK')
+    return condition
+
+def run_checks(server, directory):
+    """
+    Run the checks of the cache against a running stand-in server
+    :param server: server given by simbad_server.start_server
+    :param directory: empty directory for the cache
+    :return: number of failed checks
+    """
+    results = []
+
+    # A miss asks the server and stores the answer, a hit does not
+    library.use_simbad_cache(directory, ttl=3600)
+    first = library.fetch_objects(10.0, 40.0, 0.003)
+    results.append(check('miss sends a request', server.requests == 1))
+    results.append(check('answer parsed', sorted(library.get_objects(10.0, 40.0, 0.003)) \
+                                          == ['HD 1', 'HD 2']))
+    results.append(check('hit sends no request', server.requests == 1))
+    results.append(check('hit gives the same answer', \
+                         library.fetch_objects(10.0, 40.0, 0.003) == first))
+
+    # An entry older than the time to live is fetched again
+    old = time.time() - 2 * 3600
+    for path in library.SIMBAD_CACHE.entries():
+        os.utime(path, (old, old))
+    library.fetch_objects(10.0, 40.0, 0.003)
+    results.append(check('expired entry sends a request', server.requests == 2))
+    library.fetch_objects(10.0, 40.0, 0.003)
+    results.append(check('refreshed entry is a hit', server.requests == 2))
+
+    # Offline, the cached answers are served and the other ones raise
+    library.use_simbad_cache(directory, ttl=3600, offline=True)
+    results.append(check('offline hit', library.fetch_objects(10.0, 40.0, 0.003) == first))
+    try:
+        library.fetch_objects(20.0, -30.0, 0.003)
+        raised = False
+    except IOError:
+        raised = True
+    results.append(check('offline miss raises IOError', raised))
+    results.append(check('offline sends no request', server.requests == 2))
+
+    return results.count(False)
+
+def main():
+    """
+    Start the stand-in server, run the checks and print ok or NOT OK
+    """
+    parser = argparse.ArgumentParser(description='Check the cache of the Simbad answers ' \
+                                                 'with the local stand-in server')
+    parser.parse_args()
+
+    server = simbad_server.start_server(OBJECTS)
+    host, cache = library.SIMBAD_HOST, library.SIMBAD_CACHE
+    library.SIMBAD_HOST = server.host
+    directory = tempfile.mkdtemp(prefix='simbad-cache-')
+    try:
+        failed = run_checks(server, directory)
+    finally:
+        library.SIMBAD_HOST, library.SIMBAD_CACHE = host, cache
+        library.SIMBAD_CLIENT.close()
+        server.shutdown()
+        shutil.rmtree(directory)
+
+    print 'ok' if failed == 0 else 'NOT OK'
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script checks that the detection by strips (see streaming) gives
+the same catalog as the labelling of the whole picture (see mylib),
+on the pictures of the exercises and on shapes crossing many strips
+"""
+
+import argparse
+import sys
+import numpy as np
+import catalog
+import mylib
+import streaming
+import synthetic
+
+PICTURES = ['../data/common.fits', '../data/specific.fits']
+STRIP_ROWS = [1, 2, 7, 64, 1024]
+
+def check(name, condition):
+    """
+    Print the result of a check
+    :param name: description of the check
+    :param condition: True if the check passed
+    :return: condition
+    """
+    print '%s: %s' % (name, 'ok' if condition else 'NOT OK')
+    return condition
+
+def same_catalogs(strips, whole):
+    """
+    Compare two catalogs column by column, in the order of their clusters
+    :param strips: catalog.Catalog given by streaming.strip_catalog
+    :param whole: catalog.Catalog given by mylib.get_cluster_array
+    :return: True if they have the same clusters
+    """
+    if len(strips) != len(whole):
+        return False
+    for name in catalog.CATALOG_DTYPE.names:
+        if name == 'name':
+            continue
+        if not np.allclose(strips[name], whole[name], rtol=1e-9, atol=1e-6, \
+                           equal_nan=True):
+            return False
+    return True
+
+def shapes():
+    """
+    Build a picture whose clusters cross the boundaries of the strips:
+    a U whose arms are only joined at its bottom, a comb joined at its
+    top, a diagonal line touching the next row by a corner only,
+    a single pixel and a single row
+    :return: 2D float64 array
+    """
+    pixels = np.zeros((40, 60))
+    pixels[2:30, 3] = pixels[2:30, 8] = pixels[29, 3:9] = 50. # U
+    pixels[5, 12:30] = 80.
+    pixels[5:35, 12:30:3] = 70. # comb
+    for step in range(20):
+        pixels[10 + step, 35 + step] = 90. + step # diagonal
+    pixels[38, 2] = 60.
+    pixels[0, 40:58] = 40.
+    return pixels
+
+def run_checks():
+    """
+    Run the checks
+    :return: number of failed checks
+    """
+    results = []
+
+    # Pictures of the exercises, read from the files by strips
+    for path in PICTURES:
+        pixels, _ = mylib.get_pixels(path)
+        _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
+        whole = mylib.get_cluster_array(pixels, background, dispersion)
+        for strip_rows in STRIP_ROWS:
+            with mylib.open_image(path) as image:
+                strips = streaming.strip_catalog(image, background, dispersion, \
+                                                 strip_rows=strip_rows)
+            results.append(check('%s by %d rows' % (path, strip_rows), \
+                                 same_catalogs(strips, whole)))
+
+    # Shapes crossing the strips, with a background map
+    pixels = shapes()
+    background = np.linspace(0., 1., pixels.size).reshape(pixels.shape)
+    whole = mylib.get_cluster_array(pixels, background, 1., threshold=background + 10.)
+    for strip_rows in STRIP_ROWS:
+        strips = streaming.strip_catalog(pixels, background, 1., background + 10., strip_rows)
+        results.append(check('shapes by %d rows' % strip_rows, same_catalogs(strips, whole)))
+
+    # Integer synthetic field, whose luminosities are rounded
+    shape = (300, 200)
+    stars = synthetic.make_stars(shape, density=3e-3, seed=1)
+    pixels = np.rint(1000. + synthetic.render_strip(stars, 0, shape[0], shape[1])) \
+             .astype(np.int16)
+    whole = mylib.get_cluster_array(pixels, 1000., 10.)
+    for strip_rows in STRIP_ROWS:
+        strips = streaming.strip_catalog(pixels, 1000., 10., strip_rows=strip_rows)
+        results.append(check('synthetic field by %d rows' % strip_rows, \
+                             same_catalogs(strips, whole)))
+
+    return results.count(False)
+
+def main():
+    """
+    Run the checks and print ok or NOT OK
+    """
+    parser = argparse.ArgumentParser(description='Check the detection by strips ' \
+                                                 'against the whole picture')
+    parser.parse_args()
+
+    failed = run_checks()
+    print 'ok' if failed == 0 else 'NOT OK'
+    return 0 if failed == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,31 @@ Module which contains the class Cluster
 """
 
 import library
+import metrics
+
+def choose_star_name(celestial_objects):
+    """
+    Choose the name of a cluster among the celestial objects
+    found in its region: known objects are preferred to the
+    'Unknown' ones, and the first name in alphabetical order is taken
+    :param celestial_objects: dictionary {objectname: objecttype}
+    :return: name of the celestial object, "Unfound" if there is none
+    """
+    # If there is some objects in this region
+    if len(celestial_objects) != 0:
+        metrics.count('names_chosen')
+        knowns_objs = {i:celestial_objects[i] for i in celestial_objects \
+                       if celestial_objects[i] != 'Unknown'}
+        if len(knowns_objs) != 0:
+            knowns_keys = sorted(knowns_objs.keys())
+            return knowns_keys[0]
+        unknowns = {i:celestial_objects[i] for i in celestial_objects \
+                    if celestial_objects[i] == 'Unknown'}
+        unknowns_keys = sorted(unknowns.keys())
+        return unknowns_keys[0]
+    # is there is no object in this region
+    metrics.count('names_unfound')
+    return "Unfound"
 
 class Cluster(object):
     """
@@ -36,46 +61,6 @@ class Cluster(object):
         self.cluster_pixels.append((i, j))
         self.integrated_luminosity += pixels[i][j]
 
-    # Disable the too many arguments comment
-    # this is necessary in this recursive approach
-    # pylint: disable=R
-    def recursive_exploration(self, i, j, pixels, marks, threshold):
-        """
-        Append the pixel (i,j) and explore the contiguous pixels
-        :param i: abs of the pixel
-        :param j: ord of the pixel
-        :param pixels: 2D array of pixels
-        :param marks: 2D array to avoid double couting
-        :param threshold: allows to discriminate pixels
-        """
-        self.append_pixel(i, j, pixels)
-        if j != pixels.shape[1] - 1:
-            self.threshold_checker(i, j+1, pixels, marks, threshold)
-        if i != 0:
-            self.threshold_checker(i-1, j, pixels, marks, threshold)
-        if j != 0:
-            self.threshold_checker(i, j-1, pixels, marks, threshold)
-        if i != pixels.shape[0] - 1:
-            self.threshold_checker(i+1, j, pixels, marks, threshold)
-
-    # Disable the too many arguments comment
-    # this is necessary in this recursive approach
-    # pylint: disable=R
-    def threshold_checker(self, i, j, pixels, marks, threshold):
-        """
-        Check if the pixel (i,j) is already treated
-        and if it is above the threshold
-        :param i: abs of the pixel
-        :param j: ord of the pixel
-        :param pixels: 2D array of pixels
-        :param marks: 2D array to avoid double couting
-        :param threshold: allows to discriminate pixels
-        """
-        if marks[i][j] == 0.:
-            marks[i][j] = 1
-            if pixels[i][j] >= threshold:
-                self.recursive_exploration(i, j, pixels, marks, threshold)
-
     def find_star_name(self):
         """
         Method to find the name of the celestial object
@@ -84,21 +69,7 @@ class Cluster(object):
         # Get the dictionnary of all objects in this region
         celestial_objects = library.get_objects(self.centroid_wcs[0], \
                                                 self.centroid_wcs[1], 0.003)
-
-        # If there is some objects in this region
-        if len(celestial_objects) != 0:
-            knowns_objs = {i:celestial_objects[i] for i in celestial_objects \
-                           if celestial_objects[i] != 'Unknown'}
-            if len(knowns_objs) != 0:
-                knowns_keys = sorted(knowns_objs.keys())
-                self.star_name = knowns_keys[0]
-            else:
-                unknowns = {i:celestial_objects[i] for i in celestial_objects \
-                            if celestial_objects[i] == 'Unknown'}
-                unknowns_keys = sorted(unknowns.keys())
-                self.star_name = unknowns_keys[0]
-        else: # is there is no object in this region
-            self.star_name = "Unfound"
+        self.star_name = choose_star_name(celestial_objects)
 
     def find_centroid(self, my_wcs=None):
         """
@@ -123,15 +94,29 @@ class Cluster(object):
                 ymin = ypix
 
         # Determine centroid and boundung box
-        self.centroid_pixel = ((xmax+xmin)/2., (ymax+ymin)/2.)
-        self.bounding_box = ([xmin-0.5, ymin-0.5], xmax-xmin+1, ymax-ymin+1)
+        self.set_bounding(xmin, xmax, ymin, ymax)
 
         # If asked, determine wcs coordinates and search for star name
         if my_wcs != None:
-            self.centroid_wcs = my_wcs.convert_to_radec( \
-                                 self.centroid_pixel[0], \
-                                 self.centroid_pixel[1])
-            self.find_star_name()
+            self.find_wcs(my_wcs)
+
+    def set_bounding(self, xmin, xmax, ymin, ymax):
+        """
+        Set the bounding box and the centroid of the cluster
+        from the extreme pixels coordinates
+        """
+        self.centroid_pixel = ((xmax+xmin)/2., (ymax+ymin)/2.)
+        self.bounding_box = ([xmin-0.5, ymin-0.5], xmax-xmin+1, ymax-ymin+1)
+
+    def find_wcs(self, my_wcs):
+        """
+        Method that convert the centroid into celestial coordinates
+        and search for the star name
+        """
+        self.centroid_wcs = my_wcs.convert_to_radec( \
+                             self.centroid_pixel[0], \
+                             self.centroid_pixel[1])
+        self.find_star_name()
 
     def is_in_bounding(self, x_position, y_position):
         """
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the class ComponentTree, built once from a picture,
+giving the clusters found above any threshold without labelling
+the picture again
+"""
+
+import numpy as np
+# pylint: disable=E
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+import catalog
+import mylib
+
+class ComponentTree(object):
+    """
+    Class which holds the merges of the clusters when the threshold
+    decreases: the pixels are sorted by decreasing value, and the
+    neighbours (4-connectivity) are joined by a spanning forest whose
+    edges are added from the highest level to the lowest one.
+    Above a threshold t, the number of clusters is the number of pixels
+    minus the number of edges of the forest, both read by a binary search.
+    """
+
+    def __init__(self, pixels, background=0., lowest=None):
+        """
+        Constructor of ComponentTree
+        :param pixels: 2D array corresponding to the picture
+        :param background: value (or 2D map) subtracted from the pixels to get the flux
+        :param lowest: lowest threshold which will be asked (default: every pixel)
+        """
+        self.shape = pixels.shape
+        self.integer = np.issubdtype(pixels.dtype, np.integer)
+        flat = pixels.ravel()
+        if lowest is None:
+            lowest = flat.min()
+        self.lowest = lowest
+
+        # Keep the pixels above the lowest threshold, sorted by decreasing
+        # value (in reading order for equal values)
+        kept = np.flatnonzero(flat >= lowest)
+        order = np.argsort(-flat[kept].astype(np.float64), kind='mergesort')
+        self.index = kept[order] # position of the nodes in the picture
+        self.values = flat[self.index]
+        self.keys = -self.values.astype(np.float64) # increasing, for the searches
+        self.background = background if np.ndim(background) == 0 else \
+                          np.broadcast_to(background, self.shape).ravel()[self.index]
+        count = len(self.index)
+
+        # Node of every kept pixel, -1 for the others
+        nodes = np.full(flat.shape, -1, dtype=np.int64)
+        nodes[self.index] = np.arange(count)
+        nodes = nodes.reshape(self.shape)
+
+        # Edges between kept neighbours, an edge appearing when its
+        # lowest pixel (the highest node) is reached
+        first = np.concatenate((nodes[:, :-1].ravel(), nodes[:-1, :].ravel()))
+        second = np.concatenate((nodes[:, 1:].ravel(), nodes[1:, :].ravel()))
+        both = (first >= 0) & (second >= 0)
+        first, second = first[both], second[both]
+        level = np.maximum(first, second)
+
+        # The spanning forest keeping the earliest edges holds
+        # the merges of the clusters
+        graph = coo_matrix((level + 1., (first, second)), shape=(count, count))
+        forest = minimum_spanning_tree(graph.tocsr()).tocoo()
+        order = np.argsort(np.maximum(forest.row, forest.col), kind='mergesort')
+        self.first = forest.row[order].astype(np.int64)
+        self.second = forest.col[order].astype(np.int64)
+        self.merge_nodes = np.maximum(self.first, self.second)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the tree, in bytes
+        """
+        return sum(np.asarray(array).nbytes for array in \
+                   (self.index, self.values, self.keys, self.background, \
+                    self.first, self.second, self.merge_nodes))
+
+    def nodes_above(self, threshold):
+        """
+        Number of pixels whose value is greater or equal than threshold
+        """
+        if np.any(np.asarray(threshold) < self.lowest):
+            raise ValueError('threshold below the lowest one of the tree: %s' % self.lowest)
+        return np.searchsorted(self.keys, -np.asarray(threshold, dtype=np.float64), \
+                               side='right')
+
+    def count(self, threshold):
+        """
+        Number of clusters above a threshold
+        :param threshold: value or array of values
+        :return: number or array of numbers of clusters
+        """
+        nodes = self.nodes_above(threshold)
+        return nodes - np.searchsorted(self.merge_nodes, nodes)
+
+    def labels(self, threshold):
+        """
+        Label the pixels above a threshold, the labels following
+        the reading order of the first pixel of each cluster
+        as with mylib.label_clusters
+        :return: labels of the first nodes (from 1), number of labels
+        """
+        nodes = int(self.nodes_above(threshold))
+        merges = np.searchsorted(self.merge_nodes, nodes)
+        graph = coo_matrix((np.ones(merges), (self.first[:merges], self.second[:merges])), \
+                           shape=(nodes, nodes))
+        nlabels, components = connected_components(graph, directed=False)
+
+        # Order the clusters by their first pixel
+        first_pixel = np.full(nlabels, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first_pixel, components, self.index[:nodes])
+        rank = np.empty(nlabels, dtype=np.int64)
+        rank[np.argsort(first_pixel)] = np.arange(1, nlabels + 1)
+        return rank[components], nlabels
+
+    def statistics(self, threshold):
+        """
+        Statistics of the clusters above a threshold
+        :return: dictionary of 1D arrays indexed by label - 1,
+                 see mylib.cluster_moments
+        """
+        labels, nlabels = self.labels(threshold)
+        nodes = len(labels)
+        background = self.background if np.ndim(self.background) == 0 \
+                     else self.background[:nodes]
+        index = self.index[:nodes]
+        stats = mylib.cluster_moments(mylib.pixel_sums( \
+            self.values[:nodes], index // self.shape[1], index % self.shape[1], \
+            labels, nlabels, background))
+        if self.integer:
+            stats['luminosity'] = np.rint(stats['luminosity']).astype(np.int64)
+        return stats
+
+    def catalog(self, threshold):
+        """
+        Same as mylib.get_cluster_array (without WCS) at a threshold
+        :return: catalog.Catalog of the clusters
+        """
+        return catalog.from_statistics(self.statistics(threshold))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the class DiskCache, a persistent
+content-addressed cache with expiration and size-bounded eviction
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+def make_key(*parts):
+    """
+    Build a content-addressed key from any number of parts
+    :param parts: values whose text representation identifies the content
+    :return: hexadecimal sha1 digest
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part))
+        digest.update('\0')
+    return digest.hexdigest()
+
+class DiskCache(object):
+    """
+    Class which stores strings in files named by their key:
+    - entries older than ttl seconds are considered as missing
+    - the least recently used entries are removed when the total size
+      exceeds max_bytes
+    - hits, misses and evictions are counted
+    """
+
+    def __init__(self, directory, ttl=None, max_bytes=100*1024*1024, offline=False):
+        """
+        Constructor of DiskCache
+        :param directory: directory where the entries are stored
+        :param ttl: time to live of an entry in seconds (None for ever)
+        :param max_bytes: maximum total size of the entries
+        :param offline: if True, the values are only served from the cache
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.total_bytes = sum(os.path.getsize(path) for path in self.entries())
+
+    def path(self, key):
+        """
+        Return the path of the file of an entry
+        """
+        return os.path.join(self.directory, key[:2], key)
+
+    def entries(self):
+        """
+        Return the paths of all the stored entries
+        """
+        paths = []
+        for root, _, file_names in os.walk(self.directory):
+            paths += [os.path.join(root, file_name) for file_name in file_names \
+                      if not file_name.startswith('.')]
+        return paths
+
+    def get(self, key):
+        """
+        Return the value stored for key, None if it is missing or expired
+        """
+        path = self.path(key)
+        with self.lock:
+            try:
+                modified = os.path.getmtime(path)
+                if self.ttl is not None and time.time() - modified > self.ttl:
+                    self.remove(path)
+                    value = None
+                else:
+                    with open(path, 'rb') as entry:
+                        value = entry.read()
+                    # the access time gives the order of the evictions
+                    os.utime(path, (time.time(), modified))
+            except (IOError, OSError):
+                value = None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store value for key and evict the least recently used entries
+        if the cache is too large
+        """
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError: # created meanwhile by another writer
+                pass
+
+        # Write in a temporary file first so that readers never see
+        # a partial entry
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(handle, 'wb') as entry:
+            entry.write(value)
+        with self.lock:
+            if os.path.exists(path):
+                self.total_bytes -= os.path.getsize(path)
+            os.rename(tmp_path, path)
+            self.total_bytes += len(value)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def remove(self, path):
+        """
+        Remove the file of an entry
+        :return: True if the file was removed, False if it was already gone
+        """
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+            return True
+        except OSError:
+            return False
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size
+        is below max_bytes
+        """
+        # Entries removed meanwhile by another process are skipped
+        accessed = []
+        for path in self.entries():
+            try:
+                accessed.append((os.path.getatime(path), path))
+            except OSError:
+                pass
+        for _, path in sorted(accessed):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if self.remove(path):
+                self.evictions += 1
+
+    def keys(self):
+        """
+        Return the keys of all the stored entries
+        """
+        return [os.path.basename(path) for path in self.entries()]
+
+    def invalidate(self, key=None):
+        """
+        Remove the entry of key, or all the entries if key is None
+        """
+        with self.lock:
+            paths = self.entries() if key is None else [self.path(key)]
+            for path in paths:
+                self.remove(path)
+
+    def stats(self):
+        """
+        Return the counters of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, \
+                'evictions': self.evictions, 'bytes': self.total_bytes}
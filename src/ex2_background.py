@@ -10,6 +10,7 @@ corresponding to the data contained in pixels
 import sys
 import matplotlib.pyplot as plt
 import mylib
+import stagecache
 
 def main():
     """
@@ -17,15 +18,14 @@ def main():
     and display the associated picture without background
     """
 
-    # Get pixels and header from a fits file
-    pixels, _ = mylib.get_pixels("../data/specific.fits")
-
-    # Process to the fit of the background
+    # Process to the fit of the background, the results of the stages
+    # are kept between runs
+    pipeline = stagecache.default_pipeline()
     x_array, y_array, maxvalue, background, dispersion = \
-        mylib.modelling_parameters(pixels)
+        pipeline.modelling_parameters("../data/specific.fits")
 
     # Remove the background
-    filtered_pixels = mylib.remove_background(pixels, background, dispersion)
+    filtered_pixels = pipeline.filtered_pixels("../data/specific.fits")
 
     # Plot both histograms and picture without background
     _, axis = plt.subplots(1, 2)
@@ -8,6 +8,7 @@ Module which find clusters in the picture using recursive functions
 
 import sys
 import mylib
+import stagecache
 
 def main():
     """
@@ -16,14 +17,10 @@ def main():
     greater than a threshold (linked to the value of the background)
     """
 
-    # Get pixels and header from a fits file
-    pixels, _ = mylib.get_pixels("../data/specific.fits")
-
-    # Process to the fit of the background
-    _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
-
-    # Get the list of clusters
-    cluster_array = mylib.get_cluster_array(pixels, background, dispersion)
+    # Get the list of clusters, the results of the stages
+    # (background fit, labelling) are kept between runs
+    pipeline = stagecache.default_pipeline()
+    cluster_array = pipeline.clusters("../data/specific.fits")
 
     # Find the cluster with the greatest integral
     main_clust = mylib.find_main_centroid(cluster_array)
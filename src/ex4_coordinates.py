@@ -10,8 +10,10 @@ of the pixel given by the mouse
 
 import sys
 import matplotlib.pyplot as plt
-import mylib
 import library
+import mylib
+import stagecache
+import viewer
 
 def main():
     """
@@ -19,42 +21,24 @@ def main():
     find the clusters array, find there WCS coordinates, display it
     """
 
-    # Get pixels and header from a fits file
-    pixels, header = mylib.get_pixels("../data/specific.fits")
-
-    # Process to the fit of the background
-    _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
-
-    # Get the list of clusters
-    my_wcs = library.WCS(header) # Instantiate WCS conversion object
-    cluster_array = mylib.get_cluster_array(pixels, background, \
-                                            dispersion, my_wcs=my_wcs)
+    # Get the list of clusters with their WCS coordinates,
+    # the results of the stages are kept between runs
+    pipeline = stagecache.default_pipeline()
+    cluster_array = pipeline.clusters("../data/specific.fits", wcs=True)
+    my_wcs = pipeline.wcs("../data/specific.fits") # WCS conversion object
 
     # Remove the background
-    filtered_pixels = mylib.remove_background(pixels, background, dispersion)
+    filtered_pixels = pipeline.filtered_pixels("../data/specific.fits")
 
     # Display the picture
     fig, axis = plt.subplots()
     axis.imshow(filtered_pixels)
 
-    # Move function definition
-    def move(event):
-        """
-        Function called when the event 'motion_notify_event' occurs,
-        the wcs coordinates of the pixel pointed by the mouse are
-        then displayed at its location
-        """
-        x_position = event.xdata
-        y_position = event.ydata
-        if x_position != None: # if we are not outside the picture
-            rad, dec = my_wcs.convert_to_radec(x_position, y_position)
-            text = axis.text(x_position, y_position, 'ra: %.6f, dec: %.6f' % \
-                            (rad, dec), fontsize=14, color='white')
-            event.canvas.draw()
-            text.remove()
-
-    # Use event handler
-    fig.canvas.mpl_connect('motion_notify_event', move)
+    # The coordinates under the mouse are read in a grid converted
+    # by blocks of rows, and redrawn at most 60 times per second
+    sky_grid = library.SkyGrid(my_wcs, filtered_pixels.shape)
+    # pylint: disable=unused-variable
+    readout = viewer.CoordinateReadout(fig, axis, sky_grid) # kept until the end
     plt.show()
 
     # Find the cluster with the greatest integral
@@ -14,6 +14,8 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import mylib
 import library
+import spatialindex
+import stagecache
 
 def main():
     """
@@ -21,19 +23,14 @@ def main():
     find the clusters array, find there names, display it
     """
 
-    # Get pixels and header from a fits file
-    pixels, header = mylib.get_pixels("../data/specific.fits")
-
-    # Process to the fit of the background
-    _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
-
-    # Get the list of clusters
-    my_wcs = library.WCS(header) # Instantiate WCS conversion object
-    cluster_array = mylib.get_cluster_array(pixels, background, \
-                                            dispersion, my_wcs=my_wcs)
+    # Get the list of clusters with their names, the results of the
+    # stages and the Simbad answers are kept between runs
+    library.use_simbad_cache("../cache/simbad")
+    pipeline = stagecache.default_pipeline()
+    cluster_array = pipeline.clusters("../data/specific.fits", names=True)
 
     # Remove the background
-    filtered_pixels = mylib.remove_background(pixels, background, dispersion)
+    filtered_pixels = pipeline.filtered_pixels("../data/specific.fits")
 
     # Display the picture
     fig, axis = plt.subplots()
@@ -47,6 +44,9 @@ def main():
                                          fill=False, \
                                          color='white'))
 
+    # Index the bounding boxes to find the clicked clusters at once
+    cluster_index = spatialindex.ClusterIndex(cluster_array)
+
     # On_click function definition
     def on_click(event):
         """
@@ -57,12 +57,11 @@ def main():
         x_position = event.xdata
         y_position = event.ydata
         if x_position != None: # if we are not outside the picture
-            for clust in cluster_array:
-                if clust.is_in_bounding(x_position, y_position):
-                    text = axis.text(x_position, y_position, clust.star_name, \
-                                     fontsize=14, color='white')
-                    event.canvas.draw()
-                    text.remove()
+            for index in cluster_index.point(x_position, y_position):
+                text = axis.text(x_position, y_position, cluster_array[index].star_name, \
+                                 fontsize=14, color='white')
+                event.canvas.draw()
+                text.remove()
 
     # Use event handler
     fig.canvas.mpl_connect('button_release_event', on_click)
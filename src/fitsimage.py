@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the class FitsImage, a lazy access
+to the picture of a fits file through a memory map
+"""
+
+import numpy as np
+
+def scaled_dtype(raw_dtype, bscale, bzero):
+    """
+    Give the type of the pixels once BSCALE and BZERO are applied
+    :param raw_dtype: type of the values stored in the file
+    :param bscale: BSCALE keyword
+    :param bzero: BZERO keyword
+    :return: numpy dtype
+    """
+    if bscale == 1 and bzero == 0:
+        return np.dtype(raw_dtype)
+    if raw_dtype.kind == 'i' and bscale == 1 and bzero == 2**(8*raw_dtype.itemsize - 1):
+        # convention for unsigned integers
+        return np.dtype('u%d' % raw_dtype.itemsize)
+    if raw_dtype.kind in 'iu' and raw_dtype.itemsize <= 2:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+class FitsImage(object):
+    """
+    Class which gives access to the picture of a fits file
+    without reading it: the file is memory mapped, image[y0:y1, x0:x1]
+    reads only the rows of the section and applies BSCALE/BZERO to it
+    """
+
+    def __init__(self, path, hdu=0):
+        """
+        Constructor of FitsImage
+        :param path: path of the fits file
+        :param hdu: index of the HDU containing the picture
+        """
+        from astropy.io import fits # loaded with the first picture
+        self.path = path
+        self.hdulist = fits.open(path, memmap=True, do_not_scale_image_data=True)
+        self.header = self.hdulist[hdu].header
+        self.raw = self.hdulist[hdu].data # memory map of the stored values
+        self.bscale = self.header.get('BSCALE', 1)
+        self.bzero = self.header.get('BZERO', 0)
+        self.dtype = scaled_dtype(self.raw.dtype, self.bscale, self.bzero)
+
+    @property
+    def shape(self):
+        """
+        Shape (rows, columns) of the picture
+        """
+        return self.raw.shape
+
+    @property
+    def nbytes(self):
+        """
+        Size of the picture once scaled, in bytes
+        """
+        return self.raw.size * self.dtype.itemsize
+
+    def scale(self, raw):
+        """
+        Apply BSCALE and BZERO to stored values
+        :param raw: array of stored values
+        :return: array of pixels
+        """
+        if self.bscale == 1 and self.bzero == 0:
+            return raw
+        if self.dtype.kind == 'u':
+            # flipping the sign bit is the same as adding BZERO
+            native = raw.astype(raw.dtype.newbyteorder('='))
+            return native.view(self.dtype) ^ self.dtype.type(self.bzero)
+        pixels = raw.astype(self.dtype)
+        if self.bscale != 1:
+            pixels *= self.dtype.type(self.bscale)
+        if self.bzero != 0:
+            pixels += self.dtype.type(self.bzero)
+        return pixels
+
+    def __getitem__(self, key):
+        """
+        Read a section of the picture, e.g. image[y0:y1, x0:x1]
+        """
+        return self.scale(self.raw[key])
+
+    @property
+    def data(self):
+        """
+        Whole picture: without scaling it is the memory map itself
+        """
+        return self[...]
+
+    def rows(self, start, stop):
+        """
+        Read the rows from start to stop (excluded)
+        """
+        return self[start:stop]
+
+    def close(self):
+        """
+        Close the file, the sections already read stay valid
+        """
+        self.hdulist.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
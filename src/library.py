@@ -5,11 +5,20 @@
 Provided utilities for the exercices
 '''
 
-import urllib2
+import io
 import numpy as np
-from astropy import wcs
-import time
-
+import diskcache
+import metrics
+import simbad_client
+
+SIMBAD_HOST = 'simbad.u-strasbg.fr' # may be replaced by a local stand-in server
+SIMBAD_QUANTUM = 1e-6 # degree, precision of the positions sent to Simbad
+SIMBAD_CACHE = None # diskcache.DiskCache of the answers, see use_simbad_cache
+SIMBAD_CLIENT = simbad_client.SimbadClient() # shared pool of connections
+REFERENCE_CATALOG = None # refcatalog.ReferenceCatalog replacing Simbad, see use_reference
+SIMBAD_BATCH_SIZE = 200 # cone requests sent in a single script
+SIMBAD_MAX_BYTES = 64*1024 # largest body of a request with many cone requests
+CONE_MARKER = '#cone' # written by Simbad before the objects of each cone request
 
 def dms(angle):
     """
@@ -46,6 +55,64 @@ def radec(coord):
     """
     return 'RA=%s DEC=%s' % (hms(coord[0]), dms(coord[1]))
 
+def sexagesimal_to_degrees(text, hours=False):
+    """
+    Convert a textual representation Degree Minute Second
+    (or Hour Minute Second if hours is True) into a floating point angle
+    :param text: fields separated by spaces or ':'
+    :param hours: True for a RA coordinate
+    :return: floating point value in degree
+    """
+    fields = text.replace(':', ' ').split()
+    sign = -1.0 if fields[0].startswith('-') else 1.0
+    angle = 0.0
+    for power, field in enumerate(fields):
+        angle += abs(float(field)) / 60.0**power
+    if hours:
+        angle *= 360.0/24.0
+    return sign * angle
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """
+    Compute the angular distance between two positions
+    (works element-wise on numpy arrays)
+    :param ra1: RA of the first position (degree)
+    :param dec1: DEC of the first position (degree)
+    :param ra2: RA of the second position (degree)
+    :param dec2: DEC of the second position (degree)
+    :return: angular distance in degree
+    """
+    ra1, dec1, ra2, dec2 = [np.radians(angle) for angle in (ra1, dec1, ra2, dec2)]
+    sin_ddec = np.sin((dec2 - dec1) / 2.0)
+    sin_dra = np.sin((ra2 - ra1) / 2.0)
+    haversine = sin_ddec**2 + np.cos(dec1) * np.cos(dec2) * sin_dra**2
+    return np.degrees(2.0 * np.arcsin(np.sqrt(np.minimum(haversine, 1.0))))
+
+
+def sky_vectors(ras, decs):
+    """
+    Convert arrays of RA/DEC coordinates into unit vectors
+    :param ras: RA coordinates (degree)
+    :param decs: DEC coordinates (degree)
+    :return: array of shape (N, 3)
+    """
+    ras = np.radians(np.asarray(ras, np.float_))
+    decs = np.radians(np.asarray(decs, np.float_))
+    return np.column_stack((np.cos(decs) * np.cos(ras), \
+                            np.cos(decs) * np.sin(ras), \
+                            np.sin(decs)))
+
+
+def chord_length(radius):
+    """
+    Length of the chord between two unit vectors separated
+    by the angle radius
+    :param radius: angle in degree
+    :return: chord length
+    """
+    return 2.0 * np.sin(np.radians(radius) / 2.0)
+
 # pylint: disable=too-few-public-methods
 class WCS(object):
     '''
@@ -54,7 +121,8 @@ class WCS(object):
     def __init__(self, header):
         """ Parse the WCS keywords from the primary HDU of an FITS image """
 
-        # header = read_header(image)
+        # astropy.wcs is only loaded when a conversion is needed
+        from astropy import wcs
         self.wcs = wcs.WCS(header)
 
     def convert_to_radec(self, x, y):
@@ -64,116 +132,192 @@ class WCS(object):
         ra, dec = sky[0]
         return ra, dec
 
+    def convert_many(self, xs, ys):
+        '''convert arrays of pixel positions to ascension/declination'''
+        xs = np.asarray(xs, np.float_)
+        ys = np.asarray(ys, np.float_)
+        ras, decs = self.wcs.wcs_pix2world(xs, ys, 0)
+        return ras, decs
+
+    def convert_many_to_pixel(self, ras, decs):
+        '''convert arrays of ascension/declination to pixel positions'''
+        ras = np.asarray(ras, np.float_)
+        decs = np.asarray(decs, np.float_)
+        xs, ys = self.wcs.wcs_world2pix(ras, decs, 0)
+        return xs, ys
+
+    def field_cone(self, shape):
+        '''
+        cone (center ascension/declination and radius in degree)
+        covering the whole picture of the given shape
+        '''
+        n_row, n_column = shape
+        center_ra, center_dec = self.convert_to_radec((n_column - 1) / 2., \
+                                                      (n_row - 1) / 2.)
+        corner_ras, corner_decs = self.convert_many( \
+            [-0.5, n_column - 0.5, n_column - 0.5, -0.5], \
+            [-0.5, -0.5, n_row - 0.5, n_row - 0.5])
+        radius = np.max(angular_distance(center_ra, center_dec, \
+                                         corner_ras, corner_decs))
+        return center_ra, center_dec, radius
+
+class SkyGrid(object):
+    '''
+    Ascension/declination of the center of every pixel of a picture,
+    converted all at once or by blocks of rows when first needed,
+    so that a position is read without calling the WCS conversion
+    '''
+    def __init__(self, my_wcs, shape, block_rows=64, precompute=False):
+        """
+        Constructor of SkyGrid
+        :param my_wcs: WCS of the picture
+        :param shape: shape of the picture
+        :param block_rows: number of rows converted at once
+        :param precompute: if True, convert the whole picture now
+        """
+        self.my_wcs = my_wcs
+        self.shape = shape
+        self.block_rows = block_rows if not precompute else shape[0]
+        self.ras = np.empty(shape, dtype=np.float64)
+        self.decs = np.empty(shape, dtype=np.float64)
+        self.done = np.zeros(-(-shape[0] // self.block_rows), dtype=bool)
+        if precompute:
+            self.convert_block(0)
+
+    def convert_block(self, block):
+        '''convert the rows of a block'''
+        start = block * self.block_rows
+        stop = min(start + self.block_rows, self.shape[0])
+        ys, xs = np.mgrid[start:stop, 0:self.shape[1]]
+        self.ras[start:stop], self.decs[start:stop] = self.my_wcs.convert_many(xs, ys)
+        self.done[block] = True
+
+    def lookup(self, x, y):
+        '''
+        ascension/declination of the pixel containing the position,
+        None outside the picture
+        '''
+        column, row = int(np.floor(x + 0.5)), int(np.floor(y + 0.5))
+        if not (0 <= row < self.shape[0] and 0 <= column < self.shape[1]):
+            return None
+        block = row // self.block_rows
+        if not self.done[block]:
+            self.convert_block(block)
+        return self.ras[row, column], self.decs[row, column]
+
+
+def make_script(ra, dec, radius):
+    """
+    Build the script of a request to the Simbad server
+    :param ra: floating point value of the RA coordinate
+    :param dec: floating point value of the DEC coordinate
+    :param radius: floting value of the acceptance radius (degrees)
+    :return: script text
+    """
+    script = ''
+    # output format (for what comes from SIMBAD)
+    script += 'format object f1 "'
+    script += '%COO(A)'            # hour:minute:second
+    script += '\t%COO(D)'          # degree:arcmin:arcsec
+    script += '\t%OTYPE(S)'
+    script += '\t%IDLIST(1)'
+    script += '"\n'
+
+    script += 'query coo '
+    script += '%f' % ra           # append "a_ra" (decimal degree)
+    script += ' '
+    script += '%f' % dec          # append "a_dec" (decimal degree)
+    script += ' radius='
+    script += '%f' % radius       # append "a_radius" (decimal degree)
+    script += 'd'                  # d,m,s
+    script += ' frame=FK5 epoch=J2000 equinox=2000' # fk5
+    script += '\n'
+
+    return script
+
+
+def make_req(ra, dec, radius):
+    """
+    Build a request tu the Simbad server
+    :param ra: floating point value of the RA coordinate
+    :param dec: floating point value of the DEC coordinate
+    :param radius: floting value of the acceptance radius (degrees)
+    :return: request text
+    """
+    # WGET with the "request" string built as below :
+
+    script = encode_script(make_script(ra, dec, radius))
 
-def get_objects(ra, dec, radius):
+    request = 'http://' + SIMBAD_HOST + '/simbad/sim-script?'
+    request += 'script=' + script + '&'
+
+    return request
+
+
+def encode_script(script):
     """
-    Request from the Simbad server a list of astro objects at the
-    RA DEC position, within the specified acceptance cone
-    :param ra: the RA floating point coordinate
-    :param dec: the DEC floating point coordinate
-    :param radius: the acceptance angle in degree
-    :return: a dictionary of identified objects {objectname: objecttype}
+    Convert the special characters of a script for an url
+    :param script: script text
+    :return: encoded text
+    """
+    def crep(txt, char):
+        ''' substitute characters in a string
+        :param txt:
+        :param char:
+        :return:
+        '''
+        txt = txt.replace(char, '%%%02X' % ord(char))
+        return txt
+
+    # "special characters" converted to "%02X" format :
+    script = crep(script, '%')
+    script = crep(script, '+')
+    script = crep(script, '=')
+    script = crep(script, ';')
+    script = crep(script, '"')
+    script = crep(script, '#')
+    script = crep(script, '&')
+    script = crep(script, ' ')                # same as upper line.
+
+    script = script.replace('\n', '%0D%0A')    # CR+LF
+    script = crep(script, '\t')
+
+    return script
+
+
+def make_batch_script(positions, radius):
     """
+    Build the script of many cone requests, the objects of each one
+    being preceded in the answer by the line '#cone <index>'
+    :param positions: list of (RA, DEC) in degree
+    :param radius: floating value of the acceptance radius (degrees)
+    :return: script text
+    """
+    lines = [make_script(0., 0., radius).split('\n')[0] + '\n'] # output format
+    for index, (ra, dec) in enumerate(positions):
+        lines.append('echodata %s %d\n' % (CONE_MARKER, index))
+        lines.append(make_script(ra, dec, radius).split('\n', 1)[1])
+    return ''.join(lines)
 
-    def make_req(ra, dec, radius):
-        """
-        Build a request tu the Simbad server
-        :param ra: floating point value of the RA coordinate
-        :param dec: floating point value of the DEC coordinate
-        :param radius: floting value of the acceptance radius (degrees)
-        :return: request text
-        """
-        def crep(txt, char):
-            ''' substitute characters in a string
-            :param txt:
-            :param char:
-            :return:
-            '''
-            txt = txt.replace(char, '%%%02X' % ord(char))
-            return txt
-
-        host_simbad = 'simbad.u-strasbg.fr'
-        #port = 80
-
-        # WGET with the "request" string built as below :
-
-        script = ''
-        # output format (for what comes from SIMBAD)
-        script += 'format object f1 "'
-        script += '%COO(A)'            # hour:minute:second
-        script += '\t%COO(D)'          # degree:arcmin:arcsec
-        script += '\t%OTYPE(S)'
-        script += '\t%IDLIST(1)'
-        script += '"\n'
-
-        script += 'query coo '
-        script += '%f' % ra           # append "a_ra" (decimal degree)
-        script += ' '
-        script += '%f' % dec          # append "a_dec" (decimal degree)
-        script += ' radius='
-        script += '%f' % radius       # append "a_radius" (decimal degree)
-        script += 'd'                  # d,m,s
-        script += ' frame=FK5 epoch=J2000 equinox=2000' # fk5
-        script += '\n'
-
-        # "special characters" converted to "%02X" format :
-        script = crep(script, '%')
-        script = crep(script, '+')
-        script = crep(script, '=')
-        script = crep(script, ';')
-        script = crep(script, '"')
-        script = crep(script, ' ')                # same as upper line.
-
-        script = script.replace('\n', '%0D%0A')    # CR+LF
-        script = crep(script, '\t')
-
-        request = 'http://' + host_simbad + '/simbad/sim-script?'
-        request += 'script=' + script + '&'
-
-        return request
-
-    def wget(req):
-        '''get information from some http server'''
-        def send(url):
-            '''
-            send utility
-            :param url:
-            :return:
-            '''
-            retry = 0
-            while retry < 10:
-                try:
-                    req = urllib2.urlopen(url)
-                    # pylint: disable=broad-except
-                    try:
-                        # resp = opener.open(req)
-                        txt = req.read()
-                        lines = txt.split('<BR>\n')
-                        return lines[0]
-                    except Exception:
-                        print 'cannot read'
-                    except:
-                        raise
-
-                except urllib2.HTTPError:
-                    retry += 1
-                    time.sleep(0.2)
-                    # print 'url=[%s]' % url
-                    # print e.fp.read()
-                except:
-                    raise
-            print retry
-
-        out = send(req)
-
-        return out
-
-    req = make_req(ra, dec, radius)
-    out = wget(req)
+
+def wget(req, data=None):
+    '''get information from some http server (POST if there is data)'''
+    txt = SIMBAD_CLIENT.fetch(req, data)
+    lines = txt.split('<BR>\n')
+    return lines[0]
+
+
+def parse_objects(out):
+    """
+    Extract the data lines of a Simbad answer
+    :param out: text of the answer
+    :return: list of the fields of each data line
+             [RA, DEC, object type, object name]
+    """
     out = out.split('\n')
     in_data = False
 
-    objects = dict()
+    rows = []
 
     for line in out:
         line = line.strip()
@@ -186,7 +330,254 @@ def get_objects(ra, dec, radius):
 
         data = line.split('\t')
 
-        objects[data[3].strip()] = data[2].strip()
+        rows.append([field.strip() for field in data])
+
+    return rows
+
+
+def parse_batch(out, count):
+    """
+    Split the answer to a script of many cone requests, line after
+    line, into the data lines of each request
+    :param out: text of the answer
+    :param count: number of cone requests of the script
+    :return: iterator over the lists of the fields of the data lines
+             of each request, in the order of the requests
+    """
+    in_data = False
+    answered, rows = 0, None # number of markers met, data lines of the last one
+    for line in io.BytesIO(out):
+        line = line.strip()
+        if not in_data:
+            in_data = line == '::data'+':'*74
+            continue
+        if line == '':
+            continue
+        if line.startswith('::'): # next section
+            break
+        if line.startswith(CONE_MARKER + ' '):
+            # The answers must come in the order of the requests,
+            # else they would be given to the wrong positions
+            if line.split()[1] != str(answered):
+                raise simbad_client.SimbadError('cone marker %r instead of %s %d' % \
+                                                (line, CONE_MARKER, answered))
+            if rows is not None:
+                yield rows
+            answered, rows = answered + 1, []
+            continue
+        if rows is None:
+            raise simbad_client.SimbadError('data line before the first cone marker')
+        rows.append([field.strip() for field in line.split('\t')])
+    if rows is not None:
+        yield rows
+    if answered != count:
+        raise simbad_client.SimbadError('%d cone requests answered out of %d' % \
+                                        (answered, count))
+
+
+def format_answer(rows):
+    """
+    Write data lines as the answer to a single cone request,
+    which parse_objects reads back
+    :param rows: list of the fields of the data lines
+    :return: text of the answer
+    """
+    return '::data' + ':'*74 + '\n\n' + \
+           ''.join('\t'.join(fields) + '\n' for fields in rows)
+
+
+def use_simbad_cache(directory, ttl=30*24*3600, max_bytes=100*1024*1024, \
+                     offline=False):
+    """
+    Keep the answers of the Simbad server in a persistent cache
+    :param directory: directory of the cache
+    :param ttl: time to live of an answer in seconds
+    :param max_bytes: maximum size of the cache
+    :param offline: if True, answers are only served from the cache
+    :return: the diskcache.DiskCache instance (None removes the cache)
+    """
+    global SIMBAD_CACHE # pylint: disable=global-statement
+    if directory is None:
+        SIMBAD_CACHE = None
+    else:
+        SIMBAD_CACHE = diskcache.DiskCache(directory, ttl=ttl, \
+                                           max_bytes=max_bytes, offline=offline)
+    return SIMBAD_CACHE
+
+
+def use_reference(path):
+    """
+    Answer the cone requests from a local reference catalog
+    instead of the Simbad server
+    :param path: file of the catalog, see refcatalog.load (None to use Simbad again)
+    :return: the refcatalog.ReferenceCatalog instance
+    """
+    global REFERENCE_CATALOG # pylint: disable=global-statement
+    if path is None:
+        REFERENCE_CATALOG = None
+    else:
+        import refcatalog # imports this module
+        REFERENCE_CATALOG = refcatalog.load(path)
+    return REFERENCE_CATALOG
+
+
+@metrics.timed('simbad')
+def fetch_objects(ra, dec, radius):
+    """
+    Get the answer of the Simbad server for a cone request,
+    from the cache when it is possible
+    :param ra: the RA floating point coordinate
+    :param dec: the DEC floating point coordinate
+    :param radius: the acceptance angle in degree
+    :return: text of the answer
+    """
+    # Quantize the position so that close requests share the same answer
+    quantized = [int(round(value / SIMBAD_QUANTUM)) for value in (ra, dec, radius)]
+    ra, dec, radius = [value * SIMBAD_QUANTUM for value in quantized]
+
+    cache = SIMBAD_CACHE
+    if cache is None:
+        return wget(make_req(ra, dec, radius))
+
+    key = diskcache.make_key(SIMBAD_HOST, *(quantized + [make_script(ra, dec, radius)]))
+    out = cache.get(key)
+    metrics.count('simbad_cache_hits' if out is not None else 'simbad_cache_misses')
+    if out is None:
+        if cache.offline:
+            raise IOError('offline: no cached Simbad answer for ' \
+                          'ra=%f dec=%f radius=%f' % (ra, dec, radius))
+        out = wget(make_req(ra, dec, radius))
+        cache.put(key, out)
+    return out
+
+
+def send_batch(positions, radius):
+    """
+    Send many cone requests to the Simbad server, cut into scripts
+    of at most SIMBAD_BATCH_SIZE requests and SIMBAD_MAX_BYTES bytes
+    sent at the same time
+    :param positions: list of quantized (RA, DEC) in degree
+    :param radius: the acceptance angle in degree
+    :return: list of the answers to each request, see format_answer
+    """
+    # Cut the requests into scripts small enough
+    chunks, chunk, size = [], [], 0
+    for position in positions:
+        query = len(encode_script(make_batch_script([position], radius)))
+        if chunk and (len(chunk) == SIMBAD_BATCH_SIZE or size + query > SIMBAD_MAX_BYTES):
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(position)
+        size += query
+    if chunk:
+        chunks.append(chunk)
+
+    def send(chunk):
+        """
+        Send a script and split its answer
+        """
+        metrics.count('simbad_batch_requests')
+        out = wget('http://' + SIMBAD_HOST + '/simbad/sim-script', \
+                   'script=' + encode_script(make_batch_script(chunk, radius)))
+        return [format_answer(rows) for rows in parse_batch(out, len(chunk))]
+
+    return [out for answers in SIMBAD_CLIENT.map(send, chunks) for out in answers]
+
+
+@metrics.timed('simbad')
+def fetch_objects_many(positions, radius):
+    """
+    Get the answers of the Simbad server for many cone requests,
+    from the cache when it is possible, the other ones being sent
+    together (see send_batch)
+    :param positions: list of (RA, DEC) in degree
+    :param radius: the acceptance angle in degree
+    :return: list of the texts of the answers, read by parse_objects
+    """
+    # Quantize the positions so that close requests share the same answer
+    quantized = [[int(round(value / SIMBAD_QUANTUM)) for value in (ra, dec, radius)] \
+                 for ra, dec in positions]
+    positions = [(ra * SIMBAD_QUANTUM, dec * SIMBAD_QUANTUM) for ra, dec, _ in quantized]
+    radius = int(round(radius / SIMBAD_QUANTUM)) * SIMBAD_QUANTUM
+
+    cache = SIMBAD_CACHE
+    answers = [None] * len(positions)
+    if cache is not None:
+        keys = [diskcache.make_key(SIMBAD_HOST, *(quantum + [make_script(ra, dec, radius)])) \
+                for quantum, (ra, dec) in zip(quantized, positions)]
+        answers = [cache.get(key) for key in keys]
+        hits = sum(out is not None for out in answers)
+        metrics.count('simbad_cache_hits', hits)
+        metrics.count('simbad_cache_misses', len(answers) - hits)
+
+    # Send the missing requests, each position once
+    missing = sorted(set(positions[i] for i, out in enumerate(answers) if out is None))
+    if missing and cache is not None and cache.offline:
+        raise IOError('offline: no cached Simbad answer for %d positions ' \
+                      'such as ra=%f dec=%f radius=%f' % \
+                      (len(missing), missing[0][0], missing[0][1], radius))
+    sent = dict(zip(missing, send_batch(missing, radius))) if missing else {}
+    for i, position in enumerate(positions):
+        if answers[i] is None:
+            answers[i] = sent[position]
+            if cache is not None:
+                cache.put(keys[i], answers[i])
+    return answers
+
+
+def get_objects_many(positions, radius):
+    """
+    Same as get_objects for many positions, with as few requests
+    to the Simbad server as possible
+    :param positions: list of (RA, DEC) in degree
+    :param radius: the acceptance angle in degree
+    :return: list of dictionaries of identified objects {objectname: objecttype}
+    """
+    if REFERENCE_CATALOG is not None:
+        return [REFERENCE_CATALOG.objects(ra, dec, radius) for ra, dec in positions]
+
+    return [dict((data[3], data[2]) for data in parse_objects(out)) \
+            for out in fetch_objects_many(positions, radius)]
+
+
+def get_objects(ra, dec, radius):
+    """
+    Request from the Simbad server a list of astro objects at the
+    RA DEC position, within the specified acceptance cone
+    :param ra: the RA floating point coordinate
+    :param dec: the DEC floating point coordinate
+    :param radius: the acceptance angle in degree
+    :return: a dictionary of identified objects {objectname: objecttype}
+    """
+    if REFERENCE_CATALOG is not None:
+        return REFERENCE_CATALOG.objects(ra, dec, radius)
+
+    out = fetch_objects(ra, dec, radius)
+
+    objects = dict()
+
+    for data in parse_objects(out):
+        objects[data[3]] = data[2]
 
     return objects
 
+
+def get_objects_positions(ra, dec, radius):
+    """
+    Request from the Simbad server the astro objects at the
+    RA DEC position, within the specified acceptance cone,
+    together with their own coordinates
+    :param ra: the RA floating point coordinate
+    :param dec: the DEC floating point coordinate
+    :param radius: the acceptance angle in degree
+    :return: a list of tuples (objectname, objecttype, RA, DEC)
+    """
+    if REFERENCE_CATALOG is not None:
+        return REFERENCE_CATALOG.positions(ra, dec, radius)
+
+    out = fetch_objects(ra, dec, radius)
+
+    return [(data[3], data[2], \
+             sexagesimal_to_degrees(data[0], hours=True), \
+             sexagesimal_to_degrees(data[1])) \
+            for data in parse_objects(out)]
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which measures where the time of a run goes: the stages of
+mylib, streaming and library are timed (wall clock and CPU time) and
+count what they process (pixels, clusters, HTTP requests, cache hits).
+Nothing is recorded unless a collection is active in the thread:
+
+    with metrics.collect() as stats:
+        cluster_array = mylib.get_cluster_array(...)
+    print stats.as_dict()
+
+A collection only records the measures of the thread which opened it;
+the threads working for it record in it too inside metrics.attach.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+LOCK = threading.Lock()
+LOCAL = threading.local() # attribute collectors: active Stats of the thread
+RUNNING = 0 # number of collections open in the process
+LOG_PATH = None # JSON lines file receiving every finished collection
+
+# CPU time of the calling thread only (RUSAGE_THREAD is 1 on Linux,
+# where the resource module of Python 2 does not name it)
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', \
+                        1 if sys.platform.startswith('linux') else resource.RUSAGE_SELF)
+
+def cpu_time():
+    """
+    CPU time (user and system) of the calling thread, in seconds
+    (of the whole process where it is not available)
+    """
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_memory():
+    """
+    Peak resident memory of the process since the last
+    reset_peak_memory, in bytes
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return 1024 * int(line.split()[1])
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else 1024 * peak # kB on Linux
+
+def resident_memory():
+    """
+    Current resident memory of the process, in bytes
+    (the peak one where it is not available)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return peak_memory()
+
+def reset_peak_memory():
+    """
+    Start the peak resident memory again from the current one,
+    where the system allows it (Linux)
+    :return: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except IOError:
+        return False
+
+def active():
+    """
+    Return the collections recording the measures of the calling thread
+    """
+    return getattr(LOCAL, 'collectors', [])
+
+@contextlib.contextmanager
+def attach(collectors):
+    """
+    Record the measures of the calling thread in collections opened
+    by another thread, e.g. the one which gave it some work
+    :param collectors: list given by active() in the other thread
+    """
+    previous = active()
+    LOCAL.collectors = previous + [stats for stats in collectors if stats not in previous]
+    try:
+        yield
+    finally:
+        LOCAL.collectors = previous
+
+class Stats(object):
+    """
+    Class which holds the measures of a collection:
+    - timers: for each stage, the number of calls, the wall clock
+      and the CPU time of the thread running it
+    - counters: number of pixels scanned, clusters found,
+      HTTP requests, retries, cache hits...
+    - peak memory of the process during the collection, and its
+      increase over the memory used when the collection started
+      (exact on Linux when no other collection is open in the
+      process, an upper bound else)
+    """
+
+    def __init__(self, label=None):
+        """
+        Constructor of Stats
+        :param label: name of the collection, written in the log
+        """
+        self.label = label
+        self.timers = {}
+        self.counters = {}
+        self.peak_memory = 0
+        self.memory_delta = 0
+        self.wall = 0.
+        self.cpu = 0.
+
+    def add_time(self, stage, wall, cpu):
+        """
+        Record a call of a stage
+        """
+        timer = self.timers.setdefault(stage, {'calls': 0, 'wall': 0., 'cpu': 0.})
+        timer['calls'] += 1
+        timer['wall'] += wall
+        timer['cpu'] += cpu
+
+    def add_count(self, name, value):
+        """
+        Increase a counter
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        """
+        Return the measures as a dictionary of plain values
+        """
+        return {'label': self.label, 'wall': self.wall, 'cpu': self.cpu, \
+                'peak_memory': self.peak_memory, 'memory_delta': self.memory_delta, \
+                'timers': {stage: dict(timer) for stage, timer in self.timers.items()}, \
+                'counters': dict(self.counters)}
+
+    def merge(self, other):
+        """
+        Add the measures of another collection (e.g. of another process)
+        :param other: Stats or dictionary given by as_dict
+        """
+        if isinstance(other, Stats):
+            other = other.as_dict()
+        for stage, timer in other['timers'].items():
+            mine = self.timers.setdefault(stage, {'calls': 0, 'wall': 0., 'cpu': 0.})
+            for name in ('calls', 'wall', 'cpu'):
+                mine[name] += timer[name]
+        for name, value in other['counters'].items():
+            self.add_count(name, value)
+        self.peak_memory = max(self.peak_memory, other['peak_memory'])
+        self.memory_delta = max(self.memory_delta, other.get('memory_delta', 0))
+
+    def summary(self):
+        """
+        Return a table of the stages and the counters
+        """
+        lines = ['%-24s %6s %10s %10s' % ('stage', 'calls', 'wall (ms)', 'cpu (ms)')]
+        for stage in sorted(self.timers, key=lambda name: -self.timers[name]['wall']):
+            timer = self.timers[stage]
+            lines.append('%-24s %6d %10.2f %10.2f' % \
+                         (stage, timer['calls'], 1e3 * timer['wall'], 1e3 * timer['cpu']))
+        for name in sorted(self.counters):
+            lines.append('%-24s %s' % (name, self.counters[name]))
+        lines.append('%-24s %.1f MB' % ('peak memory', self.peak_memory / 2.**20))
+        lines.append('%-24s %.1f MB' % ('memory delta', self.memory_delta / 2.**20))
+        return '\n'.join(lines)
+
+def enabled():
+    """
+    Check whether a collection is active in the calling thread
+    """
+    return len(active()) != 0
+
+def count(name, value=1):
+    """
+    Increase a counter of the active collections
+    """
+    collectors = active()
+    if not collectors:
+        return
+    with LOCK:
+        for stats in collectors:
+            stats.add_count(name, value)
+
+@contextlib.contextmanager
+def timer(stage):
+    """
+    Time the block under it as a call of stage
+    """
+    collectors = active()
+    if not collectors:
+        yield
+        return
+    wall, cpu = time.time(), cpu_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.time() - wall, cpu_time() - cpu
+        with LOCK:
+            for stats in collectors:
+                stats.add_time(stage, wall, cpu)
+
+def timed(stage):
+    """
+    Decorator timing every call of a function as a call of stage
+    """
+    def decorator(function):
+        """
+        Wrap function
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            """
+            Call function under a timer
+            """
+            if not active():
+                return function(*args, **kwargs)
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextlib.contextmanager
+def collect(label=None):
+    """
+    Record the measures of the block under it, in the calling thread
+    :param label: name of the collection, written in the log
+    :return: Stats filled when the block ends
+    """
+    global RUNNING # pylint: disable=global-statement
+    stats = Stats(label)
+    with LOCK:
+        if RUNNING == 0: # the peak of an open collection is kept
+            reset_peak_memory()
+        RUNNING += 1
+    resident = resident_memory()
+    collectors = active()
+    LOCAL.collectors = collectors + [stats]
+    wall, cpu = time.time(), cpu_time()
+    try:
+        yield stats
+    finally:
+        stats.wall, stats.cpu = time.time() - wall, cpu_time() - cpu
+        stats.peak_memory = peak_memory()
+        stats.memory_delta = max(stats.peak_memory - resident, 0)
+        LOCAL.collectors = collectors
+        with LOCK:
+            RUNNING -= 1
+        if LOG_PATH is not None:
+            write_log(stats)
+
+def set_log(path):
+    """
+    Append every finished collection to a JSON lines file
+    :param path: path of the file (None to stop logging)
+    """
+    global LOG_PATH # pylint: disable=global-statement
+    LOG_PATH = path
+
+def write_log(stats, path=None):
+    """
+    Append a collection to the log as a single JSON line
+    :param stats: Stats or dictionary given by as_dict
+    :param path: path of the file (default: the one given to set_log)
+    """
+    record = stats.as_dict() if isinstance(stats, Stats) else dict(stats)
+    record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    record['pid'] = os.getpid()
+    with LOCK:
+        with open(path or LOG_PATH, 'a') as log_file:
+            log_file.write(json.dumps(record, sort_keys=True) + '\n')
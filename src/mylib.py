@@ -3,27 +3,42 @@
 
 """
 Module which contains tools for the five exercises
+(scipy is imported by the functions which need it, so that
+reading a picture does not load it)
 """
 
 import math
-from astropy.io import fits
 import numpy as np
-# pylint: disable=E
-from scipy.optimize import curve_fit
-from cluster import Cluster
+from cluster import choose_star_name
+import catalog
+import fitsimage
+import library
+import metrics
 
+def open_image(path):
+    """
+    Open a fits file without reading its picture
+    :param path: path of the fits file
+    :return: fitsimage.FitsImage giving access to sections of the picture
+    """
+    return fitsimage.FitsImage(path)
+
+@metrics.timed('read')
 def get_pixels(path):
     """
     Get a numpy.ndarray corresponding to data
     and an astropy.io.fits.header.Header giving other informations
     from a fits file located at 'path'
+    (the array is memory mapped: only the pixels used are read)
     """
     try:
-        with fits.open(path) as fits_data:
-            return fits_data[0].data, fits_data[0].header
+        image = open_image(path)
     except IOError:
         print 'cannot open', path
         return None, None
+    pixels = image.data
+    image.close()
+    return pixels, image.header
 
 def modelling_function(xvalue, maximum, mean, disp):
     """
@@ -37,6 +52,7 @@ def modelling_function(xvalue, maximum, mean, disp):
     # pylint: disable=E
     return maximum*np.exp(-1./2*(xvalue-mean)*(xvalue-mean)/disp/disp)
 
+@metrics.timed('background_fit')
 def modelling_parameters(pixels):
     """
     Function that takes a 2D array and returns the fit parameters
@@ -47,6 +63,15 @@ def modelling_parameters(pixels):
     # pylint: disable=E
     bin_values, bin_boundaries = np.histogram(pixels.ravel(), 200)
 
+    return fit_histogram(bin_values, bin_boundaries)
+
+def fit_histogram(bin_values, bin_boundaries):
+    """
+    Function that fits a pixel distribution with the modelling function
+    :param bin_values: number of pixels in each bin
+    :param bin_boundaries: boundaries of the bins
+    :return: data values and fitted values
+    """
     # Normalize the distribution for the gaussian fit
     max_y = np.float(np.max(bin_values))
     normal_y = bin_values/max_y
@@ -55,6 +80,7 @@ def modelling_parameters(pixels):
 
     # Fit the data with the gaussian modelling function
     # and rescale the parameters
+    from scipy.optimize import curve_fit # pylint: disable=E
     fit, _ = curve_fit(modelling_function, normal_x, normal_y)
     maxvalue = fit[0] * max_y
     background = fit[1] * max_x
@@ -65,13 +91,14 @@ def modelling_parameters(pixels):
 
     return x_values, y_values, maxvalue, background, dispersion
 
+@metrics.timed('remove_background')
 def remove_background(pixels, background, dispersion, threshold=None):
     """
     Remove the background from the picture
     :param pixels: 2D array corresponding to the picture
-    :param background: mean background value
-    :param dispersion: dispersion of the background
-    :param threshold: set another value for the threshold
+    :param background: mean background value (or 2D map)
+    :param dispersion: dispersion of the background (or 2D map)
+    :param threshold: set another value (or 2D map) for the threshold
     :return: 2D array in which the backgroud has been removed
     """
     if threshold is None: # if the threshold is not already defined
@@ -79,40 +106,271 @@ def remove_background(pixels, background, dispersion, threshold=None):
     above = pixels >= threshold
     return above * (pixels - background)
 
-def get_cluster_array(pixels, background, dispersion, threshold=None, my_wcs=None):
+def cluster_sums(pixels, labels, nlabels, background=0., row_offset=0):
+    """
+    Accumulate in one pass over the labelled pixels the sums and
+    extrema from which the statistics of every label are derived
+    :param pixels: 2D array corresponding to the picture
+    :param labels: 2D array of labels, 0 being the background,
+                   every label from 1 to nlabels being present
+    :param nlabels: number of labels
+    :param background: value (or 2D map) subtracted from the pixels to get the flux
+    :param row_offset: row of the picture corresponding to the first row
+    :return: dictionary of 1D arrays indexed by label - 1
+    """
+    # Keep only the labelled pixels
+    flat_labels = labels.ravel()
+    index = np.flatnonzero(flat_labels)
+    if np.ndim(background) != 0: # background map
+        background = np.broadcast_to(background, labels.shape).ravel()[index]
+    return pixel_sums(pixels.ravel()[index], index // labels.shape[1] + row_offset, \
+                      index % labels.shape[1], flat_labels[index], nlabels, background)
+
+def pixel_sums(values, rows, columns, label_values, nlabels, background=0.):
+    """
+    Same as cluster_sums on the labelled pixels only
+    :param values: 1D array of the values of the pixels
+    :param rows: 1D array of the rows of the pixels
+    :param columns: 1D array of the columns of the pixels
+    :param label_values: 1D array of the labels (from 1 to nlabels)
+                         of the pixels, the peak of a label being
+                         the last of its highest pixels
+    :param nlabels: number of labels
+    :param background: value (or 1D array) subtracted from the pixels to get the flux
+    :return: dictionary of 1D arrays indexed by label - 1
+    """
+    values = values.astype(np.float64)
+    weights = np.maximum(values - background, 0.)
+
+    # Extrema over the pixels of each label: sort the pixels by label
+    # (then by value, so that the peak is the last pixel of each label)
+    sums = {}
+    order = np.lexsort((values, label_values))
+    sorted_labels = label_values[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])[:nlabels]
+    ends = np.append(starts[1:], len(order))[:nlabels] - 1
+    for name, coordinates in (('x', columns[order]), ('y', rows[order])):
+        if nlabels == 0:
+            sums[name + 'min'] = sums[name + 'max'] = coordinates
+            continue
+        sums[name + 'min'] = np.minimum.reduceat(coordinates, starts)
+        sums[name + 'max'] = np.maximum.reduceat(coordinates, starts)
+    sums['peak'] = values[order][ends]
+    sums['xpeak'] = columns[order][ends]
+    sums['ypeak'] = rows[order][ends]
+
+    # Sums over the pixels of each label, the positions being taken from
+    # the corner (xmin, ymin) of the bounding box so that the second
+    # moments do not lose their precision far from the origin
+    def total(terms):
+        """ sum of terms for each label """
+        return np.bincount(label_values, weights=terms, minlength=nlabels + 1)[1:]
+    x = (columns - sums['xmin'][label_values - 1]).astype(np.float64)
+    y = (rows - sums['ymin'][label_values - 1]).astype(np.float64)
+    sums.update({'npix': np.bincount(label_values, minlength=nlabels + 1)[1:], \
+                 'luminosity': total(values), 'flux': total(weights), \
+                 'sum_x': total(weights * x), 'sum_y': total(weights * y), \
+                 'sum_xx': total(weights * x * x), 'sum_yy': total(weights * y * y), \
+                 'sum_xy': total(weights * x * y)})
+    return sums
+
+def cluster_moments(sums):
+    """
+    Derive the statistics of every label from their sums
+    :param sums: dictionary given by cluster_sums (the sums of the
+                 positions being relative to the corner (xmin, ymin))
+    :return: dictionary of 1D arrays indexed by label - 1:
+             npix, luminosity (sum of the pixels), flux (sum over the
+             background), bounding box, peak value and position,
+             flux-weighted centroid (xcen, ycen), second moments
+             (x2, y2, xy), size, ellipticity and position angle theta
+    """
+    stats = dict(sums)
+
+    # Flux-weighted centroid, the center of the bounding box being
+    # kept when there is no flux above the background
+    flux = sums['flux']
+    weighted = flux > 0
+    safe_flux = np.where(weighted, flux, 1.)
+    xcen = np.where(weighted, sums['sum_x'] / safe_flux, (sums['xmax'] - sums['xmin']) / 2.)
+    ycen = np.where(weighted, sums['sum_y'] / safe_flux, (sums['ymax'] - sums['ymin']) / 2.)
+    stats['xcen'] = sums['xmin'] + xcen
+    stats['ycen'] = sums['ymin'] + ycen
+
+    # Second moments and the ellipse they describe, from the sums
+    # relative to the corner of the bounding box
+    x2 = np.where(weighted, sums['sum_xx'] / safe_flux - xcen**2, 0.)
+    y2 = np.where(weighted, sums['sum_yy'] / safe_flux - ycen**2, 0.)
+    xy = np.where(weighted, sums['sum_xy'] / safe_flux - xcen * ycen, 0.)
+    x2, y2 = np.maximum(x2, 0.), np.maximum(y2, 0.)
+
+    # Differences below the rounding errors of the sums are meaningless
+    # (they would give a random angle to round clusters)
+    tolerance = 1e-12 * (x2 + y2)
+    xy = np.where(np.abs(xy) <= tolerance, 0., xy)
+    x2_y2 = np.where(np.abs(x2 - y2) <= tolerance, 0., x2 - y2)
+    half_sum = (x2 + y2) / 2.
+    half_diff = np.sqrt((x2_y2 / 2.)**2 + xy**2)
+    major = np.sqrt(half_sum + half_diff)
+    minor = np.sqrt(np.maximum(half_sum - half_diff, 0.))
+    stats['x2'], stats['y2'], stats['xy'] = x2, y2, xy
+    stats['size'] = np.sqrt(major * minor)
+    stats['ellipticity'] = np.where(major > 0, 1. - minor / np.where(major > 0, major, 1.), 0.)
+    stats['theta'] = np.degrees(0.5 * np.arctan2(2. * xy, x2_y2))
+
+    for name in ('sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy'):
+        del stats[name]
+    return stats
+
+def cluster_statistics(pixels, labels, nlabels, background=0.):
+    """
+    Compute the statistics of every labelled cluster at once
+    :param pixels: 2D array corresponding to the picture
+    :param labels: 2D array of labels, 0 being the background
+    :param nlabels: number of labels
+    :param background: value subtracted from the pixels to get the flux
+    :return: dictionary of 1D arrays indexed by label - 1,
+             see cluster_moments
+    """
+    stats = cluster_moments(cluster_sums(pixels, labels, nlabels, background))
+    if np.issubdtype(pixels.dtype, np.integer):
+        stats['luminosity'] = np.rint(stats['luminosity']).astype(np.int64)
+    return stats
+
+@metrics.timed('labelling')
+def label_clusters(pixels, threshold, background=0.):
+    """
+    Label the clusters of contiguous pixels above the threshold,
+    pixels being contiguous through their four sides.
+    Labels are numbered from 1 in the order in which the first pixel
+    of each cluster is met when scanning the picture row by row
+    :param pixels: 2D array corresponding to the picture
+    :param threshold: allows to discriminate pixels (value or 2D map)
+    :param background: value (or 2D map) subtracted from the pixels to get the flux
+    :return: int32 2D array of labels (0 for the background)
+             and the dictionary of statistics of each label
+    """
+    from scipy import ndimage # pylint: disable=E
+    labels = np.zeros(pixels.shape, dtype=np.int32)
+    nlabels = ndimage.label(pixels >= threshold, output=labels)
+    metrics.count('pixels_scanned', pixels.size)
+    metrics.count('clusters_found', nlabels)
+    return labels, cluster_statistics(pixels, labels, nlabels, background)
+
+def find_star_name(ra, dec, radius=0.003):
+    """
+    Find the name of the celestial object at a WCS position
+    with a cone request to Simbad
+    :param ra: RA of the position (degree)
+    :param dec: DEC of the position (degree)
+    :param radius: acceptance angle (degree)
+    :return: name of the celestial object
     """
-    Find the list of clusters in the picture pixels
+    return choose_star_name(library.get_objects(ra, dec, radius))
+
+@metrics.timed('field_names')
+def find_star_names(cluster_array, my_wcs, shape, radius=0.003):
+    """
+    Find the names of all the clusters with a single Simbad request
+    covering the whole picture, each centroid being then matched
+    locally with the objects closer than radius
+    :param cluster_array: catalog.Catalog whose ra and dec columns are known
+    :param my_wcs: WCS conversion object of the picture
+    :param shape: shape of the picture
+    :param radius: acceptance angle around each centroid (degree)
+    """
+    if len(cluster_array) == 0:
+        return
+
+    # A local reference catalog names all the clusters at once
+    if library.REFERENCE_CATALOG is not None:
+        cluster_array['name'] = library.REFERENCE_CATALOG.star_names( \
+            cluster_array['ra'], cluster_array['dec'], radius)
+        return
+
+    # Get all the objects of the field, with a margin for the border clusters
+    center_ra, center_dec, field_radius = my_wcs.field_cone(shape)
+    field_objects = library.get_objects_positions(center_ra, center_dec, \
+                                                  field_radius + radius)
+
+    # Match the centroids with the objects through their unit vectors
+    centroids = library.sky_vectors(cluster_array['ra'], cluster_array['dec'])
+    matches = [[] for _ in range(len(cluster_array))]
+    if field_objects:
+        from scipy.spatial import cKDTree # pylint: disable=E
+        tree = cKDTree(library.sky_vectors([obj[2] for obj in field_objects], \
+                                           [obj[3] for obj in field_objects]))
+        matches = tree.query_ball_point(centroids, library.chord_length(radius))
+
+    # Apply the same naming rule as for a cone request per cluster
+    cluster_array['name'] = [choose_star_name({field_objects[i][0]: field_objects[i][1] \
+                                               for i in indices}) \
+                             for indices in matches]
+
+# pylint: disable=too-many-arguments
+def get_cluster_array(pixels, background, dispersion, threshold=None, my_wcs=None, \
+                      field_query=False):
+    """
+    Find the clusters in the picture pixels
     according to a threshold defines with background and dispersion
     :param pixels: 2D array corresponding to the picture
-    :param background: mean background value
-    :param dispersion: dispersion of the background
-    :return: list of clusters found in the picture pixels
+    :param background: mean background value (or 2D map)
+    :param dispersion: dispersion of the background (or 2D map)
+    :param threshold: set another value (or 2D map) for the threshold
+    :param field_query: if True, find the star names with a single
+                        request covering the picture instead of one
+                        request per cluster
+    :return: catalog.Catalog of the clusters found in the picture pixels
     """
 
-    # Initiate some variables before looping over all pixels
+    # Label all the clusters in one pass
     if threshold is None:
         threshold = background + 6.0 * dispersion # threshold value
-    marks = np.zeros(pixels.shape) # to mark each pixels
-    n_row, n_column = pixels.shape
-    cluster_array = [] # will contain instances of the class Cluster
-
-    # Loop over pixels and add clusters in cluster_array
-    for i in range(n_row):
-        for j in range(n_column):
-            if marks[i][j] != 1: # if the pixel is not marked
-                marks[i][j] = 1 # mark it
-                if pixels[i][j] >= threshold: # if luminosity > threshold
-                    clust = Cluster()
-                    clust.recursive_exploration(i, j, pixels, marks, threshold)
-                    if my_wcs != None:
-                        clust.find_centroid(my_wcs=my_wcs)
-                    else:
-                        clust.find_centroid()
-                    cluster_array.append(clust)
-
-    # Return the array of clusters
+    _, stats = label_clusters(pixels, threshold, background)
+    cluster_array = catalog.from_statistics(stats)
+
+    # If asked, convert all the centroids in one call
+    # and search for the star names
+    if my_wcs != None:
+        convert_clusters(cluster_array, my_wcs)
+        name_clusters(cluster_array, my_wcs, pixels.shape, field_query)
+
+    # Return the catalog of clusters
     return cluster_array
 
+@metrics.timed('wcs')
+def convert_clusters(cluster_array, my_wcs):
+    """
+    Fill the celestial coordinates of the clusters in one call
+    :param cluster_array: catalog.Catalog of the clusters
+    :param my_wcs: library.WCS of the picture
+    """
+    if len(cluster_array) != 0:
+        cluster_array['ra'], cluster_array['dec'] = \
+            my_wcs.convert_many(cluster_array['x'], cluster_array['y'])
+
+@metrics.timed('names')
+def name_clusters(cluster_array, my_wcs, shape, field_query=False):
+    """
+    Fill the star names of the clusters whose coordinates are known
+    :param cluster_array: catalog.Catalog of the clusters
+    :param my_wcs: library.WCS of the picture
+    :param shape: shape of the picture
+    :param field_query: if True, a single request covers the picture
+                        (always the case with a reference catalog),
+                        else the cone requests of the clusters are
+                        sent together in a few scripts
+    """
+    if len(cluster_array) == 0:
+        return
+    if field_query or library.REFERENCE_CATALOG is not None:
+        find_star_names(cluster_array, my_wcs, shape)
+    else:
+        # One cone request per cluster, sent together in a few scripts
+        cluster_array['name'] = [choose_star_name(objects) for objects in \
+                                 library.get_objects_many(zip(cluster_array['ra'], \
+                                                              cluster_array['dec']), 0.003)]
+
 def find_main_centroid(cluster_array):
     """
     Find the cluster with the highest luminosity
@@ -120,6 +378,9 @@ def find_main_centroid(cluster_array):
     :return: the cluster of the highest luminosity
     """
 
+    if isinstance(cluster_array, catalog.Catalog):
+        return cluster_array.brightest()
+
     # Loop over the clusters to find to one with the highest luminosity
     greatest_integral = 0
     main_centroid = 0
@@ -10,7 +10,8 @@ with the use of a widget
 import sys
 import matplotlib.pyplot as plt
 import matplotlib.widgets as widgets
-import mylib
+import stagecache
+import viewer
 
 def main():
     """
@@ -19,20 +20,33 @@ def main():
     the threshold can be ajusted with a widget
     """
 
-    # Get pixels and header from a fits file
-    pixels, _ = mylib.get_pixels("../data/specific.fits")
-
-    # Process to the fit of the background
-    _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
+    # Process to the fit of the background, the results of the stages
+    # are kept between runs
+    pipeline = stagecache.default_pipeline()
+    path = "../data/specific.fits"
+    _, _, _, background, dispersion = pipeline.modelling_parameters(path)
 
     # Remove the background
-    filtered_pixels = mylib.remove_background(pixels, background, dispersion)
+    filtered_pixels = pipeline.filtered_pixels(path)
 
-    # Display the picture without the background
+    # Display the picture without the background, the viewer keeps
+    # the image and redraws only what changes
     fig, axis = plt.subplots()
     plt.subplots_adjust(left=0.1, bottom=0.25)
-    axis.imshow(filtered_pixels)
-    axis.set_title('Picture without background')
+
+    # slider_action function definition
+    def slider_action(threshold, cancelled):
+        """
+        Function called in a background thread when the threshold
+        value is changed, the filtered_pixels array is recalculated
+        """
+        if cancelled():
+            return None
+        return pipeline.filtered_pixels(path, threshold), \
+               'Picture without background : threshold = %s' % (threshold)
+
+    picture = viewer.ThresholdViewer(fig, axis, slider_action)
+    picture.show(filtered_pixels, 'Picture without background')
 
     # Define the slider axis and the widget associated
     slider_axis = plt.axes([0.2, 0.1, 0.6, 0.105])
@@ -42,23 +56,8 @@ def main():
     my_widget = widgets.Slider(slider_axis, 'threshold', threshold_min, \
                                threshold_max, valinit=threshold_init)
 
-    # slider_action function definition
-    def slider_action(threshold):
-        """
-        Function called when the threshold value is changed,
-        the filtered_pixels array is recalculated
-        and the canvas is redrawn
-        """
-        axis.cla() # delete the previous imshow
-        filtered_pixels = mylib.remove_background(pixels, background, \
-                          dispersion, threshold=threshold)
-        axis.imshow(filtered_pixels)
-        axis.set_title('Picture without background : threshold = %s' % \
-                      (threshold))
-        fig.canvas.draw() # redraw
-
-    # Use event handler
-    my_widget.on_changed(slider_action)
+    # Use event handler, the slider events being throttled
+    my_widget.on_changed(picture.on_changed)
     plt.show()
 
     return 0
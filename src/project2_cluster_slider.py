@@ -11,7 +11,8 @@ the number of clusters
 import sys
 import matplotlib.pyplot as plt
 import matplotlib.widgets as widgets
-import mylib
+import stagecache
+import viewer
 
 def main():
     """
@@ -21,20 +22,42 @@ def main():
     calculate the number of clusters
     """
 
-    # Get pixels and header from a fits file
-    pixels, _ = mylib.get_pixels("../data/specific.fits")
-
-    # Process to the fit of the background
-    _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
+    # Process to the fit of the background, the results of the stages
+    # are kept between runs
+    pipeline = stagecache.default_pipeline()
+    path = "../data/specific.fits"
+    _, _, _, background, dispersion = pipeline.modelling_parameters(path)
 
     # Remove the background
-    filtered_pixels = mylib.remove_background(pixels, background, dispersion)
+    filtered_pixels = pipeline.filtered_pixels(path)
 
-    # Display the picture without the background
+    # Display the picture without the background, the viewer keeps
+    # the image and redraws only what changes
     fig, axis = plt.subplots()
     plt.subplots_adjust(left=0.1, bottom=0.25)
-    axis.imshow(filtered_pixels)
-    axis.set_title('Picture without background')
+
+    # Build once the tree of the clusters above the background,
+    # which gives the number of clusters at any threshold
+    tree = pipeline.component_tree(path)
+
+    # slider_action function definition
+    def slider_action(threshold, cancelled):
+        """
+        Function called in a background thread when the threshold
+        value is changed, the filtered_pixels array is recalculated
+        and the clusters are counted
+        """
+        if cancelled():
+            return None
+        filtered_pixels = pipeline.filtered_pixels(path, threshold)
+        if cancelled():
+            return None
+        return filtered_pixels, \
+               'Picture without background : number of clusters = %s' % \
+               (tree.count(threshold))
+
+    picture = viewer.ThresholdViewer(fig, axis, slider_action)
+    picture.show(filtered_pixels, 'Picture without background')
 
     # Define the slider axis and the widget associated
     slider_axis = plt.axes([0.2, 0.1, 0.6, 0.105])
@@ -44,27 +67,8 @@ def main():
     my_widget = widgets.Slider(slider_axis, 'threshold', threshold_min, \
                                threshold_max, valinit=threshold_init)
 
-    # slider_action function definition
-    def slider_action(threshold):
-        """
-        Function called when the threshold value is changed,
-        the filtered_pixels array is recalculated
-        and the canvas is redrawn
-        """
-        axis.cla() # delete the previous imshow
-        filtered_pixels = mylib.remove_background(pixels, background, \
-                          dispersion, threshold=threshold)
-        axis.imshow(filtered_pixels)
-        try: # if too many recursion, say that threshold is too low
-            cluster_array = mylib.get_cluster_array(pixels, background, dispersion, threshold)
-            axis.set_title('Picture without background : number of clusters = %s' % \
-                      (len(cluster_array)))
-        except RuntimeError:
-            axis.set_title('Picture without background : threshold is too low')
-        fig.canvas.draw() # redraw
-
-    # Use event handler
-    my_widget.on_changed(slider_action)
+    # Use event handler, the slider events being throttled
+    my_widget.on_changed(picture.on_changed)
     plt.show()
 
     return 0
@@ -11,24 +11,31 @@ import os
 import sys
 import matplotlib.pyplot as plt
 import matplotlib.widgets as widgets
-import mylib
+import stagecache
+import viewer
 
 class Action(object):
     """
     Class which deals both with a radio button and a slider
     """
 
-    def __init__(self, _slider_axis, _fig, _axis):
+    def __init__(self, _slider_axis, _fig, _axis, _file_names=()):
         """
         Constructor of Action
+        :param _file_names: names of the fits files of the radio button,
+                            the neighbours of the selected one are prefetched
         """
-        self.pixels = None
+        self.pipeline = stagecache.default_pipeline(max_memory=512*1024*1024)
+        self.prefetcher = stagecache.Prefetcher(self.pipeline)
+        self.file_names = list(_file_names)
+        self.path = None
         self.background = None
         self.dispersion = None
         self.my_widget = None
         self.slider_axis = _slider_axis
         self.fig = _fig
         self.axis = _axis
+        self.picture = viewer.ThresholdViewer(_fig, _axis, self.slider_action)
 
     def radio_action(self, file_name):
         """
@@ -36,20 +43,24 @@ class Action(object):
         :param file_name: name of the fits file
         """
 
-        # Get pixels and header from a fits file
-        self.pixels, _ = mylib.get_pixels("../data/%s" % (file_name))
-
-        # Process to the fit of the background
-        _, _, _, self.background, self.dispersion = mylib.modelling_parameters(self.pixels)
+        # Process to the fit of the background, a file already
+        # selected (or prefetched) is not treated again
+        self.path = "../data/%s" % (file_name)
+        _, _, _, self.background, self.dispersion = \
+            self.pipeline.modelling_parameters(self.path)
 
         # Remove the background
-        filtered_pixels = mylib.remove_background(self.pixels, self.background, self.dispersion)
+        filtered_pixels = self.pipeline.filtered_pixels(self.path)
 
         # Update the picture
-        self.axis.cla() # delete the previous imshow
-        self.axis.imshow(filtered_pixels)
-        self.axis.set_title('Use of both slider and radio button')
-        self.fig.canvas.draw() # redraw
+        self.picture.show(filtered_pixels, 'Use of both slider and radio button')
+
+        # Prepare the files next to this one in the list in the background
+        if file_name in self.file_names:
+            index = self.file_names.index(file_name)
+            self.prefetcher.prefetch(["../data/%s" % (self.file_names[neighbour]) \
+                                      for neighbour in (index + 1, index - 1) \
+                                      if 0 <= neighbour < len(self.file_names)])
 
         # Define the slider widget
         threshold_min = max(0, self.background - 6.0 * self.dispersion)
@@ -59,18 +70,19 @@ class Action(object):
             self.slider_axis.cla()
         self.my_widget = widgets.Slider(self.slider_axis, 'threshold', threshold_min, \
                                    threshold_max, valinit=threshold_init)
+        self.my_widget.on_changed(self.picture.on_changed)
 
-    def slider_action(self, threshold):
+    def slider_action(self, threshold, cancelled):
         """
-        On changed function for slider
+        On changed function for slider, called in a background thread
         :param threshold: value of the threshold
+        :param cancelled: function telling whether the value is superseded
         """
-        self.axis.cla() # delete the previous imshow
-        filtered_pixels = mylib.remove_background(self.pixels, self.background, \
-                          self.dispersion, threshold=threshold)
-        self.axis.imshow(filtered_pixels)
-        self.axis.set_title('Use of both slider and radio button')
-        self.fig.canvas.draw() # redraw
+        path = self.path
+        if cancelled():
+            return None
+        return self.pipeline.filtered_pixels(path, threshold), \
+               'Use of both slider and radio button'
 
 def main():
     """
@@ -96,14 +108,12 @@ def main():
     slider_axis = plt.axes([0.2, 0.1, 0.6, 0.105])
 
     # Initialize Action class, display the first fits file
-    # and get the slider
-    action = Action(slider_axis, fig, axis)
+    # and its slider
+    action = Action(slider_axis, fig, axis, fits_files)
     action.radio_action(fits_files[0])
-    my_widget = action.my_widget
 
     # Use event handler and show
     radio.on_clicked(action.radio_action)
-    my_widget.on_changed(action.slider_action)
     plt.show()
 
     return 0
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reference catalog:
+Module which contains the class ReferenceCatalog, a local list of
+celestial objects answering the cone requests of the Simbad server
+without any network access. The objects are split in declination
+zones and sorted by RA inside each zone, so that a cone request only
+searches a few RA ranges of the zones it crosses. It is built from
+a text file or from the answers kept in the Simbad cache, and saved
+in a .npz file which loads without parsing.
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+import diskcache
+import library
+import metrics
+
+class ReferenceCatalog(object):
+    """
+    Class which contains celestial objects (name, type, RA, DEC)
+    ordered by declination zone then by RA:
+    - objects(ra, dec, radius) answers like library.get_objects
+    - positions(ra, dec, radius) answers like library.get_objects_positions
+    - star_names(ras, decs, radius) names many clusters at once,
+      with the rule of cluster.choose_star_name
+    """
+
+    def __init__(self, names, types, ras, decs, zone_height=0.1):
+        """
+        Constructor of ReferenceCatalog
+        :param names: names of the objects
+        :param types: types of the objects ('Unknown' if not known)
+        :param ras: RA of the objects (degree)
+        :param decs: DEC of the objects (degree)
+        :param zone_height: height of the declination zones (degree)
+        """
+        ras = np.mod(np.asarray(ras, np.float_), 360.)
+        decs = np.asarray(decs, np.float_)
+        self.zone_height = float(zone_height)
+        self.n_zone = int(np.ceil(180. / self.zone_height))
+
+        # Sort the objects by zone, then by RA: the key of an object
+        # is 360 * zone + RA, increasing along the arrays
+        zones = self.zone(decs)
+        order = np.lexsort((ras, zones))
+        self.ras = ras[order]
+        self.decs = decs[order]
+        self.keys = 360. * zones[order] + self.ras
+        self.names = np.asarray(names, dtype=str)[order]
+        self.types = np.asarray(types, dtype=str)[order]
+
+        # Rank of each object for the naming rule: the known objects
+        # first, then the first name in alphabetical order
+        ranks = np.empty(len(self.names), dtype=np.int64)
+        ranks[np.argsort(self.names, kind='mergesort')] = np.arange(len(self.names))
+        self.ranks = ranks + len(self.names) * (self.types == 'Unknown')
+
+    def __len__(self):
+        return len(self.names)
+
+    def zone(self, decs):
+        """
+        Return the declination zones of positions
+        """
+        zones = np.floor((np.asarray(decs, np.float_) + 90.) / self.zone_height)
+        return np.clip(zones, 0, self.n_zone - 1).astype(np.int64)
+
+    def candidates(self, ras, decs, radius):
+        """
+        Find the objects of the zones crossed by the cones whose RA is
+        close enough, one binary search per zone and RA range
+        :param ras: RA of the centers of the cones (degree)
+        :param decs: DEC of the centers of the cones (degree)
+        :param radius: acceptance angle (degree)
+        :return: tuple (index of the cone, index of the object) of the pairs
+        """
+        ras = np.mod(np.atleast_1d(np.asarray(ras, np.float_)), 360.)
+        decs = np.atleast_1d(np.asarray(decs, np.float_))
+
+        # Half width in RA of the cones, the whole circle near the poles
+        highest = np.minimum(np.abs(decs) + radius, 90.)
+        cosine = np.cos(np.radians(highest))
+        half_width = np.where(cosine > np.sin(np.radians(radius)), \
+                              np.degrees(np.arcsin(np.minimum(np.sin(np.radians(radius)) / \
+                                                              np.maximum(cosine, 1e-300), 1.))), \
+                              180.)
+
+        first_zone, last_zone = self.zone(decs - radius), self.zone(decs + radius)
+        cones, objects = [], []
+        for offset in range(int((last_zone - first_zone).max()) + 1 if len(decs) else 0):
+            zones = first_zone + offset
+            inside = zones <= last_zone
+            zone_starts = np.searchsorted(self.keys, 360. * zones, side='left')
+            zone_stops = np.searchsorted(self.keys, 360. * (zones + 1), side='left')
+
+            # The whole zone for the cones reaching a pole, else the RA
+            # range, split in two when it wraps around 0 or 360
+            whole = inside & (half_width >= 180.)
+            cones.append(np.flatnonzero(whole))
+            objects.append(np.column_stack((zone_starts, zone_stops))[whole])
+            for shift in (-360., 0., 360.):
+                low = np.maximum(ras - half_width + shift, 0.)
+                high = np.minimum(ras + half_width + shift, 360.)
+                valid = inside & ~whole & (low <= high)
+                starts = np.searchsorted(self.keys, 360. * zones + low, side='left')
+                stops = np.minimum(np.searchsorted(self.keys, 360. * zones + high, \
+                                                   side='right'), zone_stops)
+                cones.append(np.flatnonzero(valid))
+                objects.append(np.column_stack((starts, stops))[valid])
+
+        # Expand the ranges [start, stop) of objects into pairs
+        cones = np.concatenate(cones) if cones else np.zeros(0, np.int64)
+        ranges = np.concatenate(objects) if objects else np.zeros((0, 2), np.int64)
+        counts = np.maximum(ranges[:, 1] - ranges[:, 0], 0)
+        firsts = np.repeat(ranges[:, 0] - (np.cumsum(counts) - counts), counts)
+        return np.repeat(cones, counts), firsts + np.arange(counts.sum())
+
+    def matches(self, ras, decs, radius):
+        """
+        Find the objects closer than radius of the centers of the cones
+        :return: tuple (index of the cone, index of the object) of the pairs
+        """
+        ras = np.atleast_1d(np.asarray(ras, np.float_))
+        decs = np.atleast_1d(np.asarray(decs, np.float_))
+        cones, objects = self.candidates(ras, decs, radius)
+        close = library.angular_distance(ras[cones], decs[cones], \
+                                         self.ras[objects], self.decs[objects]) <= radius
+        return cones[close], objects[close]
+
+    def objects(self, ra, dec, radius):
+        """
+        Objects in a cone, as given by library.get_objects
+        :return: a dictionary of identified objects {objectname: objecttype}
+        """
+        _, objects = self.matches(ra, dec, radius)
+        return {self.names[i]: self.types[i] for i in np.sort(objects)}
+
+    def positions(self, ra, dec, radius):
+        """
+        Objects in a cone, as given by library.get_objects_positions
+        :return: a list of tuples (objectname, objecttype, RA, DEC)
+        """
+        _, objects = self.matches(ra, dec, radius)
+        return [(self.names[i], self.types[i], self.ras[i], self.decs[i]) \
+                for i in np.sort(objects)]
+
+    def star_names(self, ras, decs, radius=0.003):
+        """
+        Name many clusters at once: the known objects of a cone are
+        preferred to the 'Unknown' ones, and the first name in
+        alphabetical order is taken
+        :param ras: RA of the centroids (degree)
+        :param decs: DEC of the centroids (degree)
+        :param radius: acceptance angle around each centroid (degree)
+        :return: list of names, "Unfound" when a cone is empty
+        """
+        ras = np.atleast_1d(np.asarray(ras, np.float_))
+        cones, objects = self.matches(ras, decs, radius)
+        best = np.full(len(ras), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(best, cones, self.ranks[objects])
+        found = best != np.iinfo(np.int64).max
+        metrics.count('names_chosen', int(np.count_nonzero(found)))
+        metrics.count('names_unfound', int(np.count_nonzero(~found)))
+
+        # From the rank back to the object
+        by_rank = np.empty(2 * len(self.names), dtype=np.int64)
+        by_rank[self.ranks] = np.arange(len(self.names))
+        names = np.full(len(ras), 'Unfound', dtype=object)
+        names[found] = self.names[by_rank[best[found]]]
+        return list(names)
+
+    def save(self, path):
+        """
+        Save the objects in a .npz file
+        :param path: path of the file
+        """
+        np.savez(path, names=self.names, types=self.types, ras=self.ras, \
+                 decs=self.decs, zone_height=self.zone_height)
+
+def load(path, zone_height=None):
+    """
+    Load a reference catalog: a .npz file written by ReferenceCatalog.save,
+    or a text file with the fields RA, DEC, type and name separated by
+    tabulations on each line (RA and DEC in degree, or sexagesimal
+    with the RA in hours), the lines starting with # being ignored
+    :param path: path of the file
+    :param zone_height: height of the declination zones (default: the saved one)
+    :return: instance of ReferenceCatalog
+    """
+    if path.lower().endswith('.npz'):
+        with np.load(path) as arrays:
+            return ReferenceCatalog(arrays['names'], arrays['types'], arrays['ras'], \
+                                    arrays['decs'], zone_height or float(arrays['zone_height']))
+    rows = []
+    with open(path) as input_file:
+        for line in input_file:
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            rows.append([field.strip() for field in line.rstrip('\n').split('\t')])
+    return from_rows(rows, zone_height or 0.1)
+
+def from_rows(rows, zone_height=0.1):
+    """
+    Build a reference catalog from rows [RA, DEC, type, name],
+    such as the data lines of a Simbad answer (see library.parse_objects)
+    :param rows: list of rows of 4 text fields
+    :param zone_height: height of the declination zones (degree)
+    :return: instance of ReferenceCatalog
+    """
+    def angle(text, hours):
+        """
+        Angle in degree of a field, decimal or sexagesimal
+        """
+        try:
+            return float(text)
+        except ValueError:
+            return library.sexagesimal_to_degrees(text, hours)
+
+    # The same object may be given several times
+    objects = {}
+    for row in rows:
+        objects[row[3]] = (row[2], angle(row[0], True), angle(row[1], False))
+    names = sorted(objects)
+    return ReferenceCatalog(names, [objects[name][0] for name in names], \
+                            [objects[name][1] for name in names], \
+                            [objects[name][2] for name in names], zone_height)
+
+def from_simbad_cache(directory, zone_height=0.1):
+    """
+    Build a reference catalog from all the answers kept in a Simbad cache
+    (see library.use_simbad_cache)
+    :param directory: directory of the cache
+    :param zone_height: height of the declination zones (degree)
+    :return: instance of ReferenceCatalog
+    """
+    cache = diskcache.DiskCache(directory, offline=True)
+    rows = []
+    for key in cache.keys():
+        out = cache.get(key)
+        if out is not None:
+            rows += [row for row in library.parse_objects(out) if len(row) >= 4]
+    return from_rows(rows, zone_height)
+
+def main():
+    """
+    Build a reference catalog and save it in a .npz file
+    """
+    parser = argparse.ArgumentParser(description='Build a reference catalog ' \
+                                                 'for the naming without Simbad')
+    parser.add_argument('inputs', nargs='*', \
+                        help='text files of objects (RA, DEC, type and name ' \
+                             'separated by tabulations)')
+    parser.add_argument('--simbad-cache', default=None, \
+                        help='also take the objects of the answers of this Simbad cache')
+    parser.add_argument('--zone-height', type=float, default=0.1, \
+                        help='height of the declination zones in degree (default: 0.1)')
+    parser.add_argument('-o', '--output', default='reference.npz', \
+                        help='output file (default: reference.npz)')
+    args = parser.parse_args()
+
+    rows = []
+    for path in args.inputs:
+        reference = load(path)
+        rows += [[repr(ra), repr(dec), kind, name] for name, kind, ra, dec in \
+                 zip(reference.names, reference.types, reference.ras, reference.decs)]
+    if args.simbad_cache is not None and os.path.isdir(args.simbad_cache):
+        reference = from_simbad_cache(args.simbad_cache)
+        rows += [[repr(ra), repr(dec), kind, name] for name, kind, ra, dec in \
+                 zip(reference.names, reference.types, reference.ras, reference.decs)]
+
+    reference = from_rows(rows, args.zone_height)
+    reference.save(args.output)
+    print '%d objects written to %s' % (len(reference), args.output)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
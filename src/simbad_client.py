@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the class SimbadClient, a reusable HTTP client
+for the Simbad server with keep-alive connections, bounded concurrency,
+jittered exponential backoff and a circuit breaker
+"""
+
+import httplib
+import random
+import socket
+import threading
+import time
+import urlparse
+import Queue
+from multiprocessing.pool import ThreadPool
+import metrics
+
+class SimbadError(IOError):
+    """
+    Error raised when the Simbad server cannot give an answer
+    """
+    pass
+
+class CircuitOpenError(SimbadError):
+    """
+    Error raised without sending the request when too many
+    consecutive requests have failed
+    """
+    pass
+
+# pylint: disable=too-many-instance-attributes
+class SimbadClient(object):
+    """
+    Class which sends the requests to the Simbad server:
+    - connections are kept alive and reused, at most max_connections
+      of them per host, which also bounds the concurrency
+    - failed requests are retried after a jittered exponential backoff
+    - after failure_threshold consecutive failures, requests fail
+      immediately during reset_timeout seconds, then one trial request
+      is let through
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, max_connections=8, timeout=10.0, retries=5, \
+                 backoff=0.2, max_backoff=5.0, \
+                 failure_threshold=5, reset_timeout=30.0):
+        """
+        Constructor of SimbadClient
+        :param max_connections: maximum number of simultaneous requests
+        :param timeout: timeout of each request in seconds
+        :param retries: number of retries after a failure
+        :param backoff: base delay before the first retry in seconds
+        :param max_backoff: maximum delay between retries in seconds
+        :param failure_threshold: consecutive failures opening the circuit
+        :param reset_timeout: delay before trying again once the circuit is open
+        """
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.pools = {}
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False # a trial request of the half-open circuit is running
+        self.requests = 0
+        self.retried = 0
+
+    def connection(self, host):
+        """
+        Take an idle connection to host or open a new one
+        """
+        with self.lock:
+            pool = self.pools.setdefault(host, Queue.LifoQueue())
+        try:
+            return pool.get_nowait()
+        except Queue.Empty:
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def release(self, host, connection):
+        """
+        Give back a connection that can be reused
+        """
+        self.pools[host].put(connection)
+
+    def check_circuit(self):
+        """
+        Raise CircuitOpenError if the circuit is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial or time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError('Simbad circuit open after %d failures' % \
+                                       self.failures)
+            # half-open: let only this request through until its result
+            # is recorded, a failure reopens
+            self.trial = True
+            self.failures = self.failure_threshold - 1
+
+    def record(self, success):
+        """
+        Update the circuit breaker with the result of a request
+        """
+        with self.lock:
+            self.trial = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.time()
+
+    def send(self, host, path, data=None):
+        """
+        Send a single GET request (POST if there is data) on a pooled connection
+        :return: the body of the answer
+        """
+        connection = self.connection(host)
+        try:
+            if data is None:
+                connection.request('GET', path)
+            else:
+                connection.request('POST', path, data, \
+                                   {'Content-Type': 'application/x-www-form-urlencoded'})
+            response = connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(host, connection)
+        if response.status != 200:
+            # client errors are not worth retrying, except "too many requests"
+            if 400 <= response.status < 500 and response.status != 429:
+                raise SimbadError('HTTP error %d for %s' % (response.status, path))
+            raise httplib.HTTPException('HTTP error %d' % response.status)
+        return body
+
+    def fetch(self, url, data=None):
+        """
+        Get the body of the answer to url, retrying when it fails
+        :param url: complete http url
+        :param data: url encoded body of a POST request (None for GET)
+        :return: text of the answer
+        """
+        parsed = urlparse.urlsplit(url)
+        path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        attempt = 0
+        while True:
+            self.check_circuit()
+            with self.slots:
+                with self.lock:
+                    self.requests += 1
+                metrics.count('http_requests')
+                try:
+                    body = self.send(parsed.netloc, path, data)
+                except (httplib.HTTPException, socket.error) as error:
+                    self.record(False)
+                    last_error = error
+                except SimbadError:
+                    self.record(True) # the server answered
+                    raise
+                else:
+                    self.record(True)
+                    return body
+            if attempt >= self.retries:
+                raise SimbadError('no answer from %s after %d attempts: %s' % \
+                                  (parsed.netloc, attempt + 1, last_error))
+            # full jitter: wait a random delay up to the exponential backoff
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+            with self.lock:
+                self.retried += 1
+            metrics.count('http_retries')
+
+    def map(self, function, items):
+        """
+        Apply function to all items in parallel, at most max_connections
+        at a time (function is expected to call fetch)
+        :return: list of the results
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return [function(item) for item in items]
+
+        # The threads record their measures in the collections of the caller
+        collectors = metrics.active()
+        def measured(item):
+            """ function called in a thread of the pool """
+            with metrics.attach(collectors):
+                return function(item)
+        pool = ThreadPool(min(self.max_connections, len(items)))
+        try:
+            return pool.map(measured, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        """
+        Close all the idle connections
+        """
+        with self.lock:
+            for pool in self.pools.values():
+                while not pool.empty():
+                    pool.get_nowait().close()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Simbad sim-script service:
+it answers the 'query coo' requests from a local list of objects,
+so that the requests to Simbad can be exercised without network.
+Use it with library.SIMBAD_HOST = 'localhost:<port>'
+"""
+
+import argparse
+import re
+import sys
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+import library
+
+QUERY_PATTERN = re.compile(r'query coo ([-+0-9.]+) ([-+0-9.]+) radius=([0-9.]+)d')
+ECHO_PATTERN = re.compile(r'echodata (.*)')
+
+def sexagesimal(angle, hours=False):
+    """
+    Convert a floating point angle into the Simbad textual representation
+    :param angle: angle in degree
+    :param hours: True for a RA coordinate
+    :return: 'DD MM SS.ssss' or 'HH MM SS.ssss'
+    """
+    sign = '-' if angle < 0 else ('' if hours else '+')
+    angle = abs(angle) * (24.0/360.0 if hours else 1.0)
+    degree = int(angle)
+    minute = int((angle - degree) * 60.0)
+    second = ((angle - degree) * 60.0 - minute) * 60.0
+    return '%s%02d %02d %07.4f' % (sign, degree, minute, second)
+
+def read_objects(path):
+    """
+    Read a list of objects from a text file, one object per line:
+    RA DEC (decimal degree), object type and name separated by tabs
+    :param path: path of the file
+    :return: list of tuples (objectname, objecttype, RA, DEC)
+    """
+    objects = []
+    with open(path) as objects_file:
+        for line in objects_file:
+            if line.strip() and not line.startswith('#'):
+                ra, dec, otype, name = line.rstrip('\n').split('\t')
+                objects.append((name, otype, float(ra), float(dec)))
+    return objects
+
+def answer(script, objects):
+    """
+    Build the answer to a script in the format of Simbad
+    :param script: decoded script text
+    :param objects: list of tuples (objectname, objecttype, RA, DEC)
+    :return: answer text
+    """
+    lines = ['::script' + ':'*72, '']
+    lines += script.strip().split('\n')
+    lines += ['', '::data' + ':'*74, '']
+    obj_ras = np.array([obj[2] for obj in objects], dtype=np.float_)
+    obj_decs = np.array([obj[3] for obj in objects], dtype=np.float_)
+    for line in script.split('\n'):
+        echo = ECHO_PATTERN.match(line.strip())
+        if echo is not None:
+            lines.append(echo.group(1))
+        query = QUERY_PATTERN.search(line)
+        if query is None:
+            continue
+        ra, dec, radius = query.groups()
+        inside = library.angular_distance(float(ra), float(dec), \
+                                          obj_ras, obj_decs) <= float(radius)
+        for index in np.flatnonzero(inside):
+            name, otype, obj_ra, obj_dec = objects[index]
+            lines.append('%s\t%s\t%s\t%s' % (sexagesimal(obj_ra, hours=True), \
+                                             sexagesimal(obj_dec), otype, name))
+    return '\n'.join(lines) + '\n'
+
+class SimbadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Class which answers the requests sent to /simbad/sim-script
+    """
+
+    def answer_script(self, query):
+        """
+        Send the answer to the script contained in the query string
+        :param query: url encoded parameters of the request
+        """
+        self.server.requests += 1
+        script = urlparse.parse_qs(query).get('script', [''])[0]
+        text = answer(script.replace('\r\n', '\n'), self.server.objects)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """
+        Answer a GET request
+        """
+        path = urlparse.urlparse(self.path)
+        if path.path != '/simbad/sim-script':
+            self.send_error(404)
+            return
+        self.answer_script(path.query)
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """
+        Answer a POST request
+        """
+        length = int(self.headers.getheader('Content-Length', 0))
+        self.answer_script(self.rfile.read(length))
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        """
+        Do not log each request
+        """
+        pass
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Server answering each connection in its own thread, so that
+    several kept-alive connections can be served at the same time
+    """
+    daemon_threads = True
+
+def make_server(objects, port=0):
+    """
+    Build the stand-in server
+    :param objects: list of tuples (objectname, objecttype, RA, DEC)
+    :param port: port to listen on (0 for any free port)
+    :return: the server, its attribute requests counts the requests
+             and its attribute host is to be used as library.SIMBAD_HOST
+    """
+    # HTTP/1.1 so that the clients can keep their connections alive
+    SimbadHandler.protocol_version = 'HTTP/1.1'
+    server = ThreadingServer(('localhost', port), SimbadHandler)
+    server.objects = objects
+    server.requests = 0
+    server.host = 'localhost:%d' % server.server_address[1]
+    return server
+
+def start_server(objects, port=0):
+    """
+    Start the stand-in server in a background thread
+    :param objects: list of tuples (objectname, objecttype, RA, DEC)
+    :param port: port to listen on (0 for any free port)
+    :return: the running server
+    """
+    server = make_server(objects, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    """
+    Serve the objects of a file until interrupted
+    """
+    parser = argparse.ArgumentParser(description='Local stand-in Simbad server')
+    parser.add_argument('objects', help='file of objects: RA, DEC, type, name (tabs)')
+    parser.add_argument('--port', type=int, default=8080, help='listening port')
+    args = parser.parse_args()
+
+    server = make_server(read_objects(args.objects), args.port)
+    print 'serving %d objects on %s' % (len(server.objects), server.host)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the class ClusterIndex, a spatial index
+over the bounding boxes and centroids of the clusters of a catalog
+"""
+
+import numpy as np
+# pylint: disable=E
+from scipy.spatial import cKDTree
+
+MAX_CELLS = 16 # cells of a cluster above which it is checked directly
+
+class ClusterIndex(object):
+    """
+    Class which finds the clusters around a position without looking
+    at every cluster:
+    - the picture is cut in square cells, and each cell holds the
+      clusters whose bounding box covers it (point and box queries);
+      the clusters covering more than MAX_CELLS cells are kept in a
+      separate list checked at every query, so that one large cluster
+      does not fill the whole grid
+    - a k-d tree over the centroids gives the nearest clusters
+    The indices returned are the ones of the catalog, in increasing order.
+    """
+
+    def __init__(self, cluster_array, cell_size=None):
+        """
+        Constructor of ClusterIndex
+        :param cluster_array: catalog.Catalog of the clusters
+        :param cell_size: size of a cell in pixels (default: twice
+                          the median size of the bounding boxes, larger
+                          if the grid would have more cells than 4 per cluster)
+        """
+        self.xmin = np.asarray(cluster_array['xmin'], dtype=np.int64)
+        self.xmax = np.asarray(cluster_array['xmax'], dtype=np.int64)
+        self.ymin = np.asarray(cluster_array['ymin'], dtype=np.int64)
+        self.ymax = np.asarray(cluster_array['ymax'], dtype=np.int64)
+        count = len(self.xmin)
+        if cell_size is None:
+            sizes = np.maximum(self.xmax - self.xmin, self.ymax - self.ymin) + 1
+            cell_size = 2 * int(np.median(sizes)) if count != 0 else 1
+            if count != 0:
+                area = float(self.xmax.max() - self.xmin.min() + 1) * \
+                       (self.ymax.max() - self.ymin.min() + 1)
+                cell_size = max(cell_size, int(np.ceil(np.sqrt(area / (4. * count)))))
+        self.cell_size = max(1, int(cell_size))
+
+        # Cells covered by each bounding box
+        self.x_origin = self.xmin.min() if count != 0 else 0
+        self.y_origin = self.ymin.min() if count != 0 else 0
+        cx0, cx1 = self.cell_x(self.xmin), self.cell_x(self.xmax)
+        cy0, cy1 = self.cell_y(self.ymin), self.cell_y(self.ymax)
+        self.n_column = int(cx1.max()) + 1 if count != 0 else 1
+        self.n_row = int(cy1.max()) + 1 if count != 0 else 1
+
+        # One entry per (cell, cluster): the cells of a box are numbered
+        # from 0 to width * height - 1 and cut in columns and rows
+        widths = cx1 - cx0 + 1
+        ncells = widths * (cy1 - cy0 + 1)
+        large = ncells > MAX_CELLS
+        self.large = np.flatnonzero(large)
+        ncells[large] = 0
+        clusters = np.repeat(np.arange(count), ncells)
+        firsts = np.cumsum(ncells) - ncells
+        rank = np.arange(ncells.sum()) - np.repeat(firsts, ncells)
+        columns = np.repeat(cx0, ncells) + rank % np.repeat(widths, ncells)
+        rows = np.repeat(cy0, ncells) + rank // np.repeat(widths, ncells)
+        cells = rows * self.n_column + columns
+
+        # Clusters of the cells, cell after cell
+        order = np.lexsort((clusters, cells))
+        self.cell_clusters = clusters[order]
+        self.cell_starts = np.searchsorted(cells[order], \
+                                           np.arange(self.n_row * self.n_column + 1))
+
+        # Centroids for the nearest clusters
+        self.tree = cKDTree(np.column_stack((cluster_array['x'], cluster_array['y']))) \
+                    if count != 0 else None
+
+    def __len__(self):
+        return len(self.xmin)
+
+    def cell_x(self, x_position):
+        """
+        Column of the cells of pixel columns
+        """
+        return (np.asarray(x_position, dtype=np.int64) - self.x_origin) // self.cell_size
+
+    def cell_y(self, y_position):
+        """
+        Row of the cells of pixel rows
+        """
+        return (np.asarray(y_position, dtype=np.int64) - self.y_origin) // self.cell_size
+
+    def candidates(self, cx0, cx1, cy0, cy1):
+        """
+        Clusters covering the cells of a range (bounds included),
+        and the large clusters
+        """
+        cx0, cy0 = max(int(cx0), 0), max(int(cy0), 0)
+        cx1, cy1 = min(int(cx1), self.n_column - 1), min(int(cy1), self.n_row - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return self.large
+        parts = [self.cell_clusters[self.cell_starts[row * self.n_column + cx0]: \
+                                    self.cell_starts[row * self.n_column + cx1 + 1]] \
+                 for row in range(cy0, cy1 + 1)]
+        return np.unique(np.concatenate(parts + [self.large]))
+
+    def point(self, x_position, y_position):
+        """
+        Clusters whose bounding box contains a position, with the
+        convention of CatalogRow.is_in_bounding
+        :return: array of indices of the clusters
+        """
+        x_position, y_position = int(x_position), int(y_position)
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        cell_x, cell_y = self.cell_x(x_position), self.cell_y(y_position)
+        found = self.candidates(cell_x, cell_x, cell_y, cell_y)
+        inside = (self.xmin[found] <= x_position) & (x_position <= self.xmax[found]) & \
+                 (self.ymin[found] <= y_position) & (y_position <= self.ymax[found])
+        return found[inside]
+
+    def box(self, x_low, y_low, x_high, y_high):
+        """
+        Clusters whose bounding box intersects a box of pixels
+        :param x_low, y_low: first column and row of the box
+        :param x_high, y_high: last column and row of the box (included)
+        :return: array of indices of the clusters
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        x_low, x_high = int(np.floor(x_low)), int(np.floor(x_high))
+        y_low, y_high = int(np.floor(y_low)), int(np.floor(y_high))
+        found = self.candidates(self.cell_x(x_low), self.cell_x(x_high), \
+                                self.cell_y(y_low), self.cell_y(y_high))
+        inside = (self.xmin[found] <= x_high) & (x_low <= self.xmax[found]) & \
+                 (self.ymin[found] <= y_high) & (y_low <= self.ymax[found])
+        return found[inside]
+
+    def nearest(self, x_position, y_position, count=1):
+        """
+        Clusters whose centroids are the nearest to a position
+        :param count: number of clusters
+        :return: distances and indices of the clusters, nearest first
+        """
+        if self.tree is None:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+        count = min(count, len(self))
+        distances, indices = self.tree.query((x_position, y_position), k=count)
+        return np.atleast_1d(distances), np.atleast_1d(indices)
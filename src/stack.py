@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which processes many small pictures of the same shape at once:
+they are read into a single 3D array (frame, row, column), the
+background of every frame is fitted in one vectorized computation
+and the clusters of all the frames are labelled in a single pass,
+giving one catalog whose frame column tells the picture of each cluster
+"""
+
+import numpy as np
+import catalog
+import metrics
+import mylib
+
+def read_stack(paths):
+    """
+    Read pictures of the same shape into a 3D array
+    :param paths: list of paths of fits files
+    :return: 3D array (frame, row, column) and the list of the headers
+    """
+    frames, headers = [], []
+    for path in paths:
+        pixels, header = mylib.get_pixels(path)
+        if pixels is None:
+            raise IOError('cannot open %s' % path)
+        if frames and pixels.shape != frames[0].shape:
+            raise ValueError('%s: shape %s instead of %s' % \
+                             (path, pixels.shape, frames[0].shape))
+        frames.append(pixels)
+        headers.append(header)
+    return np.array(frames), headers
+
+def stack_histograms(stack, nbins=200):
+    """
+    Build the pixel distribution of every frame, with the same bins
+    as np.histogram(frame.ravel(), nbins)
+    :param stack: 3D array (frame, row, column)
+    :param nbins: number of bins
+    :return: 2D array of the numbers of pixels (frame, bin) and
+             2D array of the boundaries of the bins (frame, nbins + 1)
+    """
+    values = stack.reshape(len(stack), -1)
+    firsts = values.min(axis=1).astype(np.float64)
+    lasts = values.max(axis=1).astype(np.float64)
+    flat = lasts == firsts # expanded as np.histogram does
+    firsts, lasts = np.where(flat, firsts - 0.5, firsts), np.where(flat, lasts + 0.5, lasts)
+    boundaries = np.array([np.linspace(first, last, nbins + 1) \
+                           for first, last in zip(firsts, lasts)]).reshape(len(stack), -1)
+
+    # Index of the bin of every pixel, corrected near the boundaries
+    values = values.astype(np.float64)
+    indices = ((values - firsts[:, np.newaxis]) * \
+               (nbins / (lasts - firsts))[:, np.newaxis]).astype(np.intp)
+    indices[indices == nbins] -= 1
+    rows = np.arange(len(stack))[:, np.newaxis]
+    indices[values < boundaries[rows, indices]] -= 1
+    indices[(values >= boundaries[rows, indices + 1]) & (indices != nbins - 1)] += 1
+
+    # Count the pixels of all the frames with a single bincount
+    counts = np.bincount((indices + nbins * rows).ravel(), minlength=len(stack) * nbins)
+    return counts.reshape(len(stack), nbins), boundaries
+
+def solve_steps(matrices, vectors):
+    """
+    Solve many 3x3 linear systems, each one on its own when one of
+    them is singular
+    :param matrices: 3D array (frame, 3, 3)
+    :param vectors: 2D array (frame, 3)
+    :return: 2D array of the solutions, NaN for the singular systems
+    """
+    try:
+        return np.linalg.solve(matrices, vectors[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        steps = np.full(vectors.shape, np.nan)
+        for frame in range(len(matrices)):
+            try:
+                steps[frame] = np.linalg.solve(matrices[frame], vectors[frame])
+            except np.linalg.LinAlgError:
+                pass
+        return steps
+
+def fit_histograms(bin_values, bin_boundaries, iterations=200, tolerance=1e-10):
+    """
+    Fit the pixel distributions of all the frames with the modelling
+    function at once, with Levenberg-Marquardt steps computed for every
+    frame together (same normalization and result as mylib.fit_histogram)
+    :param bin_values: 2D array of the numbers of pixels (frame, bin)
+    :param bin_boundaries: 2D array of the boundaries of the bins (frame, nbins + 1)
+    :param iterations: largest number of steps
+    :param tolerance: relative change of the parameters below which a fit has converged
+    :return: 1D arrays of the maximum values, backgrounds and dispersions,
+             and the boolean mask of the frames whose fit has converged
+             (the other ones keep their starting guess)
+    """
+    # Normalize the distributions as mylib.fit_histogram does
+    max_y = bin_values.max(axis=1).astype(np.float64)[:, np.newaxis]
+    normal_y = bin_values / max_y
+    max_x = bin_boundaries.max(axis=1)[:, np.newaxis]
+    normal_x = bin_boundaries[:, :-1] / max_x
+
+    # Start from the peak of the distribution and its width at half maximum
+    peak = np.argmax(normal_y, axis=1)
+    rows = np.arange(len(normal_y))
+    half_width = np.maximum((normal_y >= 0.5).sum(axis=1), 1) * \
+                 (normal_x[:, 1] - normal_x[:, 0]) / 2.
+    params = np.column_stack((normal_y[rows, peak], normal_x[rows, peak], \
+                              half_width / np.sqrt(2. * np.log(2.))))
+
+    def residuals_of(frames, params):
+        """ residuals of some frames and their sums of squares """
+        model = mylib.modelling_function(normal_x[frames], params[:, 0:1], \
+                                         params[:, 1:2], params[:, 2:3])
+        residuals = normal_y[frames] - model
+        return residuals, (residuals**2).sum(axis=1)
+
+    _, cost = residuals_of(rows, params)
+    damping = np.full(len(params), 1e-3)
+    converged = np.zeros(len(params), dtype=bool)
+    active = rows[np.isfinite(cost)]
+    for _ in range(iterations):
+        if len(active) == 0:
+            break
+
+        # Jacobian of the model with respect to (maximum, mean, disp)
+        # for the frames which have not converged yet
+        current = params[active]
+        residuals, _ = residuals_of(active, current)
+        gauss = mylib.modelling_function(normal_x[active], 1., current[:, 1:2], current[:, 2:3])
+        offset = normal_x[active] - current[:, 1:2]
+        jacobian = np.stack((gauss, \
+                             current[:, 0:1] * gauss * offset / current[:, 2:3]**2, \
+                             current[:, 0:1] * gauss * offset**2 / current[:, 2:3]**3), axis=2)
+        normal = np.einsum('fbi,fbj->fij', jacobian, jacobian)
+        gradient = np.einsum('fbi,fb->fi', jacobian, residuals)
+
+        # Damped step of every frame, kept where it lowers the cost;
+        # the frames whose system is singular leave the fit unconverged
+        damped = normal * (1. + damping[active, np.newaxis, np.newaxis] * np.eye(3))
+        steps = solve_steps(damped, gradient)
+        solved = np.isfinite(steps).all(axis=1)
+        active, current, steps = active[solved], current[solved], steps[solved]
+        if len(active) == 0:
+            break
+        trial = current + steps
+        _, trial_cost = residuals_of(active, trial)
+        better = np.isfinite(trial_cost) & (trial_cost <= cost[active])
+        change = np.abs(steps).max(axis=1) / np.abs(current).max(axis=1)
+
+        params[active[better]] = trial[better]
+        cost[active[better]] = trial_cost[better]
+        damping[active] = np.where(better, damping[active] / 10., damping[active] * 10.)
+        done = better & (change < tolerance)
+        converged[active[done]] = True
+        active = active[~done & (damping[active] < 1e16)]
+
+    # Rescale the parameters
+    return params[:, 0] * max_y[:, 0], params[:, 1] * max_x[:, 0], \
+           np.abs(params[:, 2]) * max_x[:, 0], converged
+
+@metrics.timed('stack_background_fit')
+def stack_modelling_parameters(stack):
+    """
+    Fit the background of every frame at once, the frames whose fit
+    has not converged being fitted one by one with mylib.fit_histogram
+    (which raises when it fails too)
+    :param stack: 3D array (frame, row, column)
+    :return: 1D arrays of the backgrounds and dispersions of the frames
+    """
+    bin_values, bin_boundaries = stack_histograms(stack)
+    _, backgrounds, dispersions, converged = fit_histograms(bin_values, bin_boundaries)
+    for frame in np.flatnonzero(~converged):
+        _, _, _, backgrounds[frame], dispersions[frame] = \
+            mylib.fit_histogram(bin_values[frame], bin_boundaries[frame])
+    metrics.count('stack_refits', int(np.count_nonzero(~converged)))
+    return backgrounds, dispersions
+
+@metrics.timed('stack_labelling')
+def label_stack(stack, thresholds, backgrounds):
+    """
+    Label the clusters of all the frames in one pass, pixels being
+    contiguous through their four sides inside a frame only.
+    Labels are numbered from 1 frame after frame, in the order in which
+    the first pixel of each cluster is met when scanning a frame row by row
+    :param stack: 3D array (frame, row, column)
+    :param thresholds: 1D array of the thresholds of the frames
+    :param backgrounds: 1D array of the backgrounds of the frames
+    :return: int32 3D array of labels (0 for the background), the
+             dictionary of statistics of each label (rows and columns
+             being the ones inside the frames) and the frame of each label
+    """
+    from scipy import ndimage # pylint: disable=E
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 1)
+    labels = np.zeros(stack.shape, dtype=np.int32)
+    nlabels = ndimage.label(stack >= thresholds[:, np.newaxis, np.newaxis], \
+                            structure=structure, output=labels)
+    metrics.count('pixels_scanned', stack.size)
+    metrics.count('clusters_found', nlabels)
+
+    # Statistics of the labelled pixels, the background of a pixel
+    # being the one of its frame
+    flat_labels = labels.ravel()
+    index = np.flatnonzero(flat_labels)
+    n_row, n_column = stack.shape[1:]
+    frames = index // (n_row * n_column)
+    stats = mylib.cluster_moments(mylib.pixel_sums( \
+        stack.ravel()[index], index // n_column % n_row, index % n_column, \
+        flat_labels[index], nlabels, np.asarray(backgrounds, np.float64)[frames]))
+    if np.issubdtype(stack.dtype, np.integer):
+        stats['luminosity'] = np.rint(stats['luminosity']).astype(np.int64)
+
+    # The frame of a label is the one of its pixels
+    label_frames = np.zeros(nlabels, dtype=np.int64)
+    label_frames[flat_labels[index] - 1] = frames
+    return labels, stats, label_frames
+
+def stack_catalog(stack, backgrounds, dispersions, nsigma=6.0):
+    """
+    Find the clusters of all the frames
+    :param stack: 3D array (frame, row, column)
+    :param backgrounds: 1D array of the backgrounds of the frames
+    :param dispersions: 1D array of the dispersions of the frames
+    :param nsigma: threshold in dispersions above the background
+    :return: catalog.Catalog of the clusters of all the frames,
+             labelled from 1 inside each frame
+    """
+    thresholds = np.asarray(backgrounds) + nsigma * np.asarray(dispersions)
+    _, stats, label_frames = label_stack(stack, thresholds, backgrounds)
+    cluster_array = catalog.from_statistics(stats)
+    cluster_array['frame'] = label_frames
+    firsts = np.searchsorted(label_frames, np.arange(len(stack)))
+    cluster_array['label'] -= firsts[label_frames]
+    return cluster_array
+
+def find_stack_clusters(paths, nsigma=6.0):
+    """
+    Read pictures of the same shape and find all their clusters at once
+    :param paths: list of paths of fits files
+    :param nsigma: threshold in dispersions above the background
+    :return: catalog.Catalog whose frame column is the index of the
+             picture in paths, and the list of the headers
+    """
+    stack, headers = read_stack(paths)
+    backgrounds, dispersions = stack_modelling_parameters(stack)
+    return stack_catalog(stack, backgrounds, dispersions, nsigma), headers
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which memoizes the stages of the detection (reading, background
+fit, filtering, labelling, WCS conversion, star names). The results are
+keyed by the hash of the content of the fits file and by the parameters
+of the stage, and are kept in memory and on disk.
+"""
+
+import collections
+import cPickle as pickle
+import hashlib
+import os
+import sys
+import threading
+import numpy as np
+import catalog
+import componenttree
+import diskcache
+import library
+import metrics
+import mylib
+
+STAGE_VERSION = 2 # to be increased when a stage gives other results
+
+def file_digest(path, block_size=1024*1024):
+    """
+    Hash the content of a file
+    :param path: path of the file
+    :param block_size: number of bytes read at once
+    :return: hexadecimal sha1 digest
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def value_size(value):
+    """
+    Estimate the memory used by a stage result
+    :param value: array, catalog, tuple of them or anything else
+    :return: number of bytes
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, catalog.Catalog):
+        return value.data.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(value_size(item) for item in value)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+class StageCache(object):
+    """
+    Class which stores the results of the stages:
+    - in memory, the least recently used results being dropped
+      when their total size exceeds max_memory
+    - on disk (diskcache.DiskCache) if a directory is given,
+      for the results which are worth being kept between runs
+    A key is 'digest-stage-parameters' so that the results of a file
+    or of a stage can be invalidated together. The parameters include
+    STAGE_VERSION and the dtype of the catalogs, so that the results
+    of an older code are not used.
+    """
+
+    def __init__(self, directory=None, max_memory=256*1024*1024, \
+                 max_bytes=1024*1024*1024, ttl=None):
+        """
+        Constructor of StageCache
+        :param directory: directory of the disk cache (None: memory only)
+        :param max_memory: maximum size of the results kept in memory
+        :param max_bytes: maximum size of the disk cache
+        :param ttl: time to live of the disk entries in seconds
+        """
+        self.memory = collections.OrderedDict() # key -> (value, size)
+        self.memory_bytes = 0
+        self.max_memory = max_memory
+        self.disk = None if directory is None else \
+                    diskcache.DiskCache(directory, ttl=ttl, max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.computing = {} # key -> threading.Event set when the result is stored
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def make_key(digest, stage, parameters):
+        """
+        Build the key of the result of a stage
+        :param digest: hash of the content of the fits file
+        :param stage: name of the stage
+        :param parameters: tuple of the parameters of the stage
+        """
+        # repr keeps all the digits of the floating point values
+        parameters = (STAGE_VERSION, catalog.CATALOG_DTYPE.descr) + tuple(parameters)
+        return '%s-%s-%s' % (digest, stage, \
+                             diskcache.make_key(*[repr(value) for value in parameters]))
+
+    def remember(self, key, value):
+        """
+        Keep a result in memory, dropping the least recently used ones
+        """
+        size = value_size(value)
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= self.memory.pop(key)[1]
+            if size > self.max_memory:
+                return
+            self.memory[key] = (value, size)
+            self.memory_bytes += size
+            while self.memory_bytes > self.max_memory:
+                _, (_, dropped) = self.memory.popitem(last=False)
+                self.memory_bytes -= dropped
+
+    def get(self, key, persist=True):
+        """
+        Return the result stored for key, None if it is missing
+        """
+        with self.lock:
+            if key in self.memory:
+                value, size = self.memory.pop(key)
+                self.memory[key] = (value, size) # most recently used
+                self.hits += 1
+                metrics.count('stage_cache_hits')
+                return value
+        if persist and self.disk is not None:
+            stored = self.disk.get(key)
+            if stored is not None:
+                value = pickle.loads(stored)
+                self.remember(key, value)
+                with self.lock:
+                    self.hits += 1
+                metrics.count('stage_cache_hits')
+                return value
+        with self.lock:
+            self.misses += 1
+        metrics.count('stage_cache_misses')
+        return None
+
+    def put(self, key, value, persist=True):
+        """
+        Store the result of a stage
+        :param persist: if False, the result is only kept in memory
+        """
+        self.remember(key, value)
+        if persist and self.disk is not None:
+            self.disk.put(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def cached(self, digest, stage, parameters, compute, persist=True):
+        """
+        Return the result of a stage, computing it only if it is not stored
+        :param digest: hash of the content of the fits file
+        :param stage: name of the stage
+        :param parameters: tuple of the parameters of the stage
+        :param compute: function without argument giving the result
+        :param persist: if False, the result is only kept in memory
+        """
+        key = self.make_key(digest, stage, parameters)
+        while True:
+            value = self.get(key, persist)
+            if value is not None:
+                return value
+
+            # A result being computed by another thread is waited for
+            with self.lock:
+                computing = self.computing.get(key)
+                if computing is None:
+                    self.computing[key] = threading.Event()
+            if computing is None:
+                break
+            computing.wait()
+
+        try:
+            value = compute()
+            self.put(key, value, persist)
+        finally:
+            with self.lock:
+                self.computing.pop(key).set()
+        return value
+
+    def invalidate(self, digest=None, stage=None):
+        """
+        Remove the results of a file and/or of a stage,
+        or all the results if neither is given
+        """
+        def matches(key):
+            """
+            Check whether a key belongs to the removed results
+            """
+            key_digest, key_stage, _ = key.split('-', 2)
+            return (digest is None or key_digest == digest) and \
+                   (stage is None or key_stage == stage)
+
+        with self.lock:
+            for key in [key for key in self.memory if matches(key)]:
+                self.memory_bytes -= self.memory.pop(key)[1]
+        if self.disk is not None:
+            if digest is None and stage is None:
+                self.disk.invalidate()
+            else:
+                for key in self.disk.keys():
+                    if matches(key):
+                        self.disk.invalidate(key)
+
+    def stats(self):
+        """
+        Return the counters of the cache
+        """
+        stats = {'hits': self.hits, 'misses': self.misses, \
+                 'memory_bytes': self.memory_bytes, 'memory_entries': len(self.memory)}
+        if self.disk is not None:
+            stats.update(('disk_' + name, value) for name, value in self.disk.stats().items())
+        return stats
+
+class Pipeline(object):
+    """
+    Class which runs the stages of the detection on fits files
+    through a StageCache: a stage is computed once per file content
+    and set of parameters. The results are shared, they must not
+    be modified by the caller.
+    """
+
+    def __init__(self, cache=None):
+        """
+        Constructor of Pipeline
+        :param cache: StageCache (default: memory only)
+        """
+        self.cache = StageCache() if cache is None else cache
+        self.digests = {} # (path, size, mtime) -> digest, to hash a file once
+
+    def digest(self, path):
+        """
+        Hash of the content of a fits file, computed again only
+        if the file was modified
+        """
+        status = os.stat(path)
+        signature = (os.path.abspath(path), status.st_size, status.st_mtime)
+        if signature not in self.digests:
+            self.digests[signature] = file_digest(path)
+        return self.digests[signature]
+
+    def pixels(self, path):
+        """
+        Same as mylib.get_pixels (memory only, the file being memory mapped)
+        """
+        def compute():
+            """
+            Read the file, an unreadable file is not stored
+            """
+            pixels, header = mylib.get_pixels(path)
+            if pixels is None:
+                raise IOError('cannot open %s' % path)
+            return pixels, header
+        try:
+            digest = self.digest(path)
+        except OSError:
+            print 'cannot open', path
+            return None, None
+        try:
+            return self.cache.cached(digest, 'pixels', (), compute, persist=False)
+        except IOError:
+            return None, None
+
+    def modelling_parameters(self, path):
+        """
+        Same as mylib.modelling_parameters on the picture of path
+        """
+        return self.cache.cached(self.digest(path), 'background', (), \
+            lambda: mylib.modelling_parameters(self.pixels(path)[0]))
+
+    def filtered_pixels(self, path, threshold=None):
+        """
+        Same as mylib.remove_background (memory only, as large as the picture)
+        """
+        def compute():
+            """
+            Remove the fitted background
+            """
+            _, _, _, background, dispersion = self.modelling_parameters(path)
+            return mylib.remove_background(self.pixels(path)[0], background, \
+                                           dispersion, threshold)
+        return self.cache.cached(self.digest(path), 'filtered', (threshold,), \
+                                 compute, persist=False)
+
+    def component_tree(self, path):
+        """
+        componenttree.ComponentTree of the picture of path above the
+        fitted background (memory only, as large as the picture)
+        """
+        def compute():
+            """
+            Build the tree
+            """
+            _, _, _, background, _ = self.modelling_parameters(path)
+            return componenttree.ComponentTree(self.pixels(path)[0], background, \
+                                               lowest=background)
+        return self.cache.cached(self.digest(path), 'tree', (), compute, persist=False)
+
+    def wcs(self, path):
+        """
+        WCS conversion object of the picture of path
+        """
+        return self.cache.cached(self.digest(path), 'wcs', (), \
+            lambda: library.WCS(self.pixels(path)[1]), persist=False)
+
+    def clusters(self, path, threshold=None, wcs=False, names=False, field_query=False):
+        """
+        Same as mylib.get_cluster_array on the picture of path
+        :param threshold: set another value for the threshold
+        :param wcs: if True, compute the celestial coordinates
+        :param names: if True, find the star names too
+        :param field_query: see mylib.get_cluster_array
+        :return: catalog.Catalog of the clusters
+        """
+        digest = self.digest(path)
+
+        def labelled():
+            """
+            Label the clusters
+            """
+            _, _, _, background, dispersion = self.modelling_parameters(path)
+            return mylib.get_cluster_array(self.pixels(path)[0], background, \
+                                           dispersion, threshold)
+
+        def converted():
+            """
+            Add the celestial coordinates to a copy of the clusters
+            """
+            cluster_array = catalog.Catalog( \
+                self.cache.cached(digest, 'labels', (threshold,), labelled).data.copy())
+            mylib.convert_clusters(cluster_array, self.wcs(path))
+            return cluster_array
+
+        def named():
+            """
+            Add the star names to a copy of the clusters with coordinates
+            """
+            cluster_array = catalog.Catalog( \
+                self.cache.cached(digest, 'radec', (threshold,), converted).data.copy())
+            mylib.name_clusters(cluster_array, self.wcs(path), \
+                                self.pixels(path)[0].shape, field_query)
+            return cluster_array
+
+        # The names are only kept in memory: the answers of Simbad
+        # expire in their own cache, and the source of the names
+        # (Simbad server or reference catalog) is part of the key
+        if names:
+            source = library.SIMBAD_HOST if library.REFERENCE_CATALOG is None \
+                     else 'reference-%d' % id(library.REFERENCE_CATALOG)
+            return self.cache.cached(digest, 'names', (threshold, field_query, source), \
+                                     named, persist=False)
+        if wcs:
+            return self.cache.cached(digest, 'radec', (threshold,), converted)
+        return self.cache.cached(digest, 'labels', (threshold,), labelled)
+
+    def invalidate(self, path=None, stage=None):
+        """
+        Forget the results of a file and/or of a stage
+        :param path: path of the fits file (None: every file)
+        :param stage: 'pixels', 'background', 'filtered', 'tree', 'wcs',
+                      'labels', 'radec' or 'names' (None: every stage)
+        """
+        digest = None
+        if path is not None:
+            digest = self.digest(path)
+            for signature in [signature for signature, value in self.digests.items() \
+                              if value == digest]:
+                del self.digests[signature]
+        self.cache.invalidate(digest, stage)
+
+    def prepare(self, path):
+        """
+        Run the stages needed to display the picture of path
+        without background
+        """
+        self.modelling_parameters(path)
+        self.filtered_pixels(path)
+
+class Prefetcher(object):
+    """
+    Class which prepares pictures in a background thread, so that they
+    are already in the cache of the pipeline when they are asked for.
+    Only the latest list of paths is prefetched.
+    """
+
+    def __init__(self, pipeline):
+        """
+        Constructor of Prefetcher
+        :param pipeline: Pipeline whose cache is filled
+        """
+        self.pipeline = pipeline
+        self.paths = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prefetch(self, paths):
+        """
+        Replace the paths waiting to be prepared
+        """
+        with self.condition:
+            self.paths = list(paths)
+            self.condition.notify()
+
+    def run(self):
+        """
+        Loop of the thread
+        """
+        while True:
+            with self.condition:
+                while not self.paths:
+                    self.condition.wait()
+                path = self.paths.pop(0)
+            try:
+                self.pipeline.prepare(path)
+            # pylint: disable=broad-except
+            except Exception: # the file will be reported when it is asked for
+                pass
+
+def default_pipeline(max_memory=256*1024*1024):
+    """
+    Pipeline used by the scripts, the results being kept in ../cache/stages
+    :param max_memory: maximum size of the results kept in memory
+    """
+    return Pipeline(StageCache("../cache/stages", max_memory=max_memory))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Star finder:
+Headless command which writes the results of the five exercises
+and the catalog of the clusters without any display. The heavy
+modules (astropy, scipy) are only imported by the subcommands
+which need them, matplotlib never is, and the import times can be
+reported.
+"""
+
+import argparse
+import importlib
+import os
+import sys
+import time
+
+IMPORT_TIMES = [] # (module, seconds) in the order of the imports
+
+def timed_import(name):
+    """
+    Import a module, recording the time it took if it was not loaded yet
+    :param name: name of the module
+    :return: the module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.time()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.append((name, time.time() - start))
+    return module
+
+# Modules needed by each subcommand, beyond mylib
+NEEDED_MODULES = {'ex1': ['astropy.io.fits'], \
+                  'ex2': ['astropy.io.fits', 'scipy.optimize'], \
+                  'ex3': ['astropy.io.fits', 'scipy.optimize', 'scipy.ndimage'], \
+                  'ex4': ['astropy.io.fits', 'scipy.optimize', 'scipy.ndimage', 'astropy.wcs'], \
+                  'ex5': ['astropy.io.fits', 'scipy.optimize', 'scipy.ndimage', 'astropy.wcs'], \
+                  'catalog': ['astropy.io.fits', 'scipy.optimize', 'scipy.ndimage']}
+
+def write_result(args, name, results):
+    """
+    Write the result line of an exercise in exN.txt and print it
+    """
+    with open(os.path.join(args.output_dir, '%s.txt' % name), 'w') as output_file:
+        output_file.write(results)
+    print '%s: %s' % (name, results)
+
+def find_clusters(args, mylib, my_wcs=None):
+    """
+    Fit the background and find the clusters of the picture
+    :return: catalog.Catalog of the clusters
+    """
+    pixels, _ = mylib.get_pixels(args.path)
+    _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
+    return mylib.get_cluster_array(pixels, background, dispersion, \
+                                   args.threshold, my_wcs=my_wcs)
+
+def use_names_source(args, library):
+    """
+    Name the clusters from the reference catalog if one is given,
+    else from Simbad through its cache
+    """
+    if args.reference is not None:
+        library.use_reference(args.reference)
+    else:
+        library.use_simbad_cache(args.simbad_cache, offline=args.offline)
+
+def run_ex1(args, mylib):
+    """
+    Exercise 1: transformation matrix of the header
+    """
+    _, header = mylib.get_pixels(args.path)
+    write_result(args, 'ex1', 'cd1_1: %.10f, cd1_2: %.10f, cd2_1: %.10f, cd2_2: %.10f' % \
+                 (header['CD1_1'], header['CD1_2'], header['CD2_1'], header['CD2_2']))
+
+def run_ex2(args, mylib):
+    """
+    Exercise 2: background and dispersion
+    """
+    pixels, _ = mylib.get_pixels(args.path)
+    _, _, _, background, dispersion = mylib.modelling_parameters(pixels)
+    write_result(args, 'ex2', 'background: %i, dispersion: %i' % (background, dispersion))
+
+def run_ex3(args, mylib):
+    """
+    Exercise 3: clusters and the one with the greatest integral
+    """
+    cluster_array = find_clusters(args, mylib)
+    main_clust = mylib.find_main_centroid(cluster_array)
+    write_result(args, 'ex3', 'number of clusters: %2d, ' % (len(cluster_array)) \
+                 + 'greatest integral: %7d, ' % (main_clust.integrated_luminosity) \
+                 + 'centroid x: %4.1f, centroid y: %4.1f' % \
+                   (main_clust.centroid_pixel[0], main_clust.centroid_pixel[1]))
+
+def run_ex4(args, mylib):
+    """
+    Exercise 4: celestial coordinates of the main cluster
+    """
+    library = timed_import('library')
+    _, header = mylib.get_pixels(args.path)
+    cluster_array = find_clusters(args, mylib)
+    mylib.convert_clusters(cluster_array, library.WCS(header))
+    main_clust = mylib.find_main_centroid(cluster_array)
+    write_result(args, 'ex4', 'right ascension: %.3f, declination: %.3f' % \
+                 (main_clust.centroid_wcs[0], main_clust.centroid_wcs[1]))
+
+def run_ex5(args, mylib):
+    """
+    Exercise 5: name of the main celestial object
+    """
+    library = timed_import('library')
+    use_names_source(args, library)
+    _, header = mylib.get_pixels(args.path)
+    cluster_array = find_clusters(args, mylib, library.WCS(header))
+    main_clust = mylib.find_main_centroid(cluster_array)
+    write_result(args, 'ex5', 'celestial object: %s' % (main_clust.star_name))
+
+def run_catalog(args, mylib):
+    """
+    Catalog of all the clusters, with their coordinates and names if asked
+    """
+    catalog = timed_import('catalog')
+    pixels, header = mylib.get_pixels(args.path)
+    cluster_array = find_clusters(args, mylib)
+    if args.wcs or args.names:
+        library = timed_import('library')
+        my_wcs = library.WCS(header)
+        mylib.convert_clusters(cluster_array, my_wcs)
+        if args.names:
+            use_names_source(args, library)
+            mylib.name_clusters(cluster_array, my_wcs, pixels.shape, field_query=True)
+    catalog.write_catalog(cluster_array, args.output, [args.path])
+    print 'catalog: %d clusters written to %s' % (len(cluster_array), args.output)
+
+COMMANDS = {'ex1': run_ex1, 'ex2': run_ex2, 'ex3': run_ex3, 'ex4': run_ex4, \
+            'ex5': run_ex5, 'catalog': run_catalog}
+
+def main():
+    """
+    Parse the command line and run the subcommands
+    """
+    start = time.time()
+    parser = argparse.ArgumentParser(description='Find the stars of a fits file ' \
+                                                 'without display')
+    parser.add_argument('commands', nargs='+', choices=sorted(COMMANDS) + ['all'], \
+                        help='results to produce (all: ex1 to ex5)')
+    parser.add_argument('--path', default='../data/specific.fits', \
+                        help='fits file (default: ../data/specific.fits)')
+    parser.add_argument('--output-dir', default='.', \
+                        help='directory of the exN.txt files (default: .)')
+    parser.add_argument('-o', '--output', default='catalog.txt', \
+                        help='catalog file, .npy, .npz, .fits or text ' \
+                             '(default: catalog.txt)')
+    parser.add_argument('--threshold', type=float, default=None, \
+                        help='threshold (default: 6 dispersions above the background)')
+    parser.add_argument('--wcs', action='store_true', \
+                        help='add the celestial coordinates to the catalog')
+    parser.add_argument('--names', action='store_true', \
+                        help='add the star names to the catalog')
+    parser.add_argument('--simbad-cache', default='../cache/simbad', \
+                        help='directory of the Simbad answers (default: ../cache/simbad)')
+    parser.add_argument('--offline', action='store_true', \
+                        help='only use the cached Simbad answers')
+    parser.add_argument('--reference', default=None, \
+                        help='name the clusters from this reference catalog ' \
+                             'instead of Simbad (see refcatalog.py)')
+    parser.add_argument('--import-times', action='store_true', \
+                        help='report the time spent importing modules')
+    args = parser.parse_args()
+
+    commands = []
+    for command in args.commands:
+        for name in (['ex1', 'ex2', 'ex3', 'ex4', 'ex5'] if command == 'all' else [command]):
+            if name not in commands:
+                commands.append(name)
+
+    # Import only what the commands need
+    mylib = timed_import('mylib')
+    for command in commands:
+        for name in NEEDED_MODULES[command]:
+            timed_import(name)
+
+    for command in commands:
+        COMMANDS[command](args, mylib)
+
+    if args.import_times:
+        total = sum(seconds for _, seconds in IMPORT_TIMES)
+        for name, seconds in IMPORT_TIMES:
+            print >> sys.stderr, 'import %-16s %8.1f ms' % (name, 1e3 * seconds)
+        print >> sys.stderr, 'imports %.1f ms of %.1f ms, matplotlib loaded: %s' % \
+              (1e3 * total, 1e3 * (time.time() - start), 'matplotlib' in sys.modules)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which runs the detection on horizontal strips of the picture,
+so that the memory used depends on the size of a strip and not on
+the size of the picture. The results are the same as the ones of
+mylib on the whole picture held in memory.
+"""
+
+import numpy as np
+from scipy import ndimage
+import catalog
+import metrics
+import mylib
+
+def strip_bounds(n_row, strip_rows):
+    """
+    Give the first and last (excluded) rows of each strip
+    :param n_row: number of rows of the picture
+    :param strip_rows: number of rows of a strip
+    :return: list of (start, stop)
+    """
+    return [(start, min(start + strip_rows, n_row)) \
+            for start in range(0, n_row, strip_rows)]
+
+def strip_histogram(image, strip_rows=1024, nbins=200):
+    """
+    Build the pixel distribution of the picture strip by strip,
+    with the same bins as numpy.histogram(pixels.ravel(), nbins):
+    integers of 8 or 16 bits are counted in a single pass,
+    other types need a first pass to get the extreme values
+    :param image: fitsimage.FitsImage or 2D array
+    :param strip_rows: number of rows of a strip
+    :param nbins: number of bins
+    :return: number of pixels in each bin and boundaries of the bins
+    """
+    bounds = strip_bounds(image.shape[0], strip_rows)
+    dtype = np.dtype(image.dtype)
+
+    if dtype.kind in 'iu' and dtype.itemsize <= 2:
+        # Count every possible value, then regroup them in the bins
+        lowest = np.iinfo(dtype).min
+        counts = np.zeros(2**(8*dtype.itemsize), dtype=np.int64)
+        for start, stop in bounds:
+            strip = image[start:stop].ravel().astype(np.int64)
+            counts += np.bincount(strip - lowest, minlength=len(counts))
+        present = np.flatnonzero(counts)
+        values = present + lowest
+        bin_values, bin_boundaries = np.histogram( \
+            values, nbins, range=(values[0], values[-1]), weights=counts[present])
+        return bin_values.astype(np.int64), bin_boundaries
+
+    # Find the extreme values first
+    lowest, highest = np.inf, -np.inf
+    for start, stop in bounds:
+        strip = image[start:stop]
+        lowest = min(lowest, strip.min())
+        highest = max(highest, strip.max())
+    bin_values = np.zeros(nbins, dtype=np.int64)
+    for start, stop in bounds:
+        counts, bin_boundaries = np.histogram(image[start:stop].ravel(), nbins, \
+                                              range=(lowest, highest))
+        bin_values += counts
+    return bin_values, bin_boundaries
+
+@metrics.timed('background_fit')
+def strip_modelling_parameters(image, strip_rows=1024):
+    """
+    Same as mylib.modelling_parameters, strip by strip
+    :param image: fitsimage.FitsImage or 2D array
+    :param strip_rows: number of rows of a strip
+    :return: data values and fitted values
+    """
+    bin_values, bin_boundaries = strip_histogram(image, strip_rows)
+    return mylib.fit_histogram(bin_values, bin_boundaries)
+
+def strip_of(value, start, stop):
+    """
+    Give the rows of a map from start to stop (excluded),
+    or the value itself if it is a single value
+    """
+    if np.ndim(value) == 0:
+        return value
+    return value[start:stop]
+
+def iter_filtered_strips(image, background, dispersion, threshold=None, strip_rows=1024):
+    """
+    Same as mylib.remove_background, strip by strip
+    :param image: fitsimage.FitsImage or 2D array
+    :param background: mean background value (or 2D map)
+    :param dispersion: dispersion of the background (or 2D map)
+    :param threshold: set another value (or 2D map) for the threshold
+    :param strip_rows: number of rows of a strip
+    :return: iterator over (first row, filtered strip)
+    """
+    for start, stop in strip_bounds(image.shape[0], strip_rows):
+        yield start, mylib.remove_background( \
+            image[start:stop], strip_of(background, start, stop), \
+            strip_of(dispersion, start, stop), strip_of(threshold, start, stop))
+
+class UnionFind(object):
+    """
+    Class which merges the labels of the clusters crossing
+    the boundaries between strips, the smallest label of a set
+    (the one met first) being its root
+    """
+
+    def __init__(self):
+        """
+        Constructor of UnionFind
+        """
+        self.parent = np.zeros(1, dtype=np.int64)
+        self.size = 1 # label 0 is the background
+
+    def add(self, count):
+        """
+        Add count new labels
+        :return: the first new label
+        """
+        first = self.size
+        if self.size + count > len(self.parent):
+            parent = np.zeros(max(2 * len(self.parent), self.size + count), dtype=np.int64)
+            parent[:self.size] = self.parent[:self.size]
+            self.parent = parent
+        self.parent[first:first + count] = np.arange(first, first + count)
+        self.size += count
+        return first
+
+    def find(self, label):
+        """
+        Find the root of a label
+        """
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root: # path compression
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, label1, label2):
+        """
+        Merge the sets of two labels
+        """
+        root1, root2 = self.find(label1), self.find(label2)
+        if root1 != root2:
+            self.parent[max(root1, root2)] = min(root1, root2)
+
+    def roots(self):
+        """
+        Give the root of every label
+        """
+        # roots are smaller than their children: jump to the grand parents
+        # until every label points to its root
+        parent = self.parent[:self.size]
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                return parent
+            parent = grand_parent
+
+def merge_sums(parts, roots):
+    """
+    Merge the sums of the parts of the clusters
+    :param parts: dictionary of the sums of every part (see mylib.cluster_sums)
+    :param roots: root label of every part
+    :return: sums of every cluster, ordered by root label
+    """
+    unique_roots, index = np.unique(roots, return_inverse=True)
+    count = len(unique_roots)
+    if count == 0:
+        return parts
+    sums = {}
+    for name in ('xmin', 'ymin'):
+        sums[name] = np.full(count, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(sums[name], index, parts[name])
+    for name in ('xmax', 'ymax'):
+        sums[name] = np.full(count, -1, dtype=np.int64)
+        np.maximum.at(sums[name], index, parts[name])
+
+    # Move the sums of the positions of every part to the corner of
+    # the bounding box of its cluster
+    shift_x = (parts['xmin'] - sums['xmin'][index]).astype(np.float64)
+    shift_y = (parts['ymin'] - sums['ymin'][index]).astype(np.float64)
+    flux = parts['flux']
+    shifted = {'sum_x': parts['sum_x'] + flux * shift_x, \
+               'sum_y': parts['sum_y'] + flux * shift_y, \
+               'sum_xx': parts['sum_xx'] + 2. * shift_x * parts['sum_x'] + flux * shift_x**2, \
+               'sum_yy': parts['sum_yy'] + 2. * shift_y * parts['sum_y'] + flux * shift_y**2, \
+               'sum_xy': parts['sum_xy'] + shift_x * parts['sum_y'] + \
+                         shift_y * parts['sum_x'] + flux * shift_x * shift_y}
+    for name in ('npix', 'luminosity', 'flux', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy'):
+        sums[name] = np.bincount(index, weights=shifted.get(name, parts[name]), minlength=count)
+    sums['npix'] = np.rint(sums['npix']).astype(np.int64)
+
+    # The peak is the highest value, the last one in reading order if equal
+    order = np.lexsort((parts['xpeak'], parts['ypeak'], parts['peak'], index))
+    last = np.append(np.flatnonzero(np.diff(index[order])), len(order) - 1)
+    for name in ('peak', 'xpeak', 'ypeak'):
+        sums[name] = parts[name][order][last]
+    return sums
+
+# pylint: disable=too-many-locals
+@metrics.timed('labelling')
+def strip_catalog(image, background, dispersion, threshold=None, strip_rows=1024):
+    """
+    Same as mylib.get_cluster_array (without WCS), strip by strip:
+    each strip is labelled on its own, and the clusters crossing
+    the boundary with the previous strip are merged
+    :param image: fitsimage.FitsImage or 2D array
+    :param background: mean background value (or 2D map)
+    :param dispersion: dispersion of the background (or 2D map)
+    :param threshold: set another value (or 2D map) for the threshold
+    :param strip_rows: number of rows of a strip
+    :return: catalog.Catalog of the clusters
+    """
+    if threshold is None:
+        threshold = background + 6.0 * dispersion # threshold value
+    union_find = UnionFind()
+    parts = [] # sums of the parts of the clusters in each strip
+    previous_row = None # labels of the last row of the previous strip
+    integer = np.dtype(image.dtype).kind in 'iu'
+
+    for start, stop in strip_bounds(image.shape[0], strip_rows):
+        pixels = image[start:stop]
+        labels = np.zeros(pixels.shape, dtype=np.int32)
+        nlabels = ndimage.label(pixels >= strip_of(threshold, start, stop), output=labels)
+        parts.append(mylib.cluster_sums(pixels, labels, nlabels, \
+                                        strip_of(background, start, stop), start))
+
+        # Give global labels to the clusters of the strip
+        first = union_find.add(nlabels)
+        first_row = np.where(labels[0] > 0, labels[0] + first - 1, 0)
+
+        # Merge the clusters touching each other across the boundary
+        if previous_row is not None:
+            touching = (previous_row > 0) & (first_row > 0)
+            pairs = set(zip(previous_row[touching], first_row[touching]))
+            for label1, label2 in pairs:
+                union_find.union(label1, label2)
+        previous_row = np.where(labels[-1] > 0, labels[-1] + first - 1, 0)
+
+    # Gather the parts of each cluster
+    names = parts[0].keys()
+    all_parts = {name: np.concatenate([part[name] for part in parts]) for name in names}
+    roots = union_find.roots()[1:]
+    stats = mylib.cluster_moments(merge_sums(all_parts, roots))
+    if integer:
+        stats['luminosity'] = np.rint(stats['luminosity']).astype(np.int64)
+    metrics.count('pixels_scanned', image.shape[0] * image.shape[1])
+    metrics.count('clusters_found', len(stats['npix']))
+    return catalog.from_statistics(stats)
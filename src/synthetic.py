@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which writes synthetic star fields in fits files: gaussian stars
+with a power law distribution of fluxes over a noisy background,
+with a TAN projection WCS, and the list of the stars as ground truth.
+The picture is generated and written by strips, so that fields larger
+than the memory can be made.
+"""
+
+import argparse
+import sys
+import numpy as np
+from astropy.io import fits
+
+SATURATION = 32767 # highest value of the 16 bits pixels
+
+def make_header(shape, ra=148.9, dec=69.3, scale=1.5/3600):
+    """
+    Build the header of a 16 bits picture with a TAN projection
+    :param shape: shape of the picture
+    :param ra, dec: celestial coordinates of the center, in degree
+    :param scale: size of a pixel, in degree
+    :return: astropy.io.fits.Header
+    """
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = 16
+    header['NAXIS'] = 2
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = (shape[1] + 1) / 2.
+    header['CRPIX2'] = (shape[0] + 1) / 2.
+    header['CRVAL1'] = ra
+    header['CRVAL2'] = dec
+    header['CDELT1'] = -scale
+    header['CDELT2'] = scale
+    return header
+
+def make_stars(shape, density=1e-3, flux_min=500., flux_max=5e5, slope=1.5, seed=0):
+    """
+    Draw the stars of a field
+    :param shape: shape of the picture
+    :param density: number of stars per pixel
+    :param flux_min, flux_max: range of the integrated fluxes
+    :param slope: the number of stars brighter than f goes as f**-slope
+    :param seed: seed of the random generator
+    :return: structured array with the columns x, y and flux
+    """
+    random = np.random.RandomState(seed)
+    count = random.poisson(density * shape[0] * shape[1])
+    stars = np.zeros(count, dtype=[('x', np.float64), ('y', np.float64), \
+                                   ('flux', np.float64)])
+    stars['x'] = random.uniform(-0.5, shape[1] - 0.5, count)
+    stars['y'] = random.uniform(-0.5, shape[0] - 0.5, count)
+
+    # Inverse of the cumulative distribution of a truncated power law
+    low, high = flux_min**-slope, flux_max**-slope
+    stars['flux'] = (low - random.uniform(0, 1, count) * (low - high))**(-1. / slope)
+    return stars[np.argsort(stars['y'], kind='mergesort')]
+
+def render_strip(stars, start, stop, n_column, sigma=1.5):
+    """
+    Add up the gaussian profiles of the stars on a strip of rows
+    :param stars: array given by make_stars, sorted by row
+    :param start, stop: first and last (excluded) rows of the strip
+    :param n_column: number of columns of the picture
+    :param sigma: dispersion of the profiles, in pixels
+    :return: 2D float64 array of the strip
+    """
+    radius = int(np.ceil(4 * sigma))
+    first, last = np.searchsorted(stars['y'], (start - radius - 1, stop + radius + 1))
+    near = stars[first:last]
+    strip = np.zeros((stop - start) * n_column, dtype=np.float64)
+    if len(near) == 0:
+        return strip.reshape(stop - start, n_column)
+
+    # Stamp of every star around its nearest pixel
+    offsets = np.arange(-radius, radius + 1)
+    columns = np.rint(near['x']).astype(np.int64)[:, np.newaxis, np.newaxis] + \
+              offsets[np.newaxis, np.newaxis, :]
+    rows = np.rint(near['y']).astype(np.int64)[:, np.newaxis, np.newaxis] + \
+           offsets[np.newaxis, :, np.newaxis]
+    columns, rows = np.broadcast_arrays(columns, rows)
+    distance2 = (columns - near['x'][:, np.newaxis, np.newaxis])**2 + \
+                (rows - near['y'][:, np.newaxis, np.newaxis])**2
+    values = near['flux'][:, np.newaxis, np.newaxis] / (2 * np.pi * sigma**2) * \
+             np.exp(-distance2 / (2 * sigma**2))
+    inside = (rows >= start) & (rows < stop) & (columns >= 0) & (columns < n_column)
+    index = (rows[inside] - start) * n_column + columns[inside]
+    strip += np.bincount(index, weights=values[inside], minlength=len(strip))
+    return strip.reshape(stop - start, n_column)
+
+# pylint: disable=too-many-arguments
+def write_field(path, shape, density=1e-3, background=1000., noise=10., \
+                sigma=1.5, flux_min=500., flux_max=5e5, slope=1.5, seed=0, \
+                strip_rows=1024):
+    """
+    Write a synthetic field in a fits file and its stars in path.truth
+    :param path: path of the fits file
+    :param shape: shape of the picture
+    :param density: number of stars per pixel
+    :param background: mean value of the background
+    :param noise: dispersion of the background
+    :param sigma: dispersion of the star profiles, in pixels
+    :param flux_min, flux_max, slope: distribution of the fluxes (see make_stars)
+    :param seed: seed of the random generator
+    :param strip_rows: number of rows generated at once
+    :return: the stars (see make_stars)
+    """
+    stars = make_stars(shape, density, flux_min, flux_max, slope, seed)
+    random = np.random.RandomState(seed + 1)
+    stream = fits.StreamingHDU(path, make_header(shape))
+    for start in range(0, shape[0], strip_rows):
+        stop = min(start + strip_rows, shape[0])
+        strip = render_strip(stars, start, stop, shape[1], sigma) + \
+                random.normal(background, noise, (stop - start, shape[1]))
+        stream.write(np.clip(np.rint(strip), 0, SATURATION).astype('>i2'))
+    stream.close()
+
+    np.savetxt(path + '.truth', np.column_stack((stars['x'], stars['y'], stars['flux'])), \
+               fmt='%.3f', delimiter='\t', header='x\ty\tflux')
+    return stars
+
+def read_truth(path):
+    """
+    Read the stars written with a synthetic field
+    :param path: path of the fits file
+    :return: structured array with the columns x, y and flux
+    """
+    return np.atleast_1d(np.genfromtxt(path + '.truth', names=('x', 'y', 'flux'), \
+                                       delimiter='\t'))
+
+def main():
+    """
+    Write a synthetic field
+    """
+    parser = argparse.ArgumentParser(description='Write a synthetic star field')
+    parser.add_argument('path', help='fits file to write')
+    parser.add_argument('--size', type=int, default=1024, help='number of rows and columns')
+    parser.add_argument('--density', type=float, default=1e-3, help='stars per pixel')
+    parser.add_argument('--background', type=float, default=1000., help='background level')
+    parser.add_argument('--noise', type=float, default=10., help='background dispersion')
+    parser.add_argument('--sigma', type=float, default=1.5, help='width of the stars')
+    parser.add_argument('--flux-min', type=float, default=500., help='faintest flux')
+    parser.add_argument('--flux-max', type=float, default=5e5, help='brightest flux')
+    parser.add_argument('--slope', type=float, default=1.5, help='slope of the flux law')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    stars = write_field(args.path, (args.size, args.size), args.density, \
+                        args.background, args.noise, args.sigma, \
+                        args.flux_min, args.flux_max, args.slope, args.seed)
+    print '%d stars written in %s (truth in %s.truth)' % (len(stars), args.path, args.path)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
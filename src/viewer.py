@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module which contains the classes used by the interactive scripts
+to redraw the picture quickly while a slider is dragged:
+- Worker runs the computations in a thread, the superseded ones
+  being cancelled
+- ThresholdViewer keeps a single image, updates it with set_data,
+  and redraws only the image and its title (blitting)
+- CoordinateReadout shows the celestial coordinates under the mouse,
+  read in a library.SkyGrid and redrawn at most at the refresh rate
+"""
+
+import threading
+import time
+
+class Worker(object):
+    """
+    Class which runs a function in a background thread, only the
+    latest submitted arguments being computed: a computation which
+    is superseded before it starts is skipped, and its result is
+    dropped if it was already running
+    """
+
+    def __init__(self, function):
+        """
+        Constructor of Worker
+        :param function: function(*args, cancelled=callable) where
+                         cancelled() becomes True once the computation
+                         is superseded, so that it can stop early
+        """
+        self.function = function
+        self.condition = threading.Condition()
+        self.generation = 0 # number of the latest submission
+        self.pending = None # (generation, args) waiting to be computed
+        self.computing = None # generation of the running computation
+        self.result = None # (generation, args, result) of the latest computation
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, *args):
+        """
+        Ask for a computation, cancelling the previous ones
+        :return: number of the submission
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, args)
+            self.condition.notify()
+            return self.generation
+
+    def cancel(self):
+        """
+        Cancel the submitted computations
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = None
+
+    def cancelled(self, generation):
+        """
+        Check whether a submission was superseded
+        """
+        return generation != self.generation or not self.running
+
+    def run(self):
+        """
+        Loop of the thread
+        """
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                generation, args = self.pending
+                self.pending = None
+                self.computing = generation
+            result = self.function(*args, cancelled=lambda: self.cancelled(generation))
+            with self.condition:
+                self.computing = None
+                if not self.cancelled(generation):
+                    self.result = (generation, args, result)
+                    self.condition.notify_all()
+
+    def busy(self):
+        """
+        Check whether a submission is waiting or being computed
+        """
+        with self.condition:
+            return self.pending is not None or self.computing is not None
+
+    def take(self):
+        """
+        Take the result of the latest submission, if it is done
+        :return: (args, result) or None
+        """
+        with self.condition:
+            if self.result is None or self.cancelled(self.result[0]):
+                return None
+            _, args, result = self.result
+            self.result = None
+            return args, result
+
+    def wait(self, timeout=None):
+        """
+        Wait for the result of the latest submission
+        :return: (args, result) or None after timeout seconds
+        """
+        with self.condition:
+            if self.result is None or self.cancelled(self.result[0]):
+                self.condition.wait(timeout)
+        return self.take()
+
+    def stop(self):
+        """
+        Stop the thread, the running computation is cancelled
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+class ThresholdViewer(object):
+    """
+    Class which displays a picture computed from a threshold:
+    - the image and the title are animated artists, drawn over a copy
+      of the rest of the figure which is taken at each full draw
+    - the slider events are throttled: a threshold is computed at once
+      when the worker is idle and the previous computation started at
+      least interval seconds ago, the latest threshold being computed
+      afterwards (so that the picture follows the slider while dragging)
+    - the computation runs in a Worker, the results being
+      polled from the GUI thread by a timer
+    """
+
+    def __init__(self, fig, axis, compute, interval=0.05, poll=0.02):
+        """
+        Constructor of ThresholdViewer
+        :param fig: matplotlib figure
+        :param axis: axis of the picture
+        :param compute: function(threshold, cancelled=callable) giving
+                        (pixels, title), called in the worker thread
+        :param interval: minimum time between two computations, in seconds
+        :param poll: period of the check of the results and of the
+                     latest threshold, in seconds
+        """
+        self.fig = fig
+        self.axis = axis
+        self.image = None
+        self.title = None
+        self.background = None # copy of the figure without the animated artists
+        self.threshold = None # latest threshold asked
+        self.submitted = None # latest threshold given to the worker
+        self.interval = interval
+        self.last_submit = 0.
+        self.worker = Worker(compute)
+
+        canvas = fig.canvas
+        self.blit_supported = hasattr(canvas, 'copy_from_bbox')
+        canvas.mpl_connect('draw_event', self.on_draw)
+        canvas.mpl_connect('close_event', lambda event: self.worker.stop())
+        self.poll_timer = canvas.new_timer(interval=int(1000 * poll))
+        self.poll_timer.add_callback(self.poll)
+        self.poll_timer.start()
+
+    def show(self, pixels, title):
+        """
+        Display a new picture with a full redraw (its shape may change),
+        the computations for the previous one being cancelled
+        """
+        self.threshold = self.submitted = None
+        self.worker.cancel()
+        if self.image is None:
+            self.image = self.axis.imshow(pixels, animated=True)
+            self.title = self.axis.set_title(title, animated=True)
+        else:
+            self.image.set_data(pixels)
+            self.image.set_extent((-0.5, pixels.shape[1] - 0.5, pixels.shape[0] - 0.5, -0.5))
+            self.axis.set_xlim(-0.5, pixels.shape[1] - 0.5)
+            self.axis.set_ylim(pixels.shape[0] - 0.5, -0.5)
+            self.image.autoscale()
+            self.title.set_text(title)
+        self.fig.canvas.draw_idle()
+
+    def on_draw(self, _event):
+        """
+        Function called after a full draw: keep a copy of the figure
+        and draw the animated artists over it
+        """
+        if self.blit_supported:
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        """
+        Draw the image and the title
+        """
+        if self.image is not None:
+            self.axis.draw_artist(self.image)
+            self.axis.draw_artist(self.title)
+
+    def update(self, pixels, title):
+        """
+        Display a picture of the same shape, only the image and
+        the title being redrawn
+        """
+        self.image.set_data(pixels)
+        self.image.autoscale()
+        self.title.set_text(title)
+        if self.background is None:
+            self.fig.canvas.draw_idle()
+            return
+        self.fig.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.fig.canvas.blit(self.fig.bbox)
+
+    def on_changed(self, threshold):
+        """
+        Function called by the slider: compute the threshold at once
+        if possible, else poll computes it later
+        """
+        self.threshold = threshold
+        self.start_computation()
+
+    def start_computation(self):
+        """
+        Submit the latest threshold to the worker, if it was not
+        submitted yet, the worker is idle and the interval has passed
+        """
+        if self.threshold is None or self.threshold == self.submitted:
+            return
+        if self.worker.busy() or time.time() - self.last_submit < self.interval:
+            return
+        self.submitted = self.threshold
+        self.last_submit = time.time()
+        self.worker.submit(self.threshold)
+
+    def poll(self):
+        """
+        Display the result of the latest computation, if it is done,
+        and submit the latest threshold
+        """
+        done = self.worker.take()
+        if done is not None:
+            self.update(*done[1])
+        self.start_computation()
+
+class CoordinateReadout(object):
+    """
+    Class which displays the ascension/declination of the pixel pointed
+    by the mouse: the coordinates are read in a grid, only the text is
+    redrawn over a copy of the figure, and the updates closer than
+    a refresh period are merged (the last position being drawn
+    at the end of the period)
+    """
+
+    def __init__(self, fig, axis, sky_grid, refresh_rate=60.):
+        """
+        Constructor of CoordinateReadout
+        :param fig: matplotlib figure
+        :param axis: axis of the picture
+        :param sky_grid: library.SkyGrid of the picture
+        :param refresh_rate: maximum number of updates per second
+        """
+        self.fig = fig
+        self.axis = axis
+        self.sky_grid = sky_grid
+        self.period = 1. / refresh_rate
+        self.last_update = 0.
+        self.position = None # latest position of the mouse
+        self.background = None
+        self.text = axis.text(0, 0, '', fontsize=14, color='white', animated=True)
+
+        canvas = fig.canvas
+        self.blit_supported = hasattr(canvas, 'copy_from_bbox')
+        canvas.mpl_connect('draw_event', self.on_draw)
+        canvas.mpl_connect('motion_notify_event', self.on_move)
+        self.timer = canvas.new_timer(interval=int(1000 * self.period))
+        self.timer.single_shot = True
+        self.timer.add_callback(self.update)
+
+    def on_draw(self, _event):
+        """
+        Function called after a full draw: keep a copy of the figure
+        """
+        if self.blit_supported:
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.axis.draw_artist(self.text)
+
+    def on_move(self, event):
+        """
+        Function called when the event 'motion_notify_event' occurs
+        """
+        self.position = (event.xdata, event.ydata) if event.inaxes is self.axis else None
+        if time.time() - self.last_update >= self.period:
+            self.update()
+        else:
+            self.timer.stop()
+            self.timer.start()
+
+    def update(self):
+        """
+        Write the coordinates of the latest position at its location
+        """
+        self.last_update = time.time()
+        sky = None if self.position is None else self.sky_grid.lookup(*self.position)
+        if sky is None:
+            self.text.set_text('')
+        else:
+            self.text.set_position(self.position)
+            self.text.set_text('ra: %.6f, dec: %.6f' % sky)
+        if self.background is None:
+            self.fig.canvas.draw_idle()
+            return
+        self.fig.canvas.restore_region(self.background)
+        self.axis.draw_artist(self.text)
+        self.fig.canvas.blit(self.fig.bbox)
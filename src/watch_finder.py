@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Watch:
+Service which watches a directory and finds the clusters of every new
+fits file. The files go through stages linked by bounded queues:
+read -> detect (background and labelling) -> wcs -> names -> write.
+The stages waiting for the disk or the network run in threads, the
+detection runs in a pool of processes. A full queue blocks the stage
+before it, up to the watcher which then stops taking new files, so
+the memory stays bounded when the files come faster than they are
+processed. On SIGINT or SIGTERM the files already taken are finished
+before the service stops.
+"""
+
+import argparse
+import collections
+import fnmatch
+import os
+import Queue
+import signal
+import sys
+import threading
+import time
+import traceback
+import multiprocessing
+import numpy as np
+from background import ESTIMATORS, get_estimator
+import catalog
+import library
+import metrics
+import mylib
+
+STOP = None # item closing a queue, sent after the last file
+CATALOG_SUFFIX = '_clusters' # end of the names of the catalogs, before the extension
+TEMPORARY_PREFIX = '.tmp-' # start of the names of the catalogs being written
+
+class Plate(object):
+    """
+    Class which carries a file through the stages
+    """
+
+    def __init__(self, path):
+        """
+        Constructor of Plate
+        :param path: path of the fits file
+        """
+        self.path = path
+        self.pixels = None
+        self.header = None
+        self.shape = None
+        self.wcs = None
+        self.clusters = None
+        self.error = None
+        self.started = time.time()
+
+def put(queue, item, stop_event=None, timeout=0.2):
+    """
+    Put an item in a bounded queue, waiting for room (backpressure)
+    :param queue: Queue.Queue
+    :param item: item to put
+    :param stop_event: threading.Event which gives up the wait when set
+    :param timeout: interval between two checks of stop_event, in seconds
+    :return: True if the item was put
+    """
+    while True:
+        try:
+            queue.put(item, timeout=timeout)
+            return True
+        except Queue.Full:
+            if stop_event is not None and stop_event.is_set():
+                return False
+
+def error_message():
+    """
+    Type and message of the exception being handled, on a single line
+    """
+    return ' '.join(' '.join(traceback.format_exception_only(*sys.exc_info()[:2])).split())
+
+class ThreadStage(object):
+    """
+    Class which applies a function to the plates of its input queue
+    in one or more threads and puts them in its output queue.
+    The plates already in error go through unchanged.
+    """
+
+    def __init__(self, name, function, threads=1, queue_size=4):
+        """
+        Constructor of ThreadStage
+        :param name: name of the stage, used by the metrics
+        :param function: function modifying a Plate
+        :param threads: number of threads
+        :param queue_size: size of the input queue
+        """
+        self.name = name
+        self.function = function
+        self.queue = Queue.Queue(queue_size)
+        self.output = None
+        self.threads = [threading.Thread(target=self.attached, args=(self.run,), name=name) \
+                        for _ in range(threads)]
+        self.closer = threading.Thread(target=self.close)
+        self.running = threads
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.max_depth = 0
+        self.collectors = []
+
+    def start(self, output):
+        """
+        Start the threads, which record their measures in the
+        collections of the calling thread
+        :param output: input queue of the next stage
+        """
+        self.output = output
+        self.collectors = metrics.active()
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        self.closer.daemon = True
+        self.closer.start()
+
+    def attached(self, loop):
+        """
+        Run a loop of the stage in the collections given to start
+        """
+        with metrics.attach(self.collectors):
+            loop()
+
+    def run(self):
+        """
+        Loop of a thread
+        """
+        while True:
+            plate = self.queue.get()
+            if plate is STOP:
+                with self.lock:
+                    self.running -= 1
+                    if self.running != 0:
+                        self.queue.put(STOP) # for the other threads of the stage
+                return
+            with self.lock:
+                self.max_depth = max(self.max_depth, self.queue.qsize() + 1)
+            if plate.error is None:
+                try:
+                    with metrics.timer('stage_' + self.name):
+                        self.function(plate)
+                # pylint: disable=broad-except
+                except Exception:
+                    plate.error = '%s: %s' % (self.name, error_message())
+            with self.lock:
+                self.processed += 1
+            put(self.output, plate)
+
+    def close(self):
+        """
+        Close the output queue once every thread has finished
+        """
+        for thread in self.threads:
+            thread.join()
+        put(self.output, STOP)
+
+    def depth(self):
+        """
+        Number of plates waiting in the input queue
+        """
+        return self.queue.qsize()
+
+class ProcessStage(ThreadStage):
+    """
+    Class which runs a function on the plates in a pool of processes:
+    a thread submits the plates, at most in_flight at a time, and
+    another one collects the results in order
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, task, finish, pool, in_flight, queue_size=4):
+        """
+        Constructor of ProcessStage
+        :param name: name of the stage, used by the metrics
+        :param task: function of a Plate giving the function run by
+                     the pool and its arguments
+        :param finish: function of a Plate and of the result of the pool
+        :param pool: multiprocessing.Pool
+        :param in_flight: largest number of plates in the pool
+        :param queue_size: size of the input queue
+        """
+        ThreadStage.__init__(self, name, None, 1, queue_size)
+        self.task = task
+        self.finish = finish
+        self.pool = pool
+        self.slots = threading.BoundedSemaphore(in_flight)
+        self.pending = Queue.Queue()
+        self.closer = threading.Thread(target=self.attached, args=(self.collect,), \
+                                       name=name + '-collect')
+
+    def run(self):
+        """
+        Loop of the thread submitting the plates
+        """
+        while True:
+            plate = self.queue.get()
+            if plate is STOP:
+                self.pending.put((STOP, None))
+                return
+            self.max_depth = max(self.max_depth, self.queue.qsize() + 1)
+            self.slots.acquire()
+            result = None
+            if plate.error is None:
+                function, args = self.task(plate)
+                result = self.pool.apply_async(function, args)
+            self.pending.put((plate, result))
+
+    def collect(self):
+        """
+        Loop of the thread collecting the results, in the order of the plates
+        """
+        while True:
+            plate, result = self.pending.get()
+            if plate is STOP:
+                put(self.output, STOP)
+                return
+            if result is not None:
+                try:
+                    self.finish(plate, result.get())
+                # pylint: disable=broad-except
+                except Exception:
+                    plate.error = '%s: %s' % (self.name, error_message())
+            self.slots.release()
+            with self.lock:
+                self.processed += 1
+            put(self.output, plate)
+
+    def in_flight(self):
+        """
+        Number of plates given to the pool and not collected yet
+        """
+        return self.pending.qsize()
+
+def detect(path, pixels, options):
+    """
+    Fit the background and find the clusters of a picture,
+    in a process of the pool
+    :param path: path of the fits file, used by the metrics
+    :param pixels: 2D array corresponding to the picture
+    :param options: dictionary of options (nsigma and background)
+    :return: tuple (catalog.Catalog, dictionary of the measures of the run)
+    """
+    with metrics.collect(path) as stats:
+        background, dispersion = get_estimator(options['background']).estimate(pixels)
+        threshold = background + options['nsigma'] * dispersion
+        clusters = mylib.get_cluster_array(pixels, background, dispersion, threshold)
+    return clusters, stats.as_dict()
+
+def ignore_interrupt():
+    """
+    Leave the interruptions to the main process, which drains the pool
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class Watcher(object):
+    """
+    Class which finds the new files of a directory: a file is taken
+    once its size and modification time did not change between two scans,
+    the files whose catalog is more recent being skipped. A file is
+    taken again when it is replaced once its plate is done, or when it
+    changes after its plate failed.
+    """
+
+    def __init__(self, directory, pattern, output_path):
+        """
+        Constructor of Watcher
+        :param directory: watched directory
+        :param pattern: pattern of the names of the files
+        :param output_path: function giving the catalog of a file
+        """
+        self.directory = directory
+        self.pattern = pattern
+        self.output_path = output_path
+        self.sizes = {} # (size, mtime) of the files seen at the last scan
+        self.taken = {} # (size, mtime) of the files in the pipeline or failed
+        self.lock = threading.Lock()
+
+    def is_input(self, file_name):
+        """
+        Tell whether a file of the directory is to be processed,
+        the catalogs written in it being left out
+        """
+        if file_name.startswith(TEMPORARY_PREFIX) or \
+           os.path.splitext(file_name)[0].endswith(CATALOG_SUFFIX):
+            return False
+        return fnmatch.fnmatch(file_name, self.pattern)
+
+    def scan(self, settle=True):
+        """
+        List the new files ready to be processed
+        :param settle: if False, take the files without waiting for a second scan
+        :return: sorted list of paths
+        """
+        ready, sizes = [], {}
+        with self.lock:
+            for file_name in sorted(os.listdir(self.directory)):
+                if not self.is_input(file_name):
+                    continue
+                path = os.path.join(self.directory, file_name)
+                try:
+                    status = os.stat(path)
+                except OSError: # removed meanwhile
+                    continue
+                sizes[path] = (status.st_size, status.st_mtime)
+                if self.taken.get(path) == sizes[path] or \
+                   (settle and self.sizes.get(path) != sizes[path]):
+                    continue
+                output = self.output_path(path)
+                if not os.path.exists(output) or os.path.getmtime(output) < status.st_mtime:
+                    self.taken[path] = sizes[path]
+                    ready.append(path)
+
+            # Forget the files removed from the directory
+            for path in [path for path in self.taken if path not in sizes]:
+                del self.taken[path]
+        self.sizes = sizes
+        return ready
+
+    def release(self, path, failed=False):
+        """
+        Forget a file once its plate is done, its catalog telling
+        whether it has to be processed again
+        :param path: path of the file
+        :param failed: if True, the file is kept until it changes
+        """
+        if not failed:
+            with self.lock:
+                self.taken.pop(path, None)
+
+class WatchPipeline(object):
+    """
+    Class which links the stages processing the files
+    """
+
+    def __init__(self, options):
+        """
+        Constructor of WatchPipeline
+        :param options: dictionary of the options of the command line
+        """
+        self.options = options
+        jobs = options['jobs'] or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(jobs, initializer=ignore_interrupt)
+        size = options['queue_size']
+        io_threads = options['io_threads']
+        self.stages = [ThreadStage('read', self.read, io_threads, size), \
+                       ProcessStage('detect', self.detect_task, self.detect_finish, \
+                                    self.pool, 2 * jobs, size)]
+        if options['wcs'] or options['names']:
+            self.stages.append(ThreadStage('wcs', self.wcs, 1, size))
+        if options['names']:
+            self.stages.append(ThreadStage('names', self.names, io_threads, size))
+        self.stages.append(ThreadStage('write', self.write, 1, size))
+        self.done = Queue.Queue()
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.start(next_stage.queue)
+        self.stages[-1].start(self.done)
+        self.stats = metrics.Stats('watch')
+        self.results = collections.Counter()
+        self.latency = 0.
+
+    def read(self, plate):
+        """
+        Read the whole picture, so that it can be sent to the pool
+        """
+        pixels, plate.header = mylib.get_pixels(plate.path)
+        if pixels is None:
+            raise IOError('cannot open %s' % plate.path)
+        plate.pixels = np.array(pixels)
+        plate.shape = plate.pixels.shape
+
+    def detect_task(self, plate):
+        """
+        Function run by the pool for a plate
+        """
+        return detect, (plate.path, plate.pixels, self.options)
+
+    def detect_finish(self, plate, result):
+        """
+        Keep the clusters found by the pool and drop the pixels
+        """
+        plate.clusters, stats = result
+        plate.pixels = None
+        with metrics.LOCK:
+            self.stats.merge(stats)
+
+    @staticmethod
+    def wcs(plate):
+        """
+        Celestial coordinates of the clusters
+        """
+        plate.wcs = library.WCS(plate.header)
+        mylib.convert_clusters(plate.clusters, plate.wcs)
+
+    def names(self, plate):
+        """
+        Names of the clusters
+        """
+        mylib.name_clusters(plate.clusters, plate.wcs, plate.shape, \
+                            field_query=self.options['field_query'])
+
+    def output_path(self, path):
+        """
+        Path of the catalog of a fits file
+        """
+        name = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.options['output_dir'], \
+                            '%s%s.%s' % (name, CATALOG_SUFFIX, self.options['format']))
+
+    def write(self, plate):
+        """
+        Write the catalog in a temporary file renamed once complete,
+        so that readers never see a partial catalog
+        """
+        path = self.output_path(plate.path)
+        temporary = os.path.join(os.path.dirname(path), TEMPORARY_PREFIX + os.path.basename(path))
+        catalog.write_catalog(plate.clusters, temporary, [plate.path])
+        os.rename(temporary, path)
+
+    def submit(self, path, stop_event=None):
+        """
+        Give a file to the first stage, waiting while its queue is full
+        :return: True if the file was taken
+        """
+        return put(self.stages[0].queue, Plate(path), stop_event)
+
+    def report_done(self, release=None):
+        """
+        Report the files which went through every stage
+        :param release: function called with the path of every file
+                        reported and True if it failed
+        :return: False once the last stage is closed
+        """
+        while True:
+            try:
+                plate = self.done.get_nowait()
+            except Queue.Empty:
+                return True
+            if plate is STOP:
+                return False
+            latency = time.time() - plate.started
+            self.latency += latency
+            if plate.error is not None:
+                self.results['failed'] += 1
+                print '%s: ERROR %s' % (plate.path, plate.error)
+            else:
+                self.results['done'] += 1
+                print '%s: %d clusters (%.2f s)' % (plate.path, len(plate.clusters), latency)
+            sys.stdout.flush()
+            if release is not None:
+                release(plate.path, plate.error is not None)
+
+    def status(self):
+        """
+        Depth of the queues and progress of the service
+        :return: dictionary of plain values
+        """
+        count = sum(self.results.values())
+        return {'label': 'status', \
+                'queues': {stage.name: stage.depth() for stage in self.stages}, \
+                'max_queues': {stage.name: stage.max_depth for stage in self.stages}, \
+                'in_flight': self.stages[1].in_flight(), \
+                'processed': {stage.name: stage.processed for stage in self.stages}, \
+                'done': self.results['done'], 'failed': self.results['failed'], \
+                'mean_latency': self.latency / count if count else None}
+
+    def drain(self):
+        """
+        Close the first queue and wait until every file taken is processed
+        """
+        put(self.stages[0].queue, STOP)
+        while self.report_done():
+            time.sleep(0.1)
+        self.pool.close()
+        self.pool.join()
+
+def intake(watcher, pipeline, stop_event, poll, once=False):
+    """
+    Give the new files to the pipeline until stop_event is set, in its
+    own thread so that the reports go on while the first queue is full
+    :param watcher: instance of Watcher
+    :param pipeline: instance of WatchPipeline
+    :param stop_event: threading.Event which stops the intake
+    :param poll: interval between two scans in seconds
+    :param once: if True, give the files already present, then stop
+    """
+    while not stop_event.is_set():
+        for path in watcher.scan(settle=not once):
+            if not pipeline.submit(path, stop_event):
+                watcher.release(path) # taken again at the next start
+                return
+        if once:
+            return
+        stop_event.wait(poll)
+
+def main():
+    """
+    Parse the command line and watch the directory until interrupted
+    """
+    parser = argparse.ArgumentParser(description='Find the clusters of the fits files ' \
+                                                 'appearing in a directory')
+    parser.add_argument('directory', help='watched directory')
+    parser.add_argument('--pattern', default='*.fits', help='names of the files (default: *.fits)')
+    parser.add_argument('--output-dir', default=None, \
+                        help='directory of the catalogs (default: the watched one)')
+    parser.add_argument('--format', choices=['txt', 'npy', 'npz', 'fits'], default='txt', \
+                        help='format of the catalogs (default: txt)')
+    parser.add_argument('--poll', type=float, default=2.0, \
+                        help='interval between two scans in seconds (default: 2)')
+    parser.add_argument('--once', action='store_true', \
+                        help='process the files already present, then stop')
+    parser.add_argument('-j', '--jobs', type=int, default=None, \
+                        help='number of detection processes (default: number of cores)')
+    parser.add_argument('--io-threads', type=int, default=2, \
+                        help='threads of the reading and naming stages (default: 2)')
+    parser.add_argument('--queue-size', type=int, default=4, \
+                        help='files waiting between two stages (default: 4)')
+    parser.add_argument('--nsigma', type=float, default=6.0, \
+                        help='threshold in dispersions above the background')
+    parser.add_argument('--background', choices=sorted(ESTIMATORS), default='fit', \
+                        help='background estimator (default: fit)')
+    parser.add_argument('--wcs', action='store_true', \
+                        help='compute the celestial coordinates of the clusters')
+    parser.add_argument('--names', action='store_true', help='find the star names')
+    parser.add_argument('--field-query', action='store_true', \
+                        help='a single Simbad request per file for the names')
+    parser.add_argument('--reference', default=None, \
+                        help='find the star names in this reference catalog instead of Simbad')
+    parser.add_argument('--simbad-cache', default='../cache/simbad', \
+                        help='directory of the Simbad answers (default: ../cache/simbad)')
+    parser.add_argument('--status-interval', type=float, default=30.0, \
+                        help='interval between two status lines in seconds (default: 30)')
+    parser.add_argument('--metrics-log', default=None, \
+                        help='append the status and the final measures to this JSON lines file')
+    args = parser.parse_args()
+
+    options = vars(args)
+    options['output_dir'] = args.output_dir or args.directory
+    if not os.path.isdir(options['output_dir']):
+        os.makedirs(options['output_dir'])
+    if args.reference is not None:
+        library.use_reference(args.reference)
+    elif args.names:
+        library.use_simbad_cache(args.simbad_cache)
+
+    # The first interruption drains the pipeline, the second one aborts
+    stop_event = threading.Event()
+    def interrupt(signum, _):
+        """
+        Stop taking new files
+        """
+        print 'signal %d: finishing the files already taken' % signum
+        sys.stdout.flush()
+        stop_event.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
+    next_status = time.time()
+    with metrics.collect('watch') as stats:
+        pipeline = WatchPipeline(options)
+        watcher = Watcher(args.directory, args.pattern, pipeline.output_path)
+        intake_thread = threading.Thread(target=intake, name='intake', \
+                                         args=(watcher, pipeline, stop_event, args.poll, args.once))
+        intake_thread.daemon = True
+        intake_thread.start()
+        while intake_thread.is_alive():
+            pipeline.report_done(watcher.release)
+            if time.time() >= next_status:
+                status = pipeline.status()
+                print 'queues %s, in flight %d, done %d, failed %d' % \
+                      (' '.join('%s=%d' % (stage.name, status['queues'][stage.name]) \
+                                for stage in pipeline.stages), \
+                       status['in_flight'], status['done'], status['failed'])
+                sys.stdout.flush()
+                if args.metrics_log is not None:
+                    metrics.write_log(status, args.metrics_log)
+                next_status = time.time() + args.status_interval
+            time.sleep(0.1)
+        pipeline.drain()
+    stats.merge(pipeline.stats)
+
+    status = pipeline.status()
+    print '%d files done, %d failed, largest queues %s' % \
+          (status['done'], status['failed'], \
+           ' '.join('%s=%d' % (stage.name, stage.max_depth) for stage in pipeline.stages))
+    print stats.summary()
+    if args.metrics_log is not None:
+        metrics.write_log(status, args.metrics_log)
+        metrics.write_log(stats, args.metrics_log)
+
+    return 0 if status['failed'] == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main())